@@ -0,0 +1,521 @@
+# --- START OF FILE base_transport.py ---
+import asyncio
+import itertools
+import random
+import time
+from collections import deque
+from typing import Awaitable, Callable, Optional, Tuple, Union
+
+from batch_buffer import BatchBuffer, HEADROOM
+from config import config
+from crypto_utils import CryptoManager
+from compressor import Compressor
+from metrics import metrics
+from packet_view import PacketView
+from tcp_dedup import RetransmitFilter
+from wan_optimizer import WanOptimizer
+from worker_pool import WorkerPool
+from control_frames import (append_control, echo_request, echo_reply, rtt_from_reply, RttEstimator,
+                            CTRL_ECHO_REQUEST, CTRL_ECHO_REPLY, CTRL_WAN_NACK, CTRL_WAN_RESET)
+
+
+BATCH_FLAG_GZIP = 0x01
+BATCH_FLAG_WAN = 0x02
+
+
+class BaseTransport:
+    """
+    Базовый класс транспорта туннеля.
+
+    Контракт, которого ожидает PacketHandler:
+      * ``initialize(receive_callback, mode)`` — подключение к каналу,
+        ``mode`` = 'client' или 'server'. Возвращает True при успехе.
+      * ``send_data(data)`` — поставить IP-пакет (bytes или PacketView) в очередь на отправку.
+      * ``disconnect()`` — остановить фоновые задачи и закрыть канал.
+      * ``receive_callback`` — корутина ``(packet: bytes)``, вызывается
+        для каждого пакета, пришедшего с другой стороны туннеля.
+
+    Общая часть (очередь, пакетирование, сжатие/шифрование, разбор батча)
+    реализована здесь. Наследник отвечает только за доставку готового
+    зашифрованного батча (``_send_batch_task``) и за скачивание/разбор
+    входящего сообщения (``_download_task``). Оба метода выполняются в
+    пулах воркеров (worker_pool.py) фиксированного размера: при их
+    заполнении батчер и приём сообщений ждут, а не плодят задачи.
+
+    Обрыв связи: наследник вызывает ``connection_lost()`` (или
+    ``_upload_failed()`` на сетевой ошибке загрузки) и реализует
+    ``_reconnect()``. Пока идут попытки переподключения с экспоненциальной
+    паузой, очередь продолжает приниматься, а готовые батчи копятся в
+    пределах config.reconnect_buffer_bytes — TAP и маршруты не трогаются.
+
+    Подавление повторов TCP (tcp_dedup.py): отпечатки пакетов батча лежат
+    в ``batch.fingerprints``; наследник после успешной загрузки зовёт
+    ``_batch_uploaded``, а батч, освобождённый без этого, считается
+    выброшенным — и повторы его сегментов снова пропускаются.
+
+    Формат батча: последовательность ``[длина: 2 байта big-endian][пакет]``,
+    служебные кадры (пробы RTT) — см. control_frames.py. Перед шифрованием
+    добавляется байт флагов (BATCH_FLAG_GZIP, BATCH_FLAG_WAN), поэтому
+    сжатие и WAN-оптимизацию (wan_optimizer.py) можно включать и выключать
+    на ходу, не согласуя стороны.
+
+    Батч собирается в BatchBuffer (batch_buffer.py): пакет копируется туда
+    один раз, сжатие пишет в другой буфер из запаса, шифрование идёт на
+    месте, и наследник загружает ``batch.sealed`` (memoryview), после чего
+    возвращает буфер через ``_release_batch``.
+
+    Стадии батча (pipeline.py): ``tx_pipeline`` вызывается для каждого
+    отправляемого батча, ``rx_pipeline`` — после разбора принятого.
+    Конвейеры назначает обработчик; без них транспорт работает как раньше.
+
+    Data plane (data_plane.py): если main.py назначил ``data_plane``,
+    наследники зовут ``_encode_batch_async`` / ``_decode_batch_async``, и
+    gzip с ГОСТ уходят в процессы-воркеры. WAN-оптимизация остаётся здесь:
+    её хранилища чанков — состояние транспорта. Без data plane (или когда
+    воркер недоступен) это те же ``_encode_batch`` / ``_decode_batch``.
+    """
+
+    # Максимальная длина очереди отправки, после неё старые пакеты выбрасываются
+    max_queue_size = 5000
+    # False — не выбрасывать: отправитель сам ограничивает очередь (окна потоков прокси)
+    drop_oldest = True
+    # Параллельные загрузки батчей и скачивания сообщений
+    upload_workers = 5
+    # Сколько свободных буферов батчей держать для повторного использования
+    spare_batches = 4
+    download_workers = 4
+    # DataPlane на все транспорты процесса; None — всё в цикле событий
+    data_plane = None
+
+    def __init__(self, encryption_key: Optional[str] = None):
+        self.receive_callback: Optional[Callable[[bytes], Awaitable[None]]] = None
+        self.tx_pipeline = None
+        self.rx_pipeline = None
+        self.crypto = CryptoManager(encryption_key if encryption_key is not None else config.encryption_key)
+        self.compressor = Compressor()
+        self.is_connected = False
+        self.send_queue = asyncio.Queue()
+        self.sender_task = None
+        self.free_batches = []
+        # Повторы TCP-сегментов, которые ещё в очереди или недавно ушли
+        self.dedup = RetransmitFilter(config.tcp_dedup_slots) if config.tcp_dedup else None
+        self.upload_pool = WorkerPool('upload', self._send_batch_task, self.upload_workers, config.worker_queue_size)
+        self.download_pool = WorkerPool('download', self._download_task, self.download_workers,
+                                        config.worker_queue_size)
+
+        # Пробы RTT: идут вместе с данными, а в простое — отдельным батчем
+        self.rtt = RttEstimator()
+        self.last_probe = 0.0
+        self.probe_ids = itertools.count(1)
+        self.pending_control = deque()
+        # Служебные кадры других модулей (DNS): тип -> функция(payload)
+        self.control_handlers = {}
+        # Дедупликация чанков; принимать WAN-батчи может любая сторона
+        self.wan = WanOptimizer()
+        self.control_handlers[CTRL_WAN_NACK] = self.wan.on_nack
+        self.control_handlers[CTRL_WAN_RESET] = self.wan.on_reset
+
+        # Переподключение: пока reconnect_task жив, батчи идут в backlog
+        self.reconnect_task: Optional[asyncio.Task] = None
+        self.backlog = deque()
+        self.backlog_bytes = 0
+        self.reconnects = 0
+
+    async def initialize(self, receive_callback: Callable, mode: str = 'server') -> bool:
+        raise NotImplementedError
+
+    async def send_data(self, data: Union[bytes, PacketView]):
+        if not self.is_connected: return
+        dedup = self.dedup
+        if dedup is not None and data.__class__ is PacketView:
+            key = dedup.fingerprint(data)
+            # Окно после загрузки не меньше полутора RTT туннеля: столько оригинал идёт до пира
+            if key and dedup.is_retransmit(key, time.monotonic(),
+                                           max(config.tcp_dedup_window, 1.5 * (self.rtt.srtt or 0.0)),
+                                           data.length - 14):
+                metrics.tcp_retransmits_suppressed.inc()
+                metrics.tcp_retransmit_bytes_suppressed.inc(data.length - 14)
+                return
+        if self.drop_oldest and self.send_queue.qsize() > self.max_queue_size:
+            try:
+                dropped = self.send_queue.get_nowait()
+                metrics.queue_dropped.inc()
+                if dedup is not None and dropped.__class__ is PacketView:
+                    # Оригинал выброшен: его повтор должен пройти
+                    dedup.forget((dedup.fingerprint(dropped),))
+            except asyncio.QueueEmpty:
+                pass
+        await self.send_queue.put(data)
+
+    async def _batch_sender_worker(self):
+        """Собирает пакеты из очереди в батчи по batch_interval / max_batch_size"""
+        print("📦 Batch sender started")
+        buffer = self._acquire_batch()
+
+        while self.is_connected:
+            try:
+                packet = await self._wait_first_packet()
+                count = 0
+                if packet is not None:
+                    self._append_to_buffer(buffer, packet)
+                    count = 1
+
+                start_time = time.time()
+                while len(buffer) < config.max_batch_size:
+                    remaining = config.batch_interval - (time.time() - start_time)
+                    if remaining <= 0: break
+                    try:
+                        packet = await asyncio.wait_for(self.send_queue.get(), timeout=remaining)
+                        self.send_queue.task_done()
+                        if packet is None: continue
+                        self._append_to_buffer(buffer, packet)
+                        count += 1
+                    except asyncio.TimeoutError:
+                        break
+
+                self._append_control_frames(buffer)
+                if buffer:
+                    metrics.batches_sent.inc()
+                    metrics.batch_bytes.observe(len(buffer))
+                    metrics.batch_packets.observe(count)
+                    pipeline = self.tx_pipeline
+                    if pipeline is not None and pipeline.batch_stages:
+                        pipeline.run_batch(count, len(buffer))
+                    await self._dispatch_batch(buffer)
+                    buffer = self._acquire_batch()
+
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                print(f"❌ Worker Error: {e}")
+                self._release_batch(buffer)
+                buffer = self._acquire_batch()
+                await asyncio.sleep(0.1)
+
+    async def _wait_first_packet(self):
+        """
+        Первый пакет батча. Если пакетов нет дольше rtt_probe_interval,
+        возвращает None — батч уйдёт с одной лишь пробой RTT.
+        None в очереди — сигнал "есть служебные кадры, отправь батч".
+        """
+        interval = config.rtt_probe_interval
+        if not interval:
+            packet = await self.send_queue.get()
+        else:
+            timeout = max(0.0, self.last_probe + interval - time.monotonic())
+            try:
+                packet = await asyncio.wait_for(self.send_queue.get(), timeout=timeout)
+            except asyncio.TimeoutError:
+                return None
+        self.send_queue.task_done()
+        return packet
+
+    def _append_control_frames(self, buffer: bytearray):
+        while self.pending_control:
+            ctype, payload = self.pending_control.popleft()
+            append_control(buffer, ctype, payload() if callable(payload) else payload)
+        interval = config.rtt_probe_interval
+        now = time.monotonic()
+        if interval and now - self.last_probe >= interval:
+            self.last_probe = now
+            append_control(buffer, CTRL_ECHO_REQUEST, echo_request(next(self.probe_ids)))
+
+    def _handle_control(self, ctype: int, payload: bytes):
+        if ctype == CTRL_ECHO_REQUEST:
+            received = time.monotonic_ns()
+            # Время "пролёжки" считаем в момент сборки батча
+            self.pending_control.append((CTRL_ECHO_REPLY, lambda: echo_reply(payload, received)))
+            self.send_queue.put_nowait(None)
+        elif ctype == CTRL_ECHO_REPLY:
+            sample = rtt_from_reply(payload)
+            self.rtt.update(sample)
+            metrics.tunnel_rtt_seconds.observe(sample)
+            metrics.tunnel_srtt.set(self.rtt.srtt)
+            metrics.tunnel_rtt_jitter.set(self.rtt.jitter)
+        elif ctype in self.control_handlers:
+            self.control_handlers[ctype](payload)
+
+    async def send_control_now(self, frames):
+        """
+        Служебные кадры [(тип, данные), ...] одним батчем вне очереди: без
+        ожидания batch_interval и раньше уже стоящих в пуле загрузки батчей
+        """
+        if not self.is_connected: return
+        batch = self._acquire_batch()
+        for ctype, payload in frames:
+            append_control(batch, ctype, payload)
+        metrics.batches_sent.inc()
+        if self.reconnect_task is not None:
+            self._buffer_batch(batch)
+        else:
+            await self.upload_pool.submit(batch, priority=0)
+
+    def _append_to_buffer(self, buffer: BatchBuffer, packet: Union[bytes, PacketView]):
+        if packet.__class__ is PacketView:
+            if self.dedup is not None:
+                key = self.dedup.fingerprint(packet)
+                if key: buffer.fingerprints.append(key)
+            packet = packet.ip_packet
+        buffer.append_packet(packet)
+
+    def _acquire_batch(self) -> BatchBuffer:
+        return self.free_batches.pop() if self.free_batches else BatchBuffer()
+
+    def _release_batch(self, batch: BatchBuffer):
+        if batch.fingerprints and self.dedup is not None:
+            # Батч освобождается без _batch_uploaded — значит, выброшен
+            self.dedup.forget(batch.fingerprints)
+        batch.clear()
+        if len(self.free_batches) < self.spare_batches:
+            self.free_batches.append(batch)
+
+    def _batch_uploaded(self, batch: BatchBuffer):
+        """Наследник зовёт после успешной загрузки, до _release_batch"""
+        if batch.fingerprints:
+            if self.dedup is not None:
+                self.dedup.sent(batch.fingerprints, time.monotonic())
+            batch.fingerprints.clear()
+
+    async def _send_batch_task(self, batch: BatchBuffer):
+        """Сжать, зашифровать и доставить один батч (реализует наследник)"""
+        raise NotImplementedError
+
+    async def _download_task(self, message):
+        """Скачать, расшифровать и разобрать одно входящее сообщение (реализует наследник)"""
+        raise NotImplementedError
+
+    # --- Переподключение ---
+
+    @property
+    def link_up(self) -> bool:
+        return self.is_connected and self.reconnect_task is None
+
+    async def _dispatch_batch(self, batch: BatchBuffer):
+        if self.reconnect_task is not None:
+            self._buffer_batch(batch)
+        else:
+            await self.upload_pool.submit(batch)
+
+    def _buffer_batch(self, batch: BatchBuffer):
+        """Батч ждёт переподключения; сверх бюджета выбрасываются самые старые"""
+        self.backlog.append(batch)
+        self.backlog_bytes += len(batch)
+        while self.backlog_bytes > config.reconnect_buffer_bytes and len(self.backlog) > 1:
+            dropped = self.backlog.popleft()
+            self.backlog_bytes -= len(dropped)
+            metrics.reconnect_dropped_bytes.inc(len(dropped))
+            self._release_batch(dropped)
+
+    @staticmethod
+    def _is_connection_error(exc: BaseException) -> bool:
+        # requests.ConnectionError и ошибки сокетов Telethon — наследники OSError
+        return isinstance(exc, (OSError, asyncio.TimeoutError))
+
+    def _upload_failed(self, batch: BatchBuffer, exc: BaseException) -> bool:
+        """
+        Учёт неудачной загрузки. Сетевая ошибка — батч (уже зашифрованный)
+        возвращается в backlog и запускается переподключение (True),
+        остальные ошибки батч теряют и буфер освобождается.
+        """
+        metrics.upload_errors.inc()
+        if not self.is_connected or not self._is_connection_error(exc):
+            self._release_batch(batch)
+            return False
+        self._buffer_batch(batch)
+        self.connection_lost(exc)
+        return True
+
+    def connection_lost(self, exc: Optional[BaseException] = None):
+        """Канал оборвался: запустить переподключение (повторный вызов ничего не делает)"""
+        if not self.is_connected or self.reconnect_task is not None:
+            return
+        print(f"🔌 Connection lost: {exc or 'unknown reason'}. Reconnecting...")
+        self.reconnect_task = asyncio.create_task(self._reconnect_loop())
+
+    async def _reconnect_loop(self):
+        started = time.perf_counter()
+        delay = config.reconnect_min_delay
+        attempt = 0
+        try:
+            while self.is_connected:
+                attempt += 1
+                try:
+                    if await self._reconnect():
+                        break
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    print(f"⚠️ Reconnect attempt {attempt} failed: {e}")
+                # Случайная добавка, чтобы сессии многоклиентского сервера не ломились разом
+                await asyncio.sleep(delay * (1 + random.random() * 0.2))
+                delay = min(delay * 2, config.reconnect_max_delay)
+            else:
+                return
+        finally:
+            self.reconnect_task = None
+
+        self.reconnects += 1
+        metrics.reconnects.inc()
+        metrics.reconnect_seconds.time(started)
+        print(f"✅ Reconnected in {time.perf_counter() - started:.1f}s "
+              f"({attempt} attempts), resending {len(self.backlog)} batches")
+        while self.backlog and self.reconnect_task is None:
+            batch = self.backlog.popleft()
+            self.backlog_bytes -= len(batch)
+            await self.upload_pool.submit(batch)
+
+    async def _reconnect(self) -> bool:
+        """Одна попытка восстановить канал (реализует наследник). True — канал снова работает"""
+        return False
+
+    def _encode_batch(self, batch: BatchBuffer) -> BatchBuffer:
+        """
+        Батч -> (WAN) -> (gzip) -> ГОСТ. Возвращает буфер (при сжатии — другой,
+        исходный освобождается), в котором ``sealed`` готов к загрузке в мессенджер.
+        Уже зашифрованный батч (повтор после переподключения) не трогает.
+        Исходный буфер освобождается только после успеха: при исключении он
+        по-прежнему у вызывающего (его освободит ``_upload_failed``).
+        """
+        if batch.sealed is not None:
+            return batch
+        wan, flags = self._wan_encode(batch)
+        try:
+            out = self._seal(wan, flags)
+        except Exception:
+            if wan is not batch: self._release_batch(wan)
+            raise
+        self._release_stages(out, batch, wan)
+        return out
+
+    def _wan_encode(self, batch: BatchBuffer) -> Tuple[BatchBuffer, int]:
+        """WAN-стадия отправки и флаги батча (gzip — по текущему config). Вход не освобождается"""
+        flags = BATCH_FLAG_GZIP if config.compression_enabled else 0
+        if config.wan_optimizer:
+            out = self._acquire_batch()
+            # Ссылаемся только на чанки, которые пир уже должен был получить
+            self.wan.encode_into(batch.payload(), out, max(config.wan_settle, 2 * (self.rtt.srtt or 0.0)))
+            batch, flags = out, flags | BATCH_FLAG_WAN
+        return batch, flags
+
+    def _seal(self, batch: BatchBuffer, flags: int) -> BatchBuffer:
+        """gzip (по флагу) и ГОСТ. Вход не освобождается: сжатый батч — в другом буфере"""
+        if flags & BATCH_FLAG_GZIP:
+            out = self._acquire_batch()
+            self.compressor.compress_into(batch.payload(), out)
+            batch = out
+        batch.buf[HEADROOM - 1] = flags
+        batch.sealed = self.crypto.encrypt_into(batch.buf, HEADROOM - 1, batch.end)
+        return batch
+
+    def _release_stages(self, out: BatchBuffer, batch: BatchBuffer, wan: BatchBuffer):
+        """Освободить исходный и промежуточный (WAN) буферы, кроме итогового out"""
+        if batch is not out:
+            # Отпечатки TCP-сегментов едут с зашифрованным батчем
+            out.fingerprints, batch.fingerprints = batch.fingerprints, out.fingerprints
+            self._release_batch(batch)
+        if wan is not batch and wan is not out:
+            self._release_batch(wan)
+
+    async def _encode_batch_async(self, batch: BatchBuffer) -> BatchBuffer:
+        """_encode_batch, где gzip и ГОСТ делает процесс data plane (если он есть)"""
+        plane = self.data_plane
+        if plane is None or batch.sealed is not None:
+            return self._encode_batch(batch)
+        wan, flags = self._wan_encode(batch)
+        try:
+            # Пока идёт await, исходный буфер не возвращается в запас: его
+            # не отдадут другому батчу, а при ошибке его освободит вызывающий
+            sealed = await plane.seal(self.crypto.key, wan.payload(), flags)
+            if sealed is None:
+                out = self._seal(wan, flags)
+            else:
+                wan.sealed = sealed
+                out = wan
+        except Exception:
+            if wan is not batch: self._release_batch(wan)
+            raise
+        self._release_stages(out, batch, wan)
+        return out
+
+    def _decode_batch(self, encrypted_data: bytes) -> bytes:
+        """Обратная операция к _encode_batch. Бросает исключение на битых данных"""
+        metrics.download_bytes.inc(len(encrypted_data))
+        try:
+            data = self.crypto.decrypt(encrypted_data)
+            # Сжатие определяется флагом батча, а не локальным config
+            flags = data[0]
+            data = self.compressor.decompress(data[1:]) if flags & BATCH_FLAG_GZIP else data[1:]
+        except Exception:
+            metrics.decode_errors.inc()
+            raise
+        return self._wan_decode(flags, data)
+
+    async def _decode_batch_async(self, encrypted_data: bytes) -> bytes:
+        """_decode_batch, где ГОСТ и gunzip делает процесс data plane (если он есть)"""
+        plane = self.data_plane
+        if plane is None:
+            return self._decode_batch(encrypted_data)
+        try:
+            opened = await plane.open(self.crypto.key, encrypted_data)
+        except Exception:
+            metrics.decode_errors.inc()
+            raise
+        if opened is None:
+            return self._decode_batch(encrypted_data)
+        metrics.download_bytes.inc(len(encrypted_data))
+        return self._wan_decode(opened[0], bytes(opened[1:]))
+
+    def _wan_decode(self, flags: int, data: bytes) -> bytes:
+        if flags & BATCH_FLAG_WAN:
+            try:
+                data = self.wan.decode(data)
+            except Exception:
+                metrics.decode_errors.inc()
+                raise
+        metrics.batches_received.inc()
+        if self.wan.outgoing:
+            # NACK / сброс хранилища чанков уйдут со следующим батчем
+            self.pending_control.extend(self.wan.outgoing)
+            self.wan.outgoing.clear()
+            self.send_queue.put_nowait(None)
+        return data
+
+    async def _parse_batch_and_route(self, data: bytes):
+        idx = 0
+        count = 0
+        total_len = len(data)
+        while idx < total_len:
+            if idx + 2 > total_len: break
+            pkt_len = int.from_bytes(data[idx:idx + 2], 'big')
+            idx += 2
+            if pkt_len == 0:
+                # Служебный кадр: [тип][длина][данные]
+                if idx + 3 > total_len: break
+                ctype = data[idx]
+                clen = int.from_bytes(data[idx + 1:idx + 3], 'big')
+                idx += 3
+                if idx + clen > total_len: break
+                self._handle_control(ctype, data[idx:idx + clen])
+                idx += clen
+                continue
+            if idx + pkt_len > total_len: break
+            packet = data[idx:idx + pkt_len]
+            idx += pkt_len
+            count += 1
+
+            if self.receive_callback:
+                await self.receive_callback(packet)
+
+        pipeline = self.rx_pipeline
+        if pipeline is not None and pipeline.batch_stages:
+            pipeline.run_batch(count, total_len)
+
+    async def disconnect(self):
+        self.is_connected = False
+        if self.sender_task: self.sender_task.cancel()
+        if self.reconnect_task: self.reconnect_task.cancel()
+        self.upload_pool.stop()
+        self.download_pool.stop()
+        self.backlog.clear()
+        self.backlog_bytes = 0
+        self.free_batches.clear()
@@ -0,0 +1,116 @@
+# --- START OF FILE batch_buffer.py ---
+"""
+Буфер батча для исходящего пути без лишних копий.
+
+Раскладка: [IV: 16][флаги: 1][записи батча...][место под паддинг: 16]
+
+Пакет копируется из кадра TAP один раз — сразу на своё место в буфере.
+Байт флагов, IV и паддинг PKCS7 пишутся в зарезервированные края, а
+шифрование CBC идёт на месте (CryptoManager.encrypt_into), поэтому
+готовый к загрузке файл — это memoryview на тот же bytearray.
+Буферы переиспользуются (BaseTransport держит небольшой запас свободных).
+"""
+import io
+import os
+from typing import Optional
+
+IV_SIZE = 16
+HEADROOM = IV_SIZE + 1  # IV + байт флагов
+TAILROOM = 16           # паддинг PKCS7 (до одного блока)
+
+
+class BatchBuffer:
+    __slots__ = ('buf', 'end', 'sealed', 'fingerprints')
+
+    def __init__(self, capacity: int = 65536):
+        self.buf = bytearray(HEADROOM + capacity + TAILROOM)
+        self.end = HEADROOM
+        # Готовый шифротекст (memoryview на buf) после _encode_batch
+        self.sealed: Optional[memoryview] = None
+        # Отпечатки TCP-сегментов батча (tcp_dedup.py) до подтверждения загрузки
+        self.fingerprints = []
+
+    def __len__(self):
+        return self.end - HEADROOM
+
+    def _reserve(self, n: int):
+        need = self.end + n + TAILROOM
+        if need > len(self.buf):
+            # Рост удвоением; буферы переиспользуются, так что это редкость
+            grown = bytearray(max(need, 2 * len(self.buf)))
+            grown[:self.end] = memoryview(self.buf)[:self.end]
+            self.buf = grown
+
+    def extend(self, data):
+        n = len(data)
+        self._reserve(n)
+        end = self.end
+        self.buf[end:end + n] = data
+        self.end = end + n
+
+    def append(self, byte: int):
+        self._reserve(1)
+        self.buf[self.end] = byte
+        self.end += 1
+
+    def append_packet(self, packet):
+        """Запись батча [длина: 2 байта][пакет] — единственная копия пакета"""
+        n = len(packet)
+        self._reserve(n + 2)
+        buf, end = self.buf, self.end
+        buf[end] = n >> 8
+        buf[end + 1] = n & 0xFF
+        buf[end + 2:end + 2 + n] = packet
+        self.end = end + 2 + n
+
+    def payload(self) -> memoryview:
+        return memoryview(self.buf)[HEADROOM:self.end]
+
+    def clear(self):
+        self.end = HEADROOM
+        self.sealed = None
+        self.fingerprints.clear()
+
+
+class BufferReader(io.RawIOBase):
+    """
+    Файл только для чтения поверх memoryview: send_file / VkUpload читают
+    загружаемые данные прямо из буфера батча, без промежуточного BytesIO.
+    """
+
+    def __init__(self, view: memoryview, name: str):
+        super().__init__()
+        self.view = view
+        self.pos = 0
+        self.name = name
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        end = len(self.view) if size is None or size < 0 else min(len(self.view), self.pos + size)
+        data = self.view[self.pos:end].tobytes()
+        self.pos = max(self.pos, end)
+        return data
+
+    readall = read
+
+    def readinto(self, b) -> int:
+        n = max(0, min(len(b), len(self.view) - self.pos))
+        b[:n] = self.view[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += len(self.view)
+        self.pos = max(0, offset)
+        return self.pos
+
+    def tell(self) -> int:
+        return self.pos
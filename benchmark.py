@@ -0,0 +1,512 @@
+# --- START OF FILE benchmark.py ---
+"""
+Стенд замеров туннеля: PacketHandler -> транспорт -> PacketHandler в одном процессе.
+
+TAP заменён на FakeTapInterface, мессенджер — на LoopbackTransport с моделью
+канала. Трафик берётся из pcap или из синтетических профилей и гонится в обе
+стороны. Результат — JSON, который можно сравнивать между версиями.
+
+Примеры:
+    python benchmark.py --mix bulk --duration 10 --rate 2000
+    python benchmark.py --mix mixed --ideal --compression
+    python benchmark.py --mix bulk --wan --wan-settle 0.5
+    python benchmark.py --mix bulk --ideal --data-plane 2
+    python benchmark.py --pcap capture.pcap --output result.json
+    python benchmark.py --transport vk --vk-latency upload=0.3 --vk-error-rate messages.send=9:0.05
+"""
+import argparse
+import asyncio
+import json
+import platform
+import random
+import struct
+import sys
+import time
+from collections import defaultdict, deque
+
+from base_transport import BaseTransport
+from config import config
+from data_plane import DataPlane
+from fake_tap_interface import FakeTapInterface
+from loopback_transport import LoopbackLink, LinkModel, LoopbackTransport
+from packet_handler import PacketHandler
+
+BENCH_KEY = 'benchmark-key-0123456789abcdef!!'
+CLIENT_MAC = b'\x02\x00\x00\x00\x00\x0a'
+SERVER_MAC = b'\x02\x00\x00\x00\x00\x0b'
+CLIENT_IP = '10.8.0.2'
+REMOTE_IPS = ['93.184.216.34', '142.250.74.14', '151.101.1.69', '104.16.132.229']
+
+# Профили синтетического трафика: (направление, протокол, мин/макс payload, порт, вес)
+MIXES = {
+    'bulk': [('down', 6, 1400, 1460, 443, 2), ('up', 6, 0, 0, 443, 1)],
+    'interactive': [('up', 6, 1, 120, 22, 1), ('down', 6, 1, 240, 22, 1)],
+    'dns': [('up', 17, 28, 60, 53, 1), ('down', 17, 80, 320, 53, 1)],
+}
+MIXES['mixed'] = (
+    [(d, p, lo, hi, port, w * 6) for d, p, lo, hi, port, w in MIXES['bulk']] +
+    [(d, p, lo, hi, port, w * 3) for d, p, lo, hi, port, w in MIXES['interactive']] +
+    [(d, p, lo, hi, port, w) for d, p, lo, hi, port, w in MIXES['dns']]
+)
+
+
+class _NoNetwork:
+    """Заглушка NetworkManager: стенд не трогает маршруты и NAT"""
+
+    async def cleanup(self, interface_name): pass
+
+    async def setup_client_network(self, vpn_server_ip, interface_name, dns_servers=None): pass
+
+    async def setup_server_network(self, interface_name): pass
+
+
+# === Генерация кадров ===
+
+def _ip_checksum(header: bytes) -> int:
+    total = sum(struct.unpack(f'!{len(header) // 2}H', header))
+    while total >> 16:
+        total = (total & 0xFFFF) + (total >> 16)
+    return ~total & 0xFFFF
+
+
+def build_frame(src_ip: str, dst_ip: str, proto: int, sport: int, dport: int, payload: bytes,
+                src_mac: bytes = CLIENT_MAC, dst_mac: bytes = SERVER_MAC, seq: int = 0) -> bytes:
+    """Ethernet + IPv4 + TCP/UDP кадр (контрольные суммы L4 не считаются)"""
+    if proto == 6:
+        l4 = struct.pack('!HHIIBBHHH', sport, dport, seq, 0, 5 << 4, 0x18, 65535, 0, 0)
+    else:
+        l4 = struct.pack('!HHHH', sport, dport, 8 + len(payload), 0)
+    total_len = 20 + len(l4) + len(payload)
+    header = struct.pack('!BBHHHBBH4s4s', 0x45, 0, total_len, seq & 0xFFFF, 0x4000, 64, proto, 0,
+                         _ipv4_bytes(src_ip), _ipv4_bytes(dst_ip))
+    header = header[:10] + struct.pack('!H', _ip_checksum(header)) + header[12:]
+    return dst_mac + src_mac + b'\x08\x00' + header + l4 + payload
+
+
+def _ipv4_bytes(ip: str) -> bytes:
+    return bytes(int(x) for x in ip.split('.'))
+
+
+def synthetic_schedule(mix: str, rate: float, duration: float, seed: int):
+    """Список (время, направление, кадр), заранее сгенерированный, чтобы не мерить генератор"""
+    rng = random.Random(seed)
+    profile = MIXES[mix]
+    weights = [p[5] for p in profile]
+    count = int(rate * duration)
+    schedule = []
+    for seq in range(count):
+        direction, proto, lo, hi, port, _ = rng.choices(profile, weights)[0]
+        remote = REMOTE_IPS[seq % len(REMOTE_IPS)]
+        # 8-байтовая метка делает каждый пакет уникальным для замера задержки
+        payload = seq.to_bytes(8, 'big') + bytes(rng.randint(lo, hi) if hi else 0)
+        eph = 40000 + seq % 20000
+        if direction == 'up':
+            frame = build_frame(CLIENT_IP, remote, proto, eph, port, payload, seq=seq)
+        else:
+            frame = build_frame(remote, CLIENT_IP, proto, port, eph, payload,
+                                src_mac=SERVER_MAC, dst_mac=CLIENT_MAC, seq=seq)
+        schedule.append((seq / rate, direction, frame))
+    return schedule
+
+
+def read_pcap(path: str):
+    """Читает классический pcap (Ethernet или raw IP). Возвращает [(ts, кадр)]"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    magic = data[:4]
+    if magic in (b'\xd4\xc3\xb2\xa1', b'\x4d\x3c\xb2\xa1'):
+        endian = '<'
+    elif magic in (b'\xa1\xb2\xc3\xd4', b'\xa1\xb2\x3c\x4d'):
+        endian = '>'
+    else:
+        raise ValueError(f"{path}: not a pcap file (pcapng is not supported)")
+    ts_div = 1e9 if magic in (b'\x4d\x3c\xb2\xa1', b'\xa1\xb2\x3c\x4d') else 1e6
+    linktype = struct.unpack(endian + 'I', data[20:24])[0]
+
+    packets = []
+    idx = 24
+    while idx + 16 <= len(data):
+        sec, frac, incl_len, _ = struct.unpack(endian + 'IIII', data[idx:idx + 16])
+        idx += 16
+        raw = data[idx:idx + incl_len]
+        idx += incl_len
+        if linktype == 1:
+            frame = raw
+        elif linktype in (101, 228):
+            frame = SERVER_MAC + CLIENT_MAC + b'\x08\x00' + raw
+        else:
+            raise ValueError(f"{path}: unsupported linktype {linktype}")
+        if len(frame) >= 34 and frame[12:14] == b'\x08\x00':
+            packets.append((sec + frac / ts_div, frame))
+    return packets
+
+
+def pcap_schedule(path: str, speed: float):
+    """Пакеты от адреса-инициатора (src первого пакета) идут вверх, остальные вниз"""
+    packets = read_pcap(path)
+    if not packets:
+        return []
+    t0 = packets[0][0]
+    client_addr = packets[0][1][26:30]
+    schedule = []
+    for ts, frame in packets:
+        direction = 'up' if frame[26:30] == client_addr else 'down'
+        schedule.append(((ts - t0) / speed, direction, frame))
+    return schedule
+
+
+# === Измерения ===
+
+class LatencyRecorder:
+    """Сопоставляет кадры на входе одного TAP и на выходе другого"""
+
+    def __init__(self):
+        self.pending = {'up': defaultdict(deque), 'down': defaultdict(deque)}
+        self.latencies = {'up': [], 'down': []}
+        self.offered = {'up': [0, 0], 'down': [0, 0]}
+        self.delivered = {'up': [0, 0], 'down': [0, 0]}
+        self.first_sent = {}
+        self.last_recv = {}
+
+    def sent(self, direction: str, frame: bytes):
+        now = time.perf_counter()
+        self.pending[direction][frame[14:]].append(now)
+        self.offered[direction][0] += 1
+        self.offered[direction][1] += len(frame) - 14
+        self.first_sent.setdefault(direction, now)
+
+    def written(self, direction: str, frame: bytes):
+        now = time.perf_counter()
+        queue = self.pending[direction].get(bytes(frame[14:]))
+        if not queue: return
+        self.latencies[direction].append(now - queue.popleft())
+        self.delivered[direction][0] += 1
+        self.delivered[direction][1] += len(frame) - 14
+        self.last_recv[direction] = now
+
+    def outstanding(self, direction: str = None) -> int:
+        directions = [direction] if direction else list(self.pending)
+        return sum(len(q) for d in directions for q in self.pending[d].values())
+
+    def report(self, direction: str, in_flight: int = 0) -> dict:
+        """in_flight — сколько недоставленных пакетов ещё в пути на момент среза"""
+        lat = sorted(self.latencies[direction])
+        pkts, nbytes = self.delivered[direction]
+        window = self.last_recv.get(direction, 0) - self.first_sent.get(direction, 0)
+        offered = self.offered[direction][0]
+        lost = self.outstanding(direction) - in_flight
+        return {
+            'offered_packets': offered,
+            'delivered_packets': pkts,
+            'in_flight_packets': in_flight,
+            'lost_packets': lost,
+            # Только потерянные: не дождавшиеся конца прогона пакеты сюда не входят
+            'loss_ratio': round(lost / offered, 6) if offered else 0.0,
+            'packets_per_sec': round(pkts / window, 2) if window > 0 else 0.0,
+            'goodput_bps': round(nbytes * 8 / window, 1) if window > 0 else 0.0,
+            'latency_ms': {
+                'p50': _percentile_ms(lat, 0.50),
+                'p99': _percentile_ms(lat, 0.99),
+                'mean': round(sum(lat) / len(lat) * 1000, 3) if lat else None,
+                'max': round(lat[-1] * 1000, 3) if lat else None,
+            },
+        }
+
+
+def _pipeline_busy(transports, links) -> bool:
+    """Есть ли ещё работа в очередях, пулах воркеров или в канале"""
+    for t in transports:
+        if (t.send_queue.qsize() or t.inbox.qsize() or t.backlog or t.upload_pool.busy or t.upload_pool.queued
+                or t.download_pool.busy or t.download_pool.queued):
+            return True
+    return any(link.in_transit for link in links)
+
+
+def _percentile_ms(values, q):
+    if not values: return None
+    return round(values[min(len(values) - 1, int(q * len(values)))] * 1000, 3)
+
+
+class StageTimer:
+    """
+    CPU-время по стадиям конвейера (эксклюзивно: вложенная стадия
+    не засчитывается внешней). Обёрнутые корутины не должны реально
+    засыпать — на стенде так и есть: очереди неограничены, TAP в памяти.
+    """
+
+    def __init__(self):
+        self.cpu_ns = defaultdict(int)
+        self.calls = defaultdict(int)
+        self.stack = []
+        self.mark = 0
+
+    def _enter(self, name):
+        now = time.process_time_ns()
+        if self.stack:
+            self.cpu_ns[self.stack[-1]] += now - self.mark
+        self.stack.append(name)
+        self.calls[name] += 1
+        self.mark = now
+
+    def _exit(self):
+        now = time.process_time_ns()
+        self.cpu_ns[self.stack.pop()] += now - self.mark
+        self.mark = now
+
+    def wrap(self, obj, attr: str, name: str):
+        setattr(obj, attr, self._wrapped(getattr(obj, attr), name))
+
+    def wrap_stage(self, pipeline, stage: str, name: str):
+        """Стадия конвейера (pipeline.py) — функция внутри кортежа, а не атрибут"""
+        pipeline.replace(stage, self._wrapped(pipeline.get(stage), name))
+
+    def _wrapped(self, fn, name: str):
+        if asyncio.iscoroutinefunction(fn):
+            async def wrapper(*args, **kwargs):
+                self._enter(name)
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    self._exit()
+        else:
+            def wrapper(*args, **kwargs):
+                self._enter(name)
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    self._exit()
+        return wrapper
+
+    def report(self) -> dict:
+        return {name: {'cpu_ms': round(ns / 1e6, 3), 'calls': self.calls[name]}
+                for name, ns in sorted(self.cpu_ns.items())}
+
+
+def _instrument(timer: StageTimer, sender: PacketHandler, receiver: PacketHandler, direction: str):
+    timer.wrap(sender, '_handle_tap_packet', f'{direction}.tap_ingress')
+    timer.wrap(sender.transport, '_append_to_buffer', f'{direction}.batch')
+    timer.wrap(sender.transport, '_encode_batch', f'{direction}.encode')
+    timer.wrap(receiver.transport, '_decode_batch', f'{direction}.decode')
+    timer.wrap(receiver.transport, '_parse_batch_and_route', f'{direction}.deframe')
+    timer.wrap(receiver, '_handle_transport_packet', f'{direction}.tap_egress')
+
+
+def _instrument_stages(timer: StageTimer, sender: PacketHandler, receiver: PacketHandler, direction: str):
+    """Стадии конвейеров собираются в initialize, поэтому оборачиваются после него"""
+    for stage in sender.ingress.describe()['packet']:
+        timer.wrap_stage(sender.ingress, stage, f'{direction}.{stage}')
+    for stage in receiver.egress.describe()['packet']:
+        timer.wrap_stage(receiver.egress, stage, f'{direction}.rx_{stage}')
+
+
+# === Прогон ===
+
+async def run_benchmark(args) -> dict:
+    config.encryption_key = BENCH_KEY
+    config.compression_enabled = args.compression
+    config.wan_optimizer = args.wan
+    config.wan_settle = args.wan_settle
+    config.batch_interval = args.batch_interval
+    config.max_batch_size = args.max_batch_size
+
+    if args.pcap:
+        schedule = pcap_schedule(args.pcap, args.speed)
+    else:
+        schedule = synthetic_schedule(args.mix, args.rate, args.duration, args.seed)
+
+    if args.ideal:
+        model = LinkModel(latency=0, jitter=0, upload_bandwidth=0, upload_overhead=0, seed=args.seed)
+    else:
+        model = LinkModel(latency=args.latency, jitter=args.jitter, upload_bandwidth=args.bandwidth,
+                          upload_overhead=args.upload_overhead, loss=args.loss, reorder=args.reorder,
+                          flood_wait_probability=args.flood_wait_prob, flood_wait=args.flood_wait,
+                          seed=args.seed)
+    link = LoopbackLink(model)
+    vk_server = None
+    if args.transport == 'vk':
+        vk_server = _start_fake_vk(args)
+        client_transport, server_transport = _vk_transports(vk_server)
+    else:
+        client_transport = LoopbackTransport(link, BENCH_KEY)
+        server_transport = LoopbackTransport(link, BENCH_KEY)
+
+    client_tap = FakeTapInterface('bench-client', CLIENT_MAC)
+    server_tap = FakeTapInterface('bench-server', SERVER_MAC)
+    client = PacketHandler(transport=client_transport, tap_interface=client_tap, network=_NoNetwork())
+    server = PacketHandler(transport=server_transport, tap_interface=server_tap, network=_NoNetwork())
+
+    recorder = LatencyRecorder()
+    client_tap.on_write = lambda frame: recorder.written('down', frame)
+    server_tap.on_write = lambda frame: recorder.written('up', frame)
+
+    plane = None
+    if args.data_plane:
+        plane = DataPlane(args.data_plane)
+        plane.start()
+        BaseTransport.data_plane = plane
+
+    timer = StageTimer()
+    _instrument(timer, client, server, 'uplink')
+    _instrument(timer, server, client, 'downlink')
+
+    if not await client.initialize('client') or not await server.initialize('server'):
+        raise RuntimeError("handler initialization failed")
+    _instrument_stages(timer, client, server, 'uplink')
+    _instrument_stages(timer, server, client, 'downlink')
+    readers = [asyncio.create_task(client.start_reading_packets()),
+               asyncio.create_task(server.start_reading_packets())]
+
+    loop = asyncio.get_running_loop()
+    cpu_start = time.process_time()
+    wall_start = loop.time()
+    for offset, direction, frame in schedule:
+        delay = wall_start + offset - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        recorder.sent(direction, frame)
+        (client_tap if direction == 'up' else server_tap).inject(frame)
+
+    # Ждём, пока конвейер не опустеет (батчер держит батч до batch_interval,
+    # поэтому "пусто" должно продержаться settle секунд), но не дольше drain.
+    # У VK сообщение между загрузкой и LongPoll в очередях не видно: добавляем задержки стенда
+    transports = [client_transport, server_transport]
+    links = [link] if args.transport != 'vk' else []
+    settle = 2 * config.batch_interval + 0.25
+    if args.transport == 'vk':
+        settle += 1.0 + sum(_parse_vk_latency(args).values())
+    deadline = loop.time() + args.drain
+    idle_since = None
+    drained = False
+    while recorder.outstanding() and loop.time() < deadline:
+        if _pipeline_busy(transports, links):
+            idle_since = None
+        elif idle_since is None:
+            idle_since = loop.time()
+        elif loop.time() - idle_since >= settle:
+            drained = True  # всё, что не долетело, потеряно
+            break
+        await asyncio.sleep(0.05)
+    # Срез по drain при непустом конвейере: оставшееся ещё в пути, а не потеряно
+    in_flight = {d: 0 if drained else recorder.outstanding(d) for d in ('up', 'down')}
+    wall = loop.time() - wall_start
+    cpu = time.process_time() - cpu_start
+
+    client_tap.close()
+    server_tap.close()
+    await client.shutdown()
+    await server.shutdown()
+    await asyncio.gather(*readers, return_exceptions=True)
+    if vk_server:
+        vk_server.stop()
+    plane_stats = None
+    if plane:
+        plane_stats = plane.stats()
+        BaseTransport.data_plane = None
+        await plane.stop()
+
+    return {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+        },
+        'params': {
+            'source': args.pcap or args.mix,
+            'transport': args.transport,
+            'packets': len(schedule),
+            'compression': config.compression_enabled,
+            'wan_optimizer': config.wan_optimizer,
+            'data_plane_workers': args.data_plane,
+            'batch_interval': config.batch_interval,
+            'max_batch_size': config.max_batch_size,
+            'link': vars(model),
+        },
+        'uplink': recorder.report('up', in_flight['up']),
+        'downlink': recorder.report('down', in_flight['down']),
+        'stages': timer.report(),
+        'wan': {'client': client_transport.wan.stats(), 'server': server_transport.wan.stats()},
+        # cpu_s — только основной процесс: работа воркеров data plane сюда не входит
+        'process': {'wall_s': round(wall, 3), 'cpu_s': round(cpu, 3)},
+        'data_plane': plane_stats,
+        'link_stats': dict(vk_server.stats) if vk_server else dict(link.stats),
+        'drain_cut_off': any(in_flight.values()),
+    }
+
+
+def _start_fake_vk(args):
+    from fake_vk_server import FakeVkServer, _parse_kv
+    server = FakeVkServer(seed=args.seed)
+    # Короткий longpoll, чтобы остановка стенда не ждала 25 секунд
+    server.longpoll_max_wait = 1.0
+    for endpoint, seconds in _parse_vk_latency(args).items():
+        server.set_latency(endpoint, seconds)
+    for method, spec in _parse_kv(args.vk_error_rate, str).items():
+        code, _, prob = spec.partition(':')
+        server.set_error_rate(method, int(code), float(prob))
+    return server.start()
+
+
+def _parse_vk_latency(args) -> dict:
+    from fake_vk_server import _parse_kv
+    return _parse_kv(args.vk_latency, float)
+
+
+def _vk_transports(server):
+    from vk_transport import VKTransport
+    (client_token, client_id), (server_token, server_id) = list(server.users.items())[:2]
+    client = VKTransport(token=client_token, peer_id=server_id, api_url=server.base_url)
+    srv = VKTransport(token=server_token, peer_id=client_id, api_url=server.base_url)
+    for t in (client, srv):
+        t.captcha_callback = lambda url: server.captcha_answer
+    return client, srv
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="End-to-end tunnel benchmark (fake TAP + loopback transport)")
+    src = p.add_mutually_exclusive_group()
+    src.add_argument('--mix', choices=sorted(MIXES), default='mixed', help="synthetic traffic profile")
+    src.add_argument('--pcap', help="replay a classic pcap file instead of synthetic traffic")
+    p.add_argument('--rate', type=float, default=1000, help="synthetic packets per second (both directions)")
+    p.add_argument('--duration', type=float, default=5, help="synthetic traffic duration, s")
+    p.add_argument('--speed', type=float, default=1.0, help="pcap replay speed multiplier")
+    p.add_argument('--seed', type=int, default=1)
+    p.add_argument('--transport', choices=['loopback', 'vk'], default='loopback',
+                   help="vk = real VKTransport against an in-process fake_vk_server")
+    p.add_argument('--vk-latency', action='append', metavar='ENDPOINT=SECONDS')
+    p.add_argument('--vk-error-rate', action='append', metavar='METHOD=CODE:PROB')
+    p.add_argument('--compression', action='store_true')
+    p.add_argument('--wan', action='store_true', help="chunk deduplication (wan_optimizer.py)")
+    p.add_argument('--wan-settle', type=float, default=config.wan_settle,
+                   help="seconds before a sent chunk may be referenced")
+    p.add_argument('--data-plane', type=int, default=0, metavar='N',
+                   help="gzip/GOST in N worker processes per direction (data_plane.py)")
+    p.add_argument('--batch-interval', type=float, default=config.batch_interval or 0.05)
+    p.add_argument('--max-batch-size', type=int, default=config.max_batch_size)
+    p.add_argument('--ideal', action='store_true', help="zero-latency link: measure CPU cost only")
+    p.add_argument('--latency', type=float, default=0.3)
+    p.add_argument('--jitter', type=float, default=0.05)
+    p.add_argument('--bandwidth', type=float, default=2_000_000, help="upload bytes/s, 0 = unlimited")
+    p.add_argument('--upload-overhead', type=float, default=0.05)
+    p.add_argument('--loss', type=float, default=0.0)
+    p.add_argument('--reorder', type=float, default=0.0)
+    p.add_argument('--flood-wait-prob', type=float, default=0.0)
+    p.add_argument('--flood-wait', type=float, default=3.0)
+    p.add_argument('--drain', type=float, default=300.0,
+                   help="max seconds to wait for queues, worker pools and links to go idle")
+    p.add_argument('--output', help="write JSON here instead of stdout")
+    return p.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    # Служебные print'ы ядра (в т.ч. из фоновых потоков VK) уводим в stderr,
+    # чтобы в stdout был только JSON
+    json_out = sys.stdout
+    sys.stdout = sys.stderr
+    result = asyncio.run(run_benchmark(args))
+    text = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        json_out.write(text + "\n")
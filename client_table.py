@@ -0,0 +1,114 @@
+# --- START OF FILE client_table.py ---
+"""
+Клиенты многоклиентского сервера.
+
+IPv6-адрес клиента (ip6) необязателен: без него IPv6-пакеты клиента
+отбрасываются как чужие.
+
+Каждый клиент описывается в config.json (ключ "clients"): туннельный IP,
+свой чат / peer_id и при желании свой ключ шифрования. На сервере для
+клиента поднимается отдельный транспорт (своя очередь, батчер и
+CryptoManager), а обратный трафик с TAP раздаётся по IP назначения
+через словарь int -> сессия.
+"""
+import socket
+import struct
+from dataclasses import dataclass
+from typing import Dict, Iterator, Optional
+
+from ndp import ip6_to_int
+
+
+def ip_to_int(ip: str) -> int:
+    return struct.unpack('!I', socket.inet_aton(ip))[0]
+
+
+@dataclass
+class ClientEntry:
+    name: str
+    ip: str
+    # chat_id (Telegram), peer_id (VK) или имя LoopbackLink
+    peer: str = ''
+    # Пусто — общий config.encryption_key
+    encryption_key: str = ''
+    ip6: str = ''
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'ClientEntry':
+        return cls(**{k: v for k, v in data.items() if k in cls.__annotations__})
+
+
+class ClientSession:
+    """Клиент на сервере: его транспорт и счётчики"""
+    __slots__ = ('entry', 'ip', 'ip6', 'transport', 'rx_packets', 'rx_bytes', 'tx_packets', 'tx_bytes', 'spoofed')
+
+    def __init__(self, entry: ClientEntry, transport, ip: Optional[int] = None):
+        self.entry = entry
+        # 0 — адрес не проверяется (одноклиентский режим)
+        self.ip = ip_to_int(entry.ip) if ip is None else ip
+        self.ip6 = ip6_to_int(entry.ip6) if entry.ip6 and self.ip else 0
+        self.transport = transport
+        self.rx_packets = self.rx_bytes = 0
+        self.tx_packets = self.tx_bytes = 0
+        self.spoofed = 0
+
+    def stats(self) -> dict:
+        return {'ip': self.entry.ip, 'ip6': self.entry.ip6, 'rx_packets': self.rx_packets, 'rx_bytes': self.rx_bytes,
+                'tx_packets': self.tx_packets, 'tx_bytes': self.tx_bytes, 'spoofed': self.spoofed}
+
+
+class ClientTable:
+    """
+    Таблица маршрутизации сервера: туннельный IP (int) -> ClientSession.
+    default — сессия для адресов, которых нет в таблице (одноклиентский режим).
+    """
+
+    def __init__(self):
+        self._by_ip: Dict[int, ClientSession] = {}
+        self._by_ip6: Dict[int, ClientSession] = {}
+        self.default: Optional[ClientSession] = None
+
+    def add(self, session: ClientSession) -> ClientSession:
+        if session.ip:
+            if session.ip in self._by_ip:
+                raise ValueError(f"duplicate client IP {session.entry.ip}")
+            self._by_ip[session.ip] = session
+            if session.ip6:
+                self._by_ip6[session.ip6] = session
+        else:
+            self.default = session
+        return session
+
+    def remove(self, session: ClientSession):
+        if self._by_ip.get(session.ip) is session:
+            del self._by_ip[session.ip]
+        if self._by_ip6.get(session.ip6) is session:
+            del self._by_ip6[session.ip6]
+        if self.default is session:
+            self.default = None
+
+    def lookup(self, ip: int) -> Optional[ClientSession]:
+        return self._by_ip.get(ip)
+
+    def route(self, dst: int) -> Optional[ClientSession]:
+        return self._by_ip.get(dst, self.default)
+
+    def route6(self, dst: int) -> Optional[ClientSession]:
+        return self._by_ip6.get(dst, self.default)
+
+    def has_ip6(self, ip: int) -> bool:
+        return ip in self._by_ip6
+
+    def __contains__(self, ip: int) -> bool:
+        return ip in self._by_ip
+
+    def __len__(self):
+        return len(self._by_ip) + (self.default is not None)
+
+    def __iter__(self) -> Iterator[ClientSession]:
+        yield from self._by_ip.values()
+        if self.default is not None:
+            yield self.default
+
+    def stats(self) -> dict:
+        return {s.entry.name: s.stats() for s in self}
@@ -1,5 +1,6 @@
 
 import gzip
+import zlib
 
 
 
@@ -11,6 +12,14 @@ class Compressor:
         """Сжатие данных"""
         return gzip.compress(data)
 
+    @staticmethod
+    def compress_into(data, out) -> None:
+        """Сжатие в готовый буфер (BatchBuffer): формат тот же gzip, без промежуточного bytes целиком"""
+        # Уровень 9 — как у gzip.compress по умолчанию
+        stream = zlib.compressobj(9, zlib.DEFLATED, 31)
+        out.extend(stream.compress(data))
+        out.extend(stream.flush())
+
     @staticmethod
     def decompress(compressed_data: bytes) -> bytes:
         """Распаковка данных"""
@@ -5,6 +5,7 @@ from dataclasses import dataclass, field
 from typing import List
 
 CONFIG_FILE = 'config.json'
+# config.json читается один раз: отсюда берутся и значения по умолчанию, и load_from_file()
 raw_data = {}
 
 if os.path.exists(CONFIG_FILE):
@@ -15,10 +16,19 @@ if os.path.exists(CONFIG_FILE):
         print(f"⚠️ Ошибка чтения {CONFIG_FILE}: {e}")
 
 
+def _to_bool(value) -> bool:
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
+
+
+_COERCE = {int: int, float: float, str: str, bool: _to_bool}
+
+
 @dataclass
 class VPNConfig:
     # --- ВЫБОР ТРАНСПОРТА ---
-    # 'telegram' или 'vk'
+    # 'telegram', 'vk' или 'loopback' (оба конца в одном процессе, для замеров)
 
     transport_type: str = 'telegram'
 
@@ -29,9 +39,12 @@ class VPNConfig:
     chat_id: str = raw_data.get('chat_id', '')
 
     vk_login: str = raw_data.get('vk_login', '')
+    vk_password: str = raw_data.get('vk_password', '')
     vk_token: str = raw_data.get('vk_token', '')
     vk_peer_id: str = raw_data.get('vk_peer_id', '')
     vk_app_id: int = int(raw_data.get('vk_app_id', 0))
+    # Адрес API вместо api.vk.com (например http://127.0.0.1:8765 для fake_vk_server.py)
+    vk_api_url: str = raw_data.get('vk_api_url', '')
 
     # --- СЕТЕВЫЕ НАСТРОЙКИ ---
     tap_interface_name: str = 'Ethernet 5'
@@ -39,6 +52,12 @@ class VPNConfig:
     client_ip: str = raw_data.get('client_ip', '')
     netmask: str = raw_data.get('netmask', '')
 
+    # IPv6 в туннеле: адреса TAP (например fd7e:7e1e::1 / fd7e:7e1e::2) и длина префикса.
+    # Пусто — IPv6-кадры отбрасываются, как раньше
+    server_ip6: str = raw_data.get('server_ip6', '')
+    client_ip6: str = raw_data.get('client_ip6', '')
+    prefix6: int = int(raw_data.get('prefix6', 64))
+
     mtu: int = int(raw_data.get('mtu', 0))
     subnet: str = raw_data.get('subnet', '')
     encryption_key: str = raw_data.get('encryption_key', '')
@@ -50,6 +69,86 @@ class VPNConfig:
     batch_interval: float = float(raw_data.get('batch_interval', 0.05))
     max_batch_size: int = int(raw_data.get('max_batch_size', 524288))
 
+    # Сколько секунд адреса API из dns_cache.json считаются свежими
+    dns_cache_ttl: float = float(raw_data.get('dns_cache_ttl', 3600))
+
+    # Дополнительные правила фильтра TAP (см. packet_filter.FilterRule), например
+    # {"name": "no_ssh", "protocols": [6], "dst_ports": [22]}
+    filter_rules: List[dict] = field(default_factory=lambda: list(raw_data.get('filter_rules', [])))
+
+    # Многоклиентский сервер: у каждого клиента свой IP, чат/peer_id и ключ, например
+    # {"name": "alice", "ip": "10.8.0.3", "peer": "-1001234567890", "encryption_key": "..."}
+    # Пусто — один клиент (client_ip / chat_id / vk_peer_id)
+    clients: List[dict] = field(default_factory=lambda: list(raw_data.get('clients', [])))
+
+    # Период эхо-проб RTT через туннель, с (0 — выключено)
+    rtt_probe_interval: float = float(raw_data.get('rtt_probe_interval', 10.0))
+
+    # Подавление повторов TCP-сегментов, оригинал которых ждёт отправки или загружен меньше
+    # tcp_dedup_window секунд назад (не меньше 1.5 RTT); tcp_dedup_slots — размер таблицы
+    tcp_dedup: bool = _to_bool(raw_data.get('tcp_dedup', True))
+    tcp_dedup_window: float = float(raw_data.get('tcp_dedup_window', 3.0))
+    tcp_dedup_slots: int = int(raw_data.get('tcp_dedup_slots', 4096))
+
+    # Очередь заданий пулов загрузки/скачивания: при заполнении батчер ждёт
+    worker_queue_size: int = int(raw_data.get('worker_queue_size', 16))
+
+    # Переподключение транспорта без перезапуска TAP и маршрутов: экспоненциальная
+    # пауза между попытками и бюджет батчей, копящихся на время обрыва
+    reconnect_min_delay: float = float(raw_data.get('reconnect_min_delay', 1.0))
+    reconnect_max_delay: float = float(raw_data.get('reconnect_max_delay', 60.0))
+    reconnect_buffer_bytes: int = int(raw_data.get('reconnect_buffer_bytes', 8 * 1024 * 1024))
+    # Держать второе, уже авторизованное подключение к мессенджеру на случай обрыва
+    hot_standby: bool = _to_bool(raw_data.get('hot_standby', False))
+
+    # Ограничение MSS в SYN до (mtu или 1500) - 40 - mss_overhead; mss_overhead — байты
+    # инкапсуляции на пути за туннелем (например, 8 для PPPoE у сервера)
+    mss_clamp: bool = _to_bool(raw_data.get('mss_clamp', True))
+    mss_overhead: int = int(raw_data.get('mss_overhead', 0))
+
+    # DNS на адресе TAP клиента (dns_forwarder.py): кэш, промахи — срочным батчем через туннель.
+    # Сервер отправляет их резолверу dns_upstream ("адрес" или "адрес:порт"). Сроки в секундах
+    dns_forwarder: bool = _to_bool(raw_data.get('dns_forwarder', True))
+    dns_upstream: str = raw_data.get('dns_upstream', '8.8.8.8')
+    dns_cache_size: int = int(raw_data.get('dns_cache_size', 4096))
+    dns_negative_ttl: float = float(raw_data.get('dns_negative_ttl', 300))
+    dns_stale_ttl: float = float(raw_data.get('dns_stale_ttl', 86400))
+    dns_timeout: float = float(raw_data.get('dns_timeout', 10.0))
+
+    # WAN-оптимизация (wan_optimizer.py): повторяющиеся чанки полезной нагрузки уходят ссылками.
+    # Включается на отправляющей стороне, принимает любая. wan_cache_bytes — бюджет хранилища
+    # чанков на каждом конце, wan_settle — через сколько секунд (не меньше 2 RTT) на чанк можно ссылаться
+    wan_optimizer: bool = _to_bool(raw_data.get('wan_optimizer', False))
+    wan_cache_bytes: int = int(raw_data.get('wan_cache_bytes', 64 * 1024 * 1024))
+    wan_settle: float = float(raw_data.get('wan_settle', 5.0))
+
+    # Data plane (data_plane.py): сжатие и шифрование батчей в data_plane_workers процессах
+    # на каждое направление (0 — в основном процессе). data_plane_ring_bytes — размер каждого
+    # кольца общей памяти; батч больше половины кольца обрабатывается на месте
+    data_plane_workers: int = int(raw_data.get('data_plane_workers', 0))
+    data_plane_ring_bytes: int = int(raw_data.get('data_plane_ring_bytes', 8 * 1024 * 1024))
+
+    # Обработчик: 'vpn' — TAP и IP-пакеты, 'proxy' — SOCKS5 на клиенте и TCP-потоки (proxy_handler.py)
+    handler_type: str = raw_data.get('handler_type', 'vpn')
+    proxy_listen_host: str = raw_data.get('proxy_listen_host', '127.0.0.1')
+    proxy_port: int = int(raw_data.get('proxy_port', 1080))
+    # Окно потока: сколько байт можно отправить сверх прочитанного пиром
+    proxy_window: int = int(raw_data.get('proxy_window', 262144))
+    proxy_connect_timeout: float = float(raw_data.get('proxy_connect_timeout', 60.0))
+    proxy_idle_timeout: float = float(raw_data.get('proxy_idle_timeout', 600.0))
+
+    # Управляющий сокет (main.py --daemon): Unix-сокет, на Windows — TCP 127.0.0.1:control_port.
+    # В режиме TCP каждая команда несёт токен из control_token_file (читать его может только владелец)
+    control_socket: str = raw_data.get('control_socket', 'televpn.sock')
+    control_port: int = int(raw_data.get('control_port', 9465))
+    control_token_file: str = raw_data.get('control_token_file', 'televpn.token')
+
+    # Порт /metrics на 127.0.0.1 (формат Prometheus), 0 — выключено
+    metrics_port: int = int(raw_data.get('metrics_port', 9464))
+
+    # Файлы со списками префиксов мимо VPN (страны, сервисы): один CIDR в строке
+    bypass_prefix_files: List[str] = field(default_factory=lambda: list(raw_data.get('bypass_prefix_files', [])))
+
     # --- СПИСОК ИСКЛЮЧЕНИЙ (IP, которые идут мимо VPN) ---
     # Включает подсети Telegram и VKontakte/Mail.ru
     telegram_subnets: List[str] = field(default_factory=lambda: [
@@ -78,18 +177,48 @@ class VPNConfig:
         "79.137.183.0/24"
     ])
 
+    # IPv6-подсети мессенджеров — мимо туннеля, когда в нём есть IPv6
+    telegram_subnets6: List[str] = field(default_factory=lambda: [
+        # Telegram
+        "2001:67c:4e8::/48",
+        "2001:b28:f23c::/47",
+        "2001:b28:f23f::/48",
+        "2a0a:f280::/32",
+        # VKontakte
+        "2a00:bdc0::/32",
+    ])
+
     def get_ip_for_mode(self, mode: str) -> str:
         return self.server_ip if mode == "server" else self.client_ip
 
+    def get_ip6_for_mode(self, mode: str) -> str:
+        return self.server_ip6 if mode == "server" else self.client_ip6
+
+    @property
+    def ipv6_enabled(self) -> bool:
+        return bool(self.server_ip6 and self.client_ip6)
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        # Фильтруем ключи, чтобы брать только те, что есть в классе, и приводим типы
+        valid_keys = {}
+        for k, v in data.items():
+            if k not in cls.__annotations__: continue
+            conv = _COERCE.get(cls.__annotations__[k])
+            try:
+                valid_keys[k] = conv(v) if conv else v
+            except (TypeError, ValueError):
+                print(f"⚠️ {CONFIG_FILE}: bad value for '{k}': {v!r}")
+        return cls(**valid_keys)
+
     @classmethod
     def load_from_file(cls, filename: str = 'config.json'):
+        if filename == CONFIG_FILE:
+            return cls.from_dict(raw_data)
         if os.path.exists(filename):
             try:
-                with open(filename, 'r') as f:
-                    data = json.load(f)
-                # Фильтруем ключи, чтобы брать только те, что есть в классе
-                valid_keys = {k: v for k, v in data.items() if k in cls.__annotations__}
-                return cls(**valid_keys)
+                with open(filename, 'r', encoding='utf-8') as f:
+                    return cls.from_dict(json.load(f))
             except:
                 pass
         return cls()
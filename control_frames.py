@@ -0,0 +1,77 @@
+# --- START OF FILE control_frames.py ---
+"""
+Служебные кадры внутри батча.
+
+Обычная запись батча: [длина: 2 байта][IP-пакет]. Пакетов нулевой длины
+не бывает, поэтому длина 0 помечает служебный кадр:
+    [0x0000][тип: 1 байт][длина данных: 2 байта][данные]
+"""
+import struct
+import time
+from typing import Optional
+
+CONTROL_MARKER = b'\x00\x00'
+
+CTRL_ECHO_REQUEST = 1
+CTRL_ECHO_REPLY = 2
+# DNS через туннель (dns_forwarder.py): данные — сообщение DNS как есть
+CTRL_DNS_QUERY = 3
+CTRL_DNS_RESPONSE = 4
+# WAN-оптимизация (wan_optimizer.py): [эпоха: 4][хеши 8 байт...] неизвестных чанков / сброс хранилища
+CTRL_WAN_NACK = 5
+CTRL_WAN_RESET = 6
+
+_ECHO = struct.Struct('!IQ')        # id пробы, время отправки (monotonic_ns отправителя)
+_ECHO_REPLY = struct.Struct('!IQQ')  # + сколько ответ пролежал у пира, нс
+
+
+def append_control(buffer: bytearray, ctype: int, payload: bytes):
+    buffer.extend(CONTROL_MARKER)
+    buffer.append(ctype)
+    buffer.extend(len(payload).to_bytes(2, 'big'))
+    buffer.extend(payload)
+
+
+def echo_request(probe_id: int) -> bytes:
+    return _ECHO.pack(probe_id & 0xFFFFFFFF, time.monotonic_ns())
+
+
+def echo_reply(request: bytes, received_ns: int) -> bytes:
+    """Ответ на пробу: отправитель вычтет время, которое ответ ждал батча у нас"""
+    probe_id, sent_ns = _ECHO.unpack_from(request)
+    return _ECHO_REPLY.pack(probe_id, sent_ns, time.monotonic_ns() - received_ns)
+
+
+def rtt_from_reply(reply: bytes) -> float:
+    """RTT в секундах по ответу на нашу пробу"""
+    _, sent_ns, hold_ns = _ECHO_REPLY.unpack_from(reply)
+    return max(0, time.monotonic_ns() - sent_ns - hold_ns) / 1e9
+
+
+class RttEstimator:
+    """Сглаженный RTT и его разброс по RFC 6298 (srtt / rttvar)"""
+
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+
+    def __init__(self):
+        self.srtt: Optional[float] = None
+        self.rttvar = 0.0
+        self.min_rtt: Optional[float] = None
+        self.last: Optional[float] = None
+        self.samples = 0
+
+    def update(self, sample: float):
+        if self.srtt is None:
+            self.srtt = sample
+            self.rttvar = sample / 2
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - sample)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * sample
+        self.min_rtt = sample if self.min_rtt is None else min(self.min_rtt, sample)
+        self.last = sample
+        self.samples += 1
+
+    @property
+    def jitter(self) -> float:
+        return self.rttvar
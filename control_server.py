@@ -0,0 +1,270 @@
+# --- START OF FILE control_server.py ---
+"""
+Управляющий сокет работающего туннеля.
+
+Unix-сокет (config.control_socket), на Windows — TCP 127.0.0.1:control_port.
+Протокол: одна JSON-команда в строке, в ответ одна JSON-строка
+{"ok": true, "result": ...} или {"ok": false, "error": "..."}.
+
+Доступ к Unix-сокету ограничен правами файла (0600). К TCP-порту может
+подключиться любой локальный пользователь, поэтому там каждая команда
+несёт поле "token": случайный токен пишется при старте в
+config.control_token_file, доступный только владельцу (chmod 0600, на
+Windows — icacls без наследуемых прав), и удаляется при остановке.
+Команда без верного токена получает ошибку, соединение закрывается.
+
+Команды:
+    {"cmd": "ping"}
+    {"cmd": "stats"}                      снимок метрик
+    {"cmd": "queues"}                     очереди и пулы воркеров транспортов, RTT
+    {"cmd": "clients"}                    сессии многоклиентского сервера
+    {"cmd": "filter"}                     срабатывания правил фильтра
+    {"cmd": "mss"}                        ограничение MSS: значение, SYN, переписанные
+    {"cmd": "wan"}                        хранилища чанков WAN-оптимизации по транспортам
+    {"cmd": "pipeline"}                   стадии конвейеров ingress / egress
+    {"cmd": "dataplane"}                  процессы сжатия и шифрования (data_plane.py)
+    {"cmd": "profile"}                    отчёт по стадиям (main.py --profile)
+    {"cmd": "profile", "capture": 10, "sampler": false, "path": "cap.pstats"}
+                                          снимок cProfile / сэмплера на 10 с
+    {"cmd": "get"}                        текущие настраиваемые параметры
+    {"cmd": "set", "params": {"batch_interval": 0.02, "compression_enabled": true}}
+
+Клиент из командной строки:
+    python control_server.py stats
+    python control_server.py set batch_interval=0.02 max_queue_size=2000
+    python control_server.py profile capture=10 sampler=1
+"""
+import asyncio
+import hmac
+import json
+import os
+import secrets
+import subprocess
+import sys
+from typing import Optional
+
+from config import config, _to_bool
+from metrics import metrics
+
+# Параметры, которые можно менять на ходу: имя -> (приведение типа, минимум, максимум)
+TUNABLES = {
+    'batch_interval': (float, 0.0, 5.0),
+    'max_batch_size': (int, 1024, 16 * 1024 * 1024),
+    'compression_enabled': (_to_bool, None, None),
+    'wan_optimizer': (_to_bool, None, None),
+    'max_queue_size': (int, 10, 1_000_000),
+    'rtt_probe_interval': (float, 0.0, 3600.0),
+}
+
+
+class ControlServer:
+    def __init__(self, app, path: Optional[str] = None, port: Optional[int] = None):
+        self.app = app
+        self.path = path if path is not None else config.control_socket
+        self.port = port if port is not None else config.control_port
+        self.token_file = config.control_token_file
+        self.token = None  # только для TCP
+        self.server = None
+        self.writers = set()
+
+    @property
+    def use_unix(self) -> bool:
+        return bool(self.path) and hasattr(asyncio, 'start_unix_server') and sys.platform != 'win32'
+
+    async def start(self):
+        if self.use_unix:
+            if os.path.exists(self.path):
+                os.unlink(self.path)  # сокет от прошлого запуска
+            self.server = await asyncio.start_unix_server(self._handle, self.path)
+            os.chmod(self.path, 0o600)
+            print(f"🎛️ Control socket: {self.path}")
+        else:
+            self.token = secrets.token_hex(32)
+            _write_private(self.token_file, self.token)
+            self.server = await asyncio.start_server(self._handle, '127.0.0.1', self.port)
+            print(f"🎛️ Control socket: 127.0.0.1:{self.port} (token: {self.token_file})")
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            # Открытые соединения закрываем сами, иначе wait_closed ждёт клиентов
+            for writer in list(self.writers):
+                writer.close()
+            await self.server.wait_closed()
+            await asyncio.sleep(0)  # даём обработчикам увидеть закрытие
+            self.server = None
+            if self.use_unix and os.path.exists(self.path):
+                os.unlink(self.path)
+            if self.token and os.path.exists(self.token_file):
+                os.unlink(self.token_file)
+                self.token = None
+
+    async def _handle(self, reader, writer):
+        self.writers.add(writer)
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    # Строка длиннее лимита StreamReader (64 КиБ): ответ и закрытие
+                    writer.write(json.dumps({'ok': False, 'error': 'request too long'}).encode() + b"\n")
+                    break
+                if not line: break
+                try:
+                    request = json.loads(line)
+                    if not self._authorized(request):
+                        writer.write(json.dumps({'ok': False, 'error': 'unauthorized'}).encode() + b"\n")
+                        break
+                    result = self.execute(request.get('cmd'), request)
+                    response = {'ok': True, 'result': result}
+                except Exception as e:
+                    response = {'ok': False, 'error': str(e)}
+                writer.write(json.dumps(response, default=str).encode() + b"\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+    def _authorized(self, request) -> bool:
+        if self.token is None:
+            return True  # Unix-сокет: доступ ограничен правами файла
+        token = request.get('token') if isinstance(request, dict) else None
+        return isinstance(token, str) and hmac.compare_digest(token, self.token)
+
+    # --- Команды ---
+
+    def _transports(self):
+        handler = self.app.handler
+        clients = getattr(handler, 'clients', None)
+        if clients:
+            return {s.entry.name: s.transport for s in clients}
+        transport = getattr(handler, 'transport', None)
+        return {'default': transport} if transport else {}
+
+    def execute(self, cmd: str, request: dict):
+        if cmd == 'ping':
+            return 'pong'
+        if cmd == 'stats':
+            return metrics.snapshot()
+        if cmd == 'queues':
+            return {name: {'send_queue': t.send_queue.qsize(), 'max_queue_size': t.max_queue_size,
+                           'pending_control': len(t.pending_control), 'srtt': t.rtt.srtt,
+                           'rtt_jitter': t.rtt.jitter, 'connected': t.is_connected,
+                           'link_up': t.link_up, 'backlog_bytes': t.backlog_bytes,
+                           'reconnects': t.reconnects, 'upload_pool': t.upload_pool.stats(),
+                           'download_pool': t.download_pool.stats(),
+                           'tcp_dedup': t.dedup.stats() if t.dedup else None}
+                    for name, t in self._transports().items()}
+        if cmd == 'clients':
+            clients = getattr(self.app.handler, 'clients', None)
+            return clients.stats() if clients else {}
+        if cmd == 'filter':
+            packet_filter = getattr(self.app.handler, 'packet_filter', None)
+            return packet_filter.stats() if packet_filter else {}
+        if cmd == 'mss':
+            mss_clamp = getattr(self.app.handler, 'mss_clamp', None)
+            return mss_clamp.stats() if mss_clamp else {}
+        if cmd == 'pipeline':
+            handler = self.app.handler
+            return {p.name: p.describe() for p in (getattr(handler, 'ingress', None),
+                                                   getattr(handler, 'egress', None)) if p is not None}
+        if cmd == 'profile':
+            profiler = getattr(self.app, 'profiler', None)
+            if profiler is None:
+                raise ValueError("profiling is off: start with --profile")
+            if request.get('capture'):
+                started = profiler.start_capture(float(request['capture']),
+                                                 _to_bool(request.get('sampler', False)), request.get('path'))
+                return {'capturing': started, 'last_capture': profiler.last_capture}
+            return profiler.report()
+        if cmd == 'wan':
+            return {name: t.wan.stats() for name, t in self._transports().items()}
+        if cmd == 'dataplane':
+            plane = getattr(self.app, 'data_plane', None)
+            if plane is None:
+                raise ValueError("data plane is off: set data_plane_workers")
+            return plane.stats()
+        if cmd == 'get':
+            return self._tunables()
+        if cmd == 'set':
+            return self._set(request.get('params') or {})
+        raise ValueError(f"unknown command: {cmd}")
+
+    def _tunables(self) -> dict:
+        values = {name: getattr(config, name) for name in TUNABLES if hasattr(config, name)}
+        transports = list(self._transports().values())
+        if transports:
+            values['max_queue_size'] = transports[0].max_queue_size
+        return values
+
+    def _set(self, params: dict) -> dict:
+        # Сначала проверяем всё, потом применяем: команда либо проходит целиком, либо нет
+        parsed = {}
+        for name, value in params.items():
+            if name not in TUNABLES:
+                raise ValueError(f"not tunable: {name}")
+            conv, lo, hi = TUNABLES[name]
+            v = conv(value)
+            if lo is not None and not lo <= v <= hi:
+                raise ValueError(f"{name} must be in [{lo}, {hi}]")
+            parsed[name] = v
+
+        for name, v in parsed.items():
+            if name == 'max_queue_size':
+                for t in self._transports().values():
+                    t.max_queue_size = v
+            else:
+                # Батчер читает config на каждом батче, флаги сжатия и WAN идут в заголовке батча
+                setattr(config, name, v)
+            print(f"🎛️ {name} = {v}")
+        return self._tunables()
+
+
+def _write_private(path: str, text: str):
+    """Файл, который может читать только текущий пользователь"""
+    if os.path.exists(path):
+        os.unlink(path)  # старый файл мог быть создан с другими правами
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(text)
+    if sys.platform == 'win32':
+        # На Windows режим 0600 не действует: убираем наследуемые права и оставляем владельца
+        user = os.environ.get('USERNAME') or os.getlogin()
+        subprocess.run(['icacls', path, '/inheritance:r', '/grant:r', f'{user}:F'],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+
+
+def _client(argv):
+    if not argv:
+        print(__doc__)
+        return 1
+    cmd, rest = argv[0], argv[1:]
+    request = {'cmd': cmd}
+    if cmd == 'set':
+        request['params'] = dict(arg.split('=', 1) for arg in rest)
+    elif cmd == 'profile':
+        # python control_server.py profile capture=10 sampler=1 path=cap.pstats
+        request.update(arg.split('=', 1) for arg in rest)
+
+    async def send():
+        if sys.platform != 'win32' and config.control_socket:
+            reader, writer = await asyncio.open_unix_connection(config.control_socket)
+        else:
+            with open(config.control_token_file, encoding='utf-8') as f:
+                request['token'] = f.read().strip()
+            reader, writer = await asyncio.open_connection('127.0.0.1', config.control_port)
+        writer.write(json.dumps(request).encode() + b"\n")
+        await writer.drain()
+        response = json.loads(await reader.readline())
+        writer.close()
+        return response
+
+    response = asyncio.run(send())
+    print(json.dumps(response.get('result') if response.get('ok') else response, indent=2, default=str))
+    return 0 if response.get('ok') else 1
+
+
+if __name__ == "__main__":
+    sys.exit(_client(sys.argv[1:]))
@@ -1,15 +1,16 @@
 # --- START OF FILE crypto_utils.py ---
 
 import base64
+import time
 from typing import Optional
 
-# Импорт паддинга из pycryptodome (универсальный PKCS7)
-from Crypto.Util.Padding import pad, unpad
 from Crypto.Random import get_random_bytes
 
+from metrics import metrics
+
 # Попытка импорта GOST. Если нет - кидаем понятную ошибку.
 try:
-    from gostcrypto import gostcipher
+    from gostcrypto.gostcipher.gost_34_12_2015 import GOST34122015Kuznechik
 except ImportError:
     raise ImportError(
         "Библиотека 'gostcrypto' не найдена. "
@@ -21,6 +22,11 @@ class CryptoManager:
     """
     Менеджер шифрования, использующий ГОСТ Р 34.12-2015 (Кузнечик).
     Режим работы: CBC (Cipher Block Chaining).
+
+    Цепочка CBC (ГОСТ Р 34.13-2015 с IV в один блок) собрана здесь поверх
+    блочного шифра gostcrypto: ключевое расписание строится один раз, а
+    шифрование идёт на месте в буфере вызывающего (encrypt_into). Формат
+    совместим с gostcipher MODE_CBC: IV + CBC(PKCS7(data)).
     """
 
     def __init__(self, key: str):
@@ -33,39 +39,68 @@ class CryptoManager:
         # Размер блока у Кузнечика — 128 бит (16 байт), как у AES.
         # У Магмы (Magma) — 64 бита (8 байт).
         self.block_size = 16
+        self.cipher = GOST34122015Kuznechik(bytearray(self.key))
+
+    def encrypt_into(self, buf: bytearray, start: int, end: int) -> memoryview:
+        """
+        Шифрует buf[start:end] на месте. Нужны 16 байт перед start (туда
+        пишется IV) и до 16 байт после end (паддинг PKCS7).
+        Возвращает memoryview на IV + шифротекст внутри buf.
+        """
+        started = time.perf_counter()
+        bs = self.block_size
+        pad_len = bs - (end - start) % bs
+        buf[end:end + pad_len] = bytes((pad_len,)) * pad_len
+        end += pad_len
 
-    def encrypt(self, data: bytes) -> bytes:
-        """Шифрование данных (ГОСТ Кузнечик + IV + Padding)"""
         # Генерируем случайный вектор инициализации (IV) равный размеру блока
-        iv = get_random_bytes(self.block_size)
-
-        # Инициализация шифра: Алгоритм 'kuznechik', режим CBC
-        cipher = gostcipher.new('kuznechik', self.key, gostcipher.MODE_CBC, init_vect=iv)
+        iv = get_random_bytes(bs)
+        buf[start - bs:start] = iv
 
-        # Добавляем стандартный PKCS7 паддинг
-        padded_data = pad(data, self.block_size)
+        encrypt = self.cipher.encrypt
+        prev = int.from_bytes(iv, 'big')
+        for off in range(start, end, bs):
+            block = encrypt((int.from_bytes(buf[off:off + bs], 'big') ^ prev).to_bytes(bs, 'big'))
+            buf[off:off + bs] = block
+            prev = int.from_bytes(block, 'big')
 
-        # Шифруем
-        encrypted_data = cipher.encrypt(padded_data)
+        metrics.encrypt_seconds.time(started)
+        return memoryview(buf)[start - bs:end]
 
+    def encrypt(self, data: bytes) -> bytes:
+        """Шифрование данных (ГОСТ Кузнечик + IV + Padding)"""
+        bs = self.block_size
+        buf = bytearray(bs + len(data) + bs)
+        buf[bs:bs + len(data)] = data
         # Возвращаем IV + Шифротекст (IV нужен для расшифровки)
-        return iv + encrypted_data
+        return self.encrypt_into(buf, bs, bs + len(data)).tobytes()
 
     def decrypt(self, encrypted_data: bytes) -> bytes:
         """Дешифрование данных"""
+        start = time.perf_counter()
         try:
-            # Извлекаем IV из начала пакета
-            iv = encrypted_data[:self.block_size]
-            actual_data = encrypted_data[self.block_size:]
-
-            # Инициализируем шифр с тем же ключом и извлеченным IV
-            cipher = gostcipher.new('kuznechik', self.key, gostcipher.MODE_CBC, init_vect=iv)
-
-            # Расшифровываем
-            decrypted_padded = cipher.decrypt(actual_data)
-
-            # Удаляем паддинг
-            return unpad(decrypted_padded, self.block_size)
+            bs = self.block_size
+            size = len(encrypted_data) - bs
+            if size <= 0 or size % bs:
+                raise ValueError("Data must be IV + whole blocks")
+
+            # IV — первый блок, дальше шифротекст
+            view = memoryview(encrypted_data)
+            out = bytearray(size)
+            decrypt = self.cipher.decrypt
+            prev = int.from_bytes(view[:bs], 'big')
+            for off in range(bs, size + bs, bs):
+                block = view[off:off + bs]
+                out[off - bs:off] = (int.from_bytes(decrypt(block), 'big') ^ prev).to_bytes(bs, 'big')
+                prev = int.from_bytes(block, 'big')
+
+            # Удаляем паддинг PKCS7
+            pad_len = out[-1]
+            if not 1 <= pad_len <= bs or out[-pad_len:] != bytes((pad_len,)) * pad_len:
+                raise ValueError("Padding is incorrect.")
+            del out[-pad_len:]
+            metrics.decrypt_seconds.time(start)
+            return bytes(out)
         except ValueError as e:
             # Ошибка паддинга обычно означает неверный ключ
             print(f"Decryption error (Padding): {e}")
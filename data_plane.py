@@ -0,0 +1,356 @@
+# --- START OF FILE data_plane.py ---
+"""
+Многопроцессный data plane: сжатие и шифрование батчей вне цикла событий.
+
+Всё тяжёлое на пути батча — gzip и ГОСТ на чистом Python — держит GIL и
+занимает одно ядро вместе с TAP, Telethon / longpoll и GUI. При
+config.data_plane_workers > 0 запускаются процессы-воркеры:
+data_plane_workers на uplink (сжать + зашифровать) и столько же на
+downlink (расшифровать + распаковать). Сессии мессенджера, TAP,
+пакетирование и WAN-оптимизация (её хранилища — состояние транспорта)
+остаются в основном процессе: через границу процессов ходят только
+батчи, поэтому накладные расходы — единицы системных вызовов на батч.
+
+У каждого воркера два кольца shm_ring.ShmRing (задания и результаты) и
+два Pipe-"звонка": данные идут через общую память, Pipe только будит
+читателя. Результаты в основном процессе ждёт один поток, который
+передаёт их циклу событий через call_soon_threadsafe.
+
+Супервизор раз в секунду проверяет процессы: упавший воркер
+перезапускается (не чаще MAX_RESTARTS раз за RESTART_WINDOW секунд),
+его незавершённые задания возвращают None, и транспорт делает эту работу
+сам — как и при переполненном кольце или слишком большом батче.
+
+Процессы создаются через spawn на всех ОС: fork процесса с живым циклом
+событий и потоками небезопасен, а на Windows другого и нет.
+"""
+import asyncio
+import itertools
+import multiprocessing
+import signal
+import struct
+import threading
+import time
+from collections import deque
+from multiprocessing.connection import wait
+from typing import Optional
+
+from batch_buffer import BatchBuffer, HEADROOM
+from config import config
+from metrics import metrics
+from shm_ring import ShmRing
+
+OP_KEY = 1   # данные — ключ; слот из заголовка
+OP_SEAL = 2  # [флаги батча] + payload -> (gzip) + ГОСТ
+OP_OPEN = 3  # шифротекст -> [флаги] + расшифрованный (и распакованный) батч
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+_JOB = struct.Struct('!IBBH')    # id задания, операция, флаги батча, слот ключа
+_RESULT = struct.Struct('!IBd')  # id задания, статус, секунды шифра
+
+BATCH_FLAG_GZIP = 0x01  # то же, что base_transport.BATCH_FLAG_GZIP (без импорта транспорта в воркер)
+MAX_RESTARTS = 5
+RESTART_WINDOW = 60.0
+
+
+# --- Процесс-воркер ---
+
+def _seal(cipher, flags: int, payload):
+    from compressor import Compressor
+    batch = BatchBuffer(len(payload))
+    if flags & BATCH_FLAG_GZIP:
+        Compressor.compress_into(payload, batch)
+    else:
+        batch.extend(payload)
+    batch.buf[HEADROOM - 1] = flags
+    started = time.perf_counter()
+    sealed = cipher.encrypt_into(batch.buf, HEADROOM - 1, batch.end)
+    return (sealed,), time.perf_counter() - started
+
+
+def _open(cipher, data):
+    from compressor import Compressor
+    started = time.perf_counter()
+    plain = cipher.decrypt(data)
+    elapsed = time.perf_counter() - started
+    flags = plain[0]
+    body = Compressor.decompress(plain[1:]) if flags & BATCH_FLAG_GZIP else plain[1:]
+    return (bytes((flags,)), body), elapsed
+
+
+def _worker_main(jobs_args: tuple, results_args: tuple, jobs_bell, results_bell):
+    """Цикл воркера: будится звонком, разбирает кольцо заданий, пишет результаты"""
+    from crypto_utils import CryptoManager
+    # Ctrl+C получает вся группа процессов; останавливает воркеры основной процесс
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    jobs, results = ShmRing(*jobs_args), ShmRing(*results_args)
+    parent = multiprocessing.parent_process()
+    ciphers = {}
+    try:
+        while True:
+            if not jobs_bell.poll(1.0):
+                if parent is not None and not parent.is_alive():
+                    break
+                continue
+            while jobs_bell.poll():
+                jobs_bell.recv_bytes()
+            while True:
+                record = jobs.pop()
+                if record is None:
+                    break
+                job_id, op, flags, slot = _JOB.unpack_from(record)
+                payload = memoryview(record)[_JOB.size:]
+                if op == OP_KEY:
+                    ciphers[slot] = CryptoManager(bytes(payload).decode('utf-8'))
+                    continue
+                try:
+                    if op == OP_SEAL:
+                        parts, elapsed = _seal(ciphers[slot], flags, payload)
+                    else:
+                        parts, elapsed = _open(ciphers[slot], bytes(payload))
+                    header = _RESULT.pack(job_id, STATUS_OK, elapsed)
+                except Exception as e:
+                    parts, header = (str(e).encode('utf-8', 'replace'),), _RESULT.pack(job_id, STATUS_ERROR, 0.0)
+                while not results.push(header, *parts):
+                    time.sleep(0.001)  # основной процесс не успевает забирать
+                results_bell.send_bytes(b'r')
+    except (EOFError, BrokenPipeError, OSError):
+        pass  # основной процесс закрыл звонок — выходим
+    finally:
+        jobs.close()
+        results.close()
+
+
+# --- Основной процесс ---
+
+class _Worker:
+    def __init__(self, ctx, direction: str, index: int, ring_bytes: int):
+        self.direction = direction
+        self.index = index
+        self.name = f"{direction}-{index}"
+        self.jobs = ShmRing(ring_bytes)
+        self.results = ShmRing(ring_bytes)
+        jobs_reader, self.jobs_bell = ctx.Pipe(duplex=False)
+        self.results_bell, results_writer = ctx.Pipe(duplex=False)
+        self.process = ctx.Process(target=_worker_main, name=f"televpn-{self.name}", daemon=True,
+                                   args=(self.jobs.attach_args(), self.results.attach_args(),
+                                         jobs_reader, results_writer))
+        self.process.start()
+        # Концы воркера живут в его процессе
+        jobs_reader.close()
+        results_writer.close()
+        self.pending = {}  # id задания -> Future
+        self.closing = False
+        self.keys = set()  # слоты ключей, уже переданные воркеру
+        self.restarts = deque()
+
+    @property
+    def alive(self) -> bool:
+        return self.process.is_alive()
+
+    def fail_pending(self):
+        """Только в цикле событий: Future не потокобезопасны, а _drain трогает pending там же"""
+        self.closing = True
+        for fut in self.pending.values():
+            if not fut.done():
+                fut.set_result(None)
+        self.pending.clear()
+
+    def close(self, timeout: float = 2.0):
+        """Блокирующее закрытие (из потока); задания до этого сбрасывает fail_pending"""
+        try:
+            self.jobs_bell.close()  # воркер получит EOF и выйдет сам
+        except OSError:
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join(timeout)
+        self.results_bell.close()
+        self.jobs.close()
+        self.results.close()
+
+
+class DataPlane:
+    def __init__(self, workers: int = None, ring_bytes: int = None):
+        self.count = workers if workers is not None else config.data_plane_workers
+        self.ring_bytes = ring_bytes if ring_bytes is not None else config.data_plane_ring_bytes
+        self.ctx = multiprocessing.get_context('spawn')
+        self.workers = []
+        self.slots = {}  # ключ -> слот
+        self.job_ids = itertools.count(1)
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.supervisor_task: Optional[asyncio.Task] = None
+        self.reader_thread: Optional[threading.Thread] = None
+        self.running = False
+
+        self.jobs_done = 0
+        self.fallbacks = 0
+        self.restarts = 0
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        for direction in ('uplink', 'downlink'):
+            for i in range(self.count):
+                self.workers.append(_Worker(self.ctx, direction, i, self.ring_bytes))
+        self.running = True
+        self.reader_thread = threading.Thread(target=self._read_bells, name='data-plane-results', daemon=True)
+        self.reader_thread.start()
+        self.supervisor_task = asyncio.create_task(self._supervise())
+        metrics.gauge('televpn_data_plane_pending', 'Batches queued in data plane worker processes',
+                      fn=lambda: sum(len(w.pending) for w in self.workers if w is not None))
+        print(f"🧵 Data plane: {self.count} uplink + {self.count} downlink worker processes")
+
+    async def stop(self):
+        self.running = False
+        if self.supervisor_task:
+            self.supervisor_task.cancel()
+        workers, self.workers = self.workers, []
+        for w in workers:
+            if w is not None:
+                w.fail_pending()
+                await asyncio.to_thread(w.close)
+        if self.reader_thread:
+            self.reader_thread.join(2.0)
+
+    # --- Результаты ---
+
+    def _read_bells(self):
+        """Поток: ждёт звонков воркеров и передаёт разбор колец циклу событий"""
+        while self.running:
+            workers = {w.results_bell: w for w in list(self.workers) if w is not None}
+            if not workers:
+                time.sleep(0.1)
+                continue
+            try:
+                ready = wait(list(workers), timeout=0.5)
+            except (OSError, ValueError):
+                continue  # звонок закрыли при перезапуске воркера
+            for bell in ready:
+                worker = workers[bell]
+                try:
+                    while bell.poll():
+                        bell.recv_bytes()
+                except (EOFError, OSError):
+                    time.sleep(0.05)  # воркер умер — им займётся супервизор
+                try:
+                    self.loop.call_soon_threadsafe(self._drain, worker)
+                except RuntimeError:
+                    return  # цикл событий закрыт
+
+    def _drain(self, worker: _Worker):
+        if worker.closing or worker.results.buf is None: return
+        while True:
+            record = worker.results.pop()
+            if record is None:
+                break
+            job_id, status, elapsed = _RESULT.unpack_from(record)
+            fut = worker.pending.pop(job_id, None)
+            if fut is not None and not fut.done():
+                fut.set_result((status, elapsed, memoryview(record)[_RESULT.size:]))
+
+    # --- Супервизор ---
+
+    async def _supervise(self):
+        while True:
+            await asyncio.sleep(1.0)
+            for i, w in enumerate(self.workers):
+                if w is None or w.alive:
+                    continue
+                print(f"⚠️ Data plane worker {w.name} exited (code {w.process.exitcode})")
+                w.fail_pending()
+                await asyncio.to_thread(w.close)
+                now = time.monotonic()
+                history = w.restarts
+                while history and now - history[0] > RESTART_WINDOW:
+                    history.popleft()
+                if len(history) >= MAX_RESTARTS:
+                    # Падает раз за разом: эту часть работы делает основной процесс
+                    print(f"❌ Data plane worker {w.name}: too many restarts, running inline")
+                    self.workers[i] = None
+                    continue
+                replacement = _Worker(self.ctx, w.direction, w.index, self.ring_bytes)
+                replacement.restarts = history
+                history.append(now)
+                self.workers[i] = replacement
+                self.restarts += 1
+                metrics.data_plane_restarts.inc()
+
+    # --- Задания ---
+
+    def _pick(self, direction: str) -> Optional[_Worker]:
+        """Наименее загруженный живой воркер направления"""
+        best = None
+        for w in self.workers:
+            if w is not None and w.direction == direction and w.alive:
+                if best is None or len(w.pending) < len(best.pending):
+                    best = w
+        return best
+
+    async def _push(self, worker: _Worker, *parts) -> bool:
+        while not worker.jobs.push(*parts):
+            if not worker.alive:
+                return False
+            await asyncio.sleep(0.001)  # кольцо заданий заполнено: ждём воркера
+        return True
+
+    async def _submit(self, direction: str, op: int, flags: int, key: bytes, payload):
+        worker = self._pick(direction)
+        if worker is None or not worker.jobs.fits(_JOB.size + len(payload)):
+            self.fallbacks += 1
+            metrics.data_plane_fallbacks.inc()
+            return None
+        slot = self.slots.setdefault(key, len(self.slots))
+        if slot not in worker.keys:
+            if not await self._push(worker, _JOB.pack(0, OP_KEY, 0, slot), key):
+                return None
+            worker.keys.add(slot)
+        job_id = next(self.job_ids) & 0xFFFFFFFF
+        fut = self.loop.create_future()
+        worker.pending[job_id] = fut
+        if not await self._push(worker, _JOB.pack(job_id, op, flags, slot), payload) or worker.closing:
+            # Пока ждали место в кольце, воркер закрыли: его задания уже сброшены
+            worker.pending.pop(job_id, None)
+            return None
+        try:
+            worker.jobs_bell.send_bytes(b'j')
+        except OSError:
+            worker.pending.pop(job_id, None)
+            return None
+        result = await fut
+        if result is None:
+            self.fallbacks += 1
+            metrics.data_plane_fallbacks.inc()
+            return None
+        status, elapsed, body = result
+        if status != STATUS_OK:
+            raise ValueError(f"data plane {worker.name}: {bytes(body).decode('utf-8', 'replace')}")
+        self.jobs_done += 1
+        metrics.data_plane_jobs.inc()
+        return elapsed, body
+
+    async def seal(self, key: bytes, payload, flags: int) -> Optional[memoryview]:
+        """(gzip по флагу) + ГОСТ в воркере uplink. None — сделайте это сами"""
+        result = await self._submit('uplink', OP_SEAL, flags, key, payload)
+        if result is None:
+            return None
+        elapsed, sealed = result
+        metrics.encrypt_seconds.observe(elapsed)
+        return sealed
+
+    async def open(self, key: bytes, encrypted) -> Optional[memoryview]:
+        """ГОСТ + gunzip в воркере downlink: [флаги] + батч. None — сделайте это сами"""
+        result = await self._submit('downlink', OP_OPEN, 0, key, encrypted)
+        if result is None:
+            return None
+        elapsed, plain = result
+        metrics.decrypt_seconds.observe(elapsed)
+        return plain
+
+    def stats(self) -> dict:
+        return {'workers': {w.name: {'pid': w.process.pid, 'alive': w.alive, 'pending': len(w.pending),
+                                     'jobs_ring_bytes': len(w.jobs), 'results_ring_bytes': len(w.results)}
+                            for w in self.workers if w is not None},
+                'jobs': self.jobs_done, 'fallbacks': self.fallbacks, 'restarts': self.restarts}
@@ -0,0 +1,121 @@
+# --- START OF FILE dns_cache.py ---
+"""
+Кэш DNS для исключений маршрутов (адреса API мессенджеров).
+
+Все домены резолвятся параллельно через loop.getaddrinfo (в пуле потоков,
+цикл событий не блокируется). Результат хранится в JSON с временем жизни:
+при следующем запуске и при очистке адреса берутся из кэша сразу, а
+устаревшие записи обновляются в фоне. Колбэк on_change вызывается только
+если набор адресов действительно изменился.
+"""
+import asyncio
+import json
+import os
+import socket
+import time
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional
+
+DNS_CACHE_FILE = 'dns_cache.json'
+
+
+class DnsCache:
+    """
+    Записи: домен -> {"ips": [...], "expires": unix-время}. getaddrinfo не
+    отдаёт TTL записи, поэтому срок жизни общий (ttl).
+    """
+
+    def __init__(self, path: str = DNS_CACHE_FILE, ttl: float = 3600, timeout: float = 3.0):
+        self.path = path
+        self.ttl = ttl
+        self.timeout = timeout
+        self.entries: Dict[str, dict] = {}
+        self.refresh_task: Optional[asyncio.Task] = None
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"⚠️ DNS cache {self.path} ignored: {e}")
+
+    def _save(self):
+        tmp = self.path + '.tmp'
+        try:
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(self.entries, f, indent=2, sort_keys=True)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print(f"⚠️ DNS cache not saved: {e}")
+
+    def cached(self, domains: Iterable[str]) -> List[str]:
+        """Адреса из кэша, в том числе устаревшие. Сеть не трогает"""
+        ips = set()
+        for d in domains:
+            entry = self.entries.get(d)
+            if entry: ips.update(entry['ips'])
+        return sorted(ips)
+
+    def stale(self, domains: Iterable[str]) -> List[str]:
+        now = time.time()
+        return [d for d in domains if d not in self.entries or self.entries[d]['expires'] <= now]
+
+    async def _resolve_one(self, loop, domain: str) -> Optional[List[str]]:
+        try:
+            infos = await asyncio.wait_for(
+                loop.getaddrinfo(domain, 443, family=socket.AF_INET, proto=socket.IPPROTO_TCP),
+                timeout=self.timeout)
+        except Exception:
+            return None
+        return sorted({info[4][0] for info in infos})
+
+    async def resolve(self, domains: Iterable[str]) -> bool:
+        """Параллельно резолвит домены и обновляет кэш. True — адреса изменились"""
+        domains = list(domains)
+        if not domains: return False
+        before = self.cached(domains)
+        loop = asyncio.get_running_loop()
+        results = await asyncio.gather(*(self._resolve_one(loop, d) for d in domains))
+        expires = time.time() + self.ttl
+        for domain, ips in zip(domains, results):
+            if ips:
+                self.entries[domain] = {'ips': ips, 'expires': expires}
+                print(f"🌍 Resolved {domain} -> {', '.join(ips)}")
+            # При ошибке старая запись остаётся: лучше устаревший адрес, чем никакого
+        self._save()
+        return self.cached(domains) != before
+
+    async def get(self, domains: Iterable[str],
+                  on_change: Optional[Callable[[List[str]], Awaitable[None]]] = None) -> List[str]:
+        """
+        Адреса для доменов. Если в кэше есть все домены — отвечает сразу,
+        устаревшие обновляются в фоне (с вызовом on_change при изменении).
+        Иначе ждёт резолва отсутствующих.
+        """
+        domains = list(domains)
+        missing = [d for d in domains if d not in self.entries]
+        if missing:
+            await self.resolve(missing)
+        # Только что резолвленные (даже неудачно) повторно не трогаем
+        stale = [d for d in self.stale(domains) if d not in missing]
+        if stale:
+            self.refresh_in_background(domains, on_change, stale)
+        return self.cached(domains)
+
+    def refresh_in_background(self, domains: List[str],
+                              on_change: Optional[Callable[[List[str]], Awaitable[None]]] = None,
+                              stale: Optional[List[str]] = None):
+        if self.refresh_task and not self.refresh_task.done():
+            return
+
+        async def refresh():
+            if await self.resolve(stale if stale is not None else domains) and on_change:
+                await on_change(self.cached(domains))
+
+        self.refresh_task = asyncio.create_task(refresh())
+
+    def cancel(self):
+        if self.refresh_task and not self.refresh_task.done():
+            self.refresh_task.cancel()
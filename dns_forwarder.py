@@ -0,0 +1,381 @@
+# --- START OF FILE dns_forwarder.py ---
+"""
+Кэширующий DNS на адресе TAP клиента.
+
+Без него каждый запрос к 8.8.8.8 — полный круг через мессенджер (секунда
+и больше) ещё до начала соединения. Здесь:
+  * ответы кэшируются по TTL (меньшему из записей ответа), отдаются с
+    уменьшенным TTL и с ID / регистром вопроса текущего запроса;
+  * NXDOMAIN и пустые ответы кэшируются по SOA (RFC 2308), не дольше
+    dns_negative_ttl;
+  * популярные имена (не меньше PREFETCH_HITS попаданий) обновляются
+    заранее, пока запись ещё жива;
+  * просроченная запись отдаётся сразу с TTL STALE_ANSWER_TTL и обновляется
+    в фоне (serve-stale, RFC 8767), пока ей не больше dns_stale_ttl.
+Промахи не идут UDP-пакетами через TAP: за FLUSH_DELAY они собираются в
+служебные кадры CTRL_DNS_QUERY и уходят одним срочным батчем
+(BaseTransport.send_control_now). На сервере DnsRelay отправляет их
+резолверу dns_upstream и так же срочно возвращает ответы.
+"""
+import asyncio
+import random
+import struct
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from config import config
+from control_frames import CTRL_DNS_QUERY, CTRL_DNS_RESPONSE
+from metrics import metrics
+
+_HEADER = struct.Struct('!HHHHHH')
+_RR = struct.Struct('!HHIH')
+_QUESTION_TAIL = struct.Struct('!HH')
+
+FLAG_QR = 0x8000
+FLAG_TC = 0x0200
+FLAG_RA = 0x0080
+RCODE_NOERROR = 0
+RCODE_SERVFAIL = 2
+RCODE_NXDOMAIN = 3
+TYPE_SOA = 6
+TYPE_OPT = 41
+
+FLUSH_DELAY = 0.005
+PREFETCH_HITS = 2
+STALE_ANSWER_TTL = 30
+
+
+def _send_frames(tasks: set, tunnel, frames):
+    """
+    Срочный батч отдельной задачей. Ссылка на неё хранится в tasks до
+    завершения (иначе задачу может собрать GC), ошибка печатается, а
+    незавершённые задачи отменяет stop().
+    """
+    task = asyncio.create_task(tunnel.send_control_now(frames))
+    tasks.add(task)
+
+    def done(t):
+        tasks.discard(t)
+        if not t.cancelled() and t.exception() is not None:
+            print(f"⚠️ DNS urgent batch failed: {t.exception()}")
+
+    task.add_done_callback(done)
+
+
+def parse_question(msg: bytes) -> Optional[Tuple[tuple, int]]:
+    """(ключ кэша, конец секции вопроса) для запроса с одним вопросом, иначе None"""
+    try:
+        _, flags, qdcount, _, _, arcount = _HEADER.unpack_from(msg)
+        if flags & FLAG_QR or qdcount != 1:
+            return None
+        labels, i = [], 12
+        while msg[i]:
+            n = msg[i]
+            if n & 0xC0:
+                return None
+            labels.append(bytes(msg[i + 1:i + 1 + n]))
+            i += n + 1
+        qtype, qclass = _QUESTION_TAIL.unpack_from(msg, i + 1)
+    except (IndexError, struct.error):
+        return None
+    # EDNS в ключе: ответ для клиента с большим буфером может не влезть в 512 байт
+    return (b'.'.join(labels).lower(), qtype, qclass, arcount > 0), i + 5
+
+
+def _skip_name(msg: bytes, i: int) -> int:
+    while True:
+        n = msg[i]
+        if n == 0:
+            return i + 1
+        if n & 0xC0 == 0xC0:
+            return i + 2
+        i += n + 1
+
+
+class DnsEntry:
+    __slots__ = ('response', 'query', 'ttl_offsets', 'ttl', 'stored', 'expires', 'hits', 'negative')
+
+    def __init__(self, response: bytes, query: bytes, ttl_offsets: List[int], ttl: int, negative: bool, now: float):
+        self.response = response
+        # Запрос, которым запись обновляется при prefetch / serve-stale
+        self.query = query
+        self.ttl_offsets = ttl_offsets
+        self.ttl = ttl
+        self.stored = now
+        self.expires = now + ttl
+        self.hits = 0
+        self.negative = negative
+
+    @classmethod
+    def from_response(cls, response: bytes, query: bytes, now: float) -> Optional['DnsEntry']:
+        """Запись кэша или None, если ответ кэшировать нельзя (SERVFAIL, TC, TTL 0)"""
+        try:
+            _, flags, qdcount, ancount, nscount, arcount = _HEADER.unpack_from(response)
+            rcode = flags & 0x0F
+            if flags & FLAG_TC or rcode not in (RCODE_NOERROR, RCODE_NXDOMAIN):
+                return None
+            i = 12
+            for _ in range(qdcount):
+                i = _skip_name(response, i) + 4
+            offsets, answer_ttl, soa_ttl = [], None, None
+            for n in range(ancount + nscount + arcount):
+                i = _skip_name(response, i)
+                rtype, _, ttl, rdlength = _RR.unpack_from(response, i)
+                if rtype != TYPE_OPT:  # у OPT в поле TTL флаги EDNS
+                    offsets.append(i + 4)
+                if n < ancount:
+                    answer_ttl = ttl if answer_ttl is None else min(answer_ttl, ttl)
+                elif n < ancount + nscount and rtype == TYPE_SOA:
+                    minimum = struct.unpack_from('!I', response, i + 10 + rdlength - 4)[0]
+                    soa_ttl = min(ttl, minimum)
+                i += 10 + rdlength
+        except (IndexError, struct.error):
+            return None
+
+        negative = rcode == RCODE_NXDOMAIN or not ancount
+        if negative:
+            ttl = min(soa_ttl if soa_ttl is not None else config.dns_negative_ttl, config.dns_negative_ttl)
+        else:
+            ttl = answer_ttl
+        if not ttl:
+            return None
+        return cls(bytes(response), bytes(query), offsets, ttl, negative, now)
+
+    def render(self, query: bytes, question_end: int, now: float, stale: bool = False) -> bytes:
+        """Ответ на query: его ID и вопрос (регистр 0x20), TTL за вычетом возраста записи"""
+        out = bytearray(self.response)
+        out[0:2] = query[0:2]
+        out[12:question_end] = query[12:question_end]
+        age = int(now - self.stored)
+        for off in self.ttl_offsets:
+            ttl = int.from_bytes(out[off:off + 4], 'big')
+            ttl = STALE_ANSWER_TTL if stale else max(0, ttl - age)
+            out[off:off + 4] = ttl.to_bytes(4, 'big')
+        return bytes(out)
+
+
+def servfail(query: bytes, question_end: int) -> bytes:
+    """Ответ SERVFAIL: заголовок запроса с QR/RA и одним вопросом"""
+    _, flags, _, _, _, _ = _HEADER.unpack_from(query)
+    header = _HEADER.pack(int.from_bytes(query[0:2], 'big'), (flags & 0x7900) | FLAG_QR | FLAG_RA | RCODE_SERVFAIL,
+                          1, 0, 0, 0)
+    return header + bytes(query[12:question_end])
+
+
+class _Pending:
+    __slots__ = ('tunnel_id', 'sent', 'query', 'question_end', 'waiters')
+
+    def __init__(self, tunnel_id: int, sent: float, query: bytes, question_end: int):
+        self.tunnel_id = tunnel_id
+        self.sent = sent
+        self.query = query
+        self.question_end = question_end
+        # (ID запроса, адрес, секция вопроса) — кому отдать ответ
+        self.waiters = []
+
+
+class DnsForwarder(asyncio.DatagramProtocol):
+    """Клиент: слушает UDP 53 на адресе TAP, промахи — через туннель"""
+
+    def __init__(self, tunnel):
+        self.tunnel = tunnel
+        self.udp: Optional[asyncio.DatagramTransport] = None
+        self.cache: 'OrderedDict[tuple, DnsEntry]' = OrderedDict()
+        self.pending: Dict[tuple, _Pending] = {}
+        self.by_id: Dict[int, tuple] = {}
+        self.next_id = random.randrange(0x10000)
+        self.outbox = []
+        self.flush_handle = None
+        self.flush_tasks = set()
+        self.maintenance_task = None
+
+    async def start(self, host: str, port: int = 53, attempts: int = 5) -> bool:
+        loop = asyncio.get_running_loop()
+        for attempt in range(attempts):
+            try:
+                self.udp, _ = await loop.create_datagram_endpoint(lambda: self, local_addr=(host, port))
+                break
+            except OSError as e:
+                # Адрес TAP может появиться в системе не сразу после назначения
+                if attempt == attempts - 1:
+                    print(f"⚠️ DNS forwarder disabled ({host}:{port}): {e}")
+                    return False
+                await asyncio.sleep(1.0)
+        self.tunnel.control_handlers[CTRL_DNS_RESPONSE] = self.on_response
+        metrics.gauge('televpn_dns_cache_entries', 'Entries in the client DNS cache', fn=lambda: len(self.cache))
+        self.maintenance_task = asyncio.create_task(self._maintenance())
+        print(f"🧭 DNS forwarder on {host}:{port}")
+        return True
+
+    def stop(self):
+        if self.maintenance_task: self.maintenance_task.cancel()
+        if self.flush_handle: self.flush_handle.cancel()
+        for task in list(self.flush_tasks):
+            task.cancel()
+        self.tunnel.control_handlers.pop(CTRL_DNS_RESPONSE, None)
+        if self.udp:
+            self.udp.close()
+            self.udp = None
+
+    def datagram_received(self, data: bytes, addr):
+        parsed = parse_question(data)
+        if parsed is None:
+            return
+        metrics.dns_queries.inc()
+        key, question_end = parsed
+        now = time.monotonic()
+        entry = self.cache.get(key)
+        if entry is not None:
+            self.cache.move_to_end(key)
+            if now < entry.expires:
+                entry.hits += 1
+                metrics.dns_cache_hits.inc()
+                if entry.negative: metrics.dns_negative_hits.inc()
+                self.udp.sendto(entry.render(data, question_end, now), addr)
+                if entry.hits >= PREFETCH_HITS and key not in self.pending and \
+                        entry.expires - now < self._prefetch_lead(entry):
+                    metrics.dns_prefetches.inc()
+                    self._forward(key, entry.query, question_end, now)
+                return
+            if now < entry.expires + config.dns_stale_ttl:
+                metrics.dns_stale_served.inc()
+                self.udp.sendto(entry.render(data, question_end, now, stale=True), addr)
+                self._forward(key, entry.query, question_end, now)
+                return
+            del self.cache[key]
+        self._forward(key, data, question_end, now, addr)
+
+    def _prefetch_lead(self, entry: DnsEntry) -> float:
+        # Обновление занимает круг через туннель — начинаем с запасом в два RTT
+        return max(0.1 * entry.ttl, 2 * (self.tunnel.rtt.srtt or 1.0))
+
+    def _forward(self, key: tuple, query: bytes, question_end: int, now: float, addr=None):
+        """Поставить запрос в срочный батч; одинаковые вопросы объединяются"""
+        p = self.pending.get(key)
+        if p is None:
+            while self.next_id in self.by_id:
+                self.next_id = (self.next_id + 1) & 0xFFFF
+            tunnel_id = self.next_id
+            self.next_id = (self.next_id + 1) & 0xFFFF
+            p = self.pending[key] = _Pending(tunnel_id, now, bytes(query), question_end)
+            self.by_id[tunnel_id] = key
+            self.outbox.append((CTRL_DNS_QUERY, tunnel_id.to_bytes(2, 'big') + bytes(query[2:])))
+            if self.flush_handle is None:
+                self.flush_handle = asyncio.get_running_loop().call_later(FLUSH_DELAY, self._flush)
+        if addr is not None:
+            waiter = (bytes(query[0:2]), addr, bytes(query[12:question_end]))
+            # Повтор ОС с тем же ID не должен получить два ответа
+            if waiter not in p.waiters:
+                p.waiters.append(waiter)
+
+    def _flush(self):
+        self.flush_handle = None
+        frames, self.outbox = self.outbox, []
+        metrics.dns_tunnel_queries.inc(len(frames))
+        _send_frames(self.flush_tasks, self.tunnel, frames)
+
+    def on_response(self, payload: bytes):
+        if len(payload) < 12:
+            return
+        key = self.by_id.pop(int.from_bytes(payload[0:2], 'big'), None)
+        if key is None:
+            return
+        p = self.pending.pop(key)
+        now = time.monotonic()
+        metrics.dns_tunnel_seconds.observe(now - p.sent)
+
+        entry = DnsEntry.from_response(payload, p.query, now)
+        if entry is not None:
+            self.cache[key] = entry
+            self.cache.move_to_end(key)
+            while len(self.cache) > config.dns_cache_size:
+                self.cache.popitem(last=False)
+        if self.udp is None:
+            return
+        for query_id, addr, question in p.waiters:
+            out = bytearray(payload)
+            out[0:2] = query_id
+            out[12:12 + len(question)] = question
+            self.udp.sendto(bytes(out), addr)
+
+    async def _maintenance(self):
+        """Раз в секунду: просроченные запросы и prefetch популярных имён"""
+        while True:
+            await asyncio.sleep(1.0)
+            now = time.monotonic()
+            for key, p in list(self.pending.items()):
+                if now - p.sent < config.dns_timeout:
+                    continue
+                del self.pending[key]
+                self.by_id.pop(p.tunnel_id, None)
+                metrics.dns_tunnel_failures.inc()
+                entry = self.cache.get(key)
+                for query_id, addr, question in p.waiters:
+                    query = query_id + p.query[2:12] + question + p.query[p.question_end:]
+                    if entry is not None:
+                        answer = entry.render(query, p.question_end, now, stale=True)
+                    else:
+                        answer = servfail(query, p.question_end)
+                    if self.udp: self.udp.sendto(answer, addr)
+            for key, entry in list(self.cache.items()):
+                if entry.hits >= PREFETCH_HITS and key not in self.pending and \
+                        0 < entry.expires - now < self._prefetch_lead(entry):
+                    metrics.dns_prefetches.inc()
+                    entry.hits = 0
+                    self._forward(key, entry.query, parse_question(entry.query)[1], now)
+
+    def stats(self) -> dict:
+        return {'entries': len(self.cache), 'pending': len(self.pending),
+                'negative': sum(1 for e in self.cache.values() if e.negative)}
+
+
+class DnsRelay(asyncio.DatagramProtocol):
+    """Сервер: CTRL_DNS_QUERY -> резолвер dns_upstream, ответы — срочным батчем обратно"""
+
+    def __init__(self, tunnel):
+        self.tunnel = tunnel
+        self.udp: Optional[asyncio.DatagramTransport] = None
+        self.outbox = []
+        self.flush_handle = None
+        self.flush_tasks = set()
+
+    async def start(self) -> bool:
+        loop = asyncio.get_running_loop()
+        host, port = config.dns_upstream, 53
+        if host.count(':') == 1:  # "адрес:порт"; IPv6 — без порта
+            host, port = host.split(':')[0], int(host.split(':')[1])
+        try:
+            self.udp, _ = await loop.create_datagram_endpoint(lambda: self, remote_addr=(host, port))
+        except OSError as e:
+            print(f"⚠️ DNS relay disabled ({config.dns_upstream}): {e}")
+            return False
+        self.tunnel.control_handlers[CTRL_DNS_QUERY] = self.on_query
+        return True
+
+    def stop(self):
+        if self.flush_handle: self.flush_handle.cancel()
+        for task in list(self.flush_tasks):
+            task.cancel()
+        self.tunnel.control_handlers.pop(CTRL_DNS_QUERY, None)
+        if self.udp:
+            self.udp.close()
+            self.udp = None
+
+    def on_query(self, payload: bytes):
+        if self.udp and len(payload) >= 12:
+            self.udp.sendto(payload)
+
+    def datagram_received(self, data: bytes, addr):
+        self.outbox.append((CTRL_DNS_RESPONSE, data))
+        if self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_later(FLUSH_DELAY, self._flush)
+
+    def error_received(self, exc):
+        # ICMP unreachable от резолвера: клиент дождётся dns_timeout и отдаст stale / SERVFAIL
+        pass
+
+    def _flush(self):
+        self.flush_handle = None
+        frames, self.outbox = self.outbox, []
+        _send_frames(self.flush_tasks, self.tunnel, frames)
@@ -0,0 +1,69 @@
+# --- START OF FILE fake_tap_interface.py ---
+import asyncio
+from typing import Callable, Optional
+
+from metrics import metrics
+
+
+class FakeTapInterface:
+    """
+    TAP-устройство в памяти с тем же API, что и RealTapInterface.
+
+    Кадры "из ОС" подаются через inject(), кадры, которые туннель пишет
+    в устройство, передаются в on_write. Используется стендом замеров.
+    """
+
+    def __init__(self, name: str = 'FakeTap', mac: bytes = b'\x02\x00\x00\x00\x00\x02'):
+        self.tap_handle = None
+        self.interface_guid = 'fake'
+        self.interface_name = name
+        self.local_ip = None
+        self.mac = mac
+        self.is_running = False
+        self.packet_count = 0
+        self.written_count = 0
+        self.on_write: Optional[Callable[[bytes], None]] = None
+        self.rx_queue = asyncio.Queue()
+
+    def find_tap_interface(self) -> bool:
+        return True
+
+    def set_ip_address(self, ip: str, netmask: str = "255.255.255.0") -> bool:
+        self.local_ip = ip
+        return True
+
+    def get_mac_address(self) -> bytes:
+        return self.mac
+
+    def open_tap_device(self) -> bool:
+        self.tap_handle = True
+        return True
+
+    def inject(self, frame: bytes):
+        """Кадр, который ОС "отправила" в TAP"""
+        self.rx_queue.put_nowait(frame)
+
+    async def read_packets(self, packet_handler):
+        self.is_running = True
+        while self.is_running:
+            data = await self.rx_queue.get()
+            if data is None: break
+            self.packet_count += 1
+            metrics.tap_rx_packets.inc()
+            metrics.tap_rx_bytes.inc(len(data))
+            try:
+                await packet_handler(data)
+            except Exception as e:
+                print(f"❌ Error handling fake TAP packet: {e}")
+
+    async def write_packet(self, packet: bytes) -> bool:
+        self.written_count += 1
+        metrics.tap_tx_packets.inc()
+        metrics.tap_tx_bytes.inc(len(packet))
+        if self.on_write:
+            self.on_write(packet)
+        return True
+
+    def close(self):
+        self.is_running = False
+        self.rx_queue.put_nowait(None)
@@ -0,0 +1,355 @@
+# --- START OF FILE fake_vk_server.py ---
+"""
+Локальный сервер, имитирующий ту часть API ВКонтакте, которой пользуется VKTransport.
+
+Поддерживается: users.get, docs.getMessagesUploadServer, загрузка файла,
+docs.save, messages.send, messages.getById, messages.getLongPollServer,
+LongPoll a_check и скачивание документов. Задержки, ошибки 9 (flood control)
+и 14 (captcha) задаются скриптом или вероятностью.
+
+VKTransport направляется сюда параметром vk_api_url в config.json:
+    "vk_api_url": "http://127.0.0.1:8765",
+    "vk_token": "fake-token-client-0001", "vk_peer_id": "1002"   (клиент)
+    "vk_token": "fake-token-server-0002", "vk_peer_id": "1001"   (сервер)
+
+Запуск:
+    python fake_vk_server.py --port 8765 --latency upload=0.4 --error-rate messages.send=9:0.05
+"""
+import argparse
+import email.parser
+import itertools
+import json
+import random
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+from urllib.parse import parse_qs, urlsplit
+
+DEFAULT_USERS = {
+    'fake-token-client-0001': 1001,
+    'fake-token-server-0002': 1002,
+}
+
+OUTBOX_FLAG = 2
+
+
+class FakeVkServer:
+    """
+    Фейковый api.vk.com. Состояние (документы, сообщения, очереди LongPoll)
+    хранится в памяти, все методы потокобезопасны.
+
+    Скрипт ошибок:
+        server.inject_error('messages.send', 9, count=3)   # три раза flood control
+        server.require_captcha('docs.save')                # одна капча
+        server.set_error_rate('messages.send', 14, 0.01)   # капча в 1% отправок
+        server.set_latency('upload', 0.5)                  # 'upload', 'download', 'longpoll' или метод API
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, users: Optional[Dict[str, int]] = None,
+                 seed: Optional[int] = None):
+        self.users = dict(users or DEFAULT_USERS)
+        self.captcha_answer = 'fake'
+        self.longpoll_max_wait = 25.0
+
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.rng = random.Random(seed)
+        self.ids = itertools.count(1)
+
+        self.uploads: Dict[str, bytes] = {}
+        self.docs: Dict[int, dict] = {}
+        self.messages: Dict[int, dict] = {}
+        self.updates = defaultdict(list)   # user_id -> список событий LongPoll
+        self.lp_keys: Dict[int, str] = {}
+
+        self.latency: Dict[str, float] = {}
+        self.script = defaultdict(deque)   # метод -> очередь кодов ошибок
+        self.error_rates = defaultdict(list)  # метод -> [(код, вероятность)]
+        self.pending_captchas = set()
+        self.stats = Counter()
+
+        self.httpd = ThreadingHTTPServer((host, port), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.fake = self
+        self.thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self) -> 'FakeVkServer':
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='fake-vk', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        with self.cond:
+            self.cond.notify_all()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    # === Сценарии ===
+
+    def set_latency(self, endpoint: str, seconds: float):
+        self.latency[endpoint] = seconds
+
+    def inject_error(self, method: str, code: int, count: int = 1):
+        with self.lock:
+            self.script[method].extend([code] * count)
+
+    def require_captcha(self, method: str, count: int = 1):
+        self.inject_error(method, 14, count)
+
+    def set_error_rate(self, method: str, code: int, probability: float):
+        with self.lock:
+            self.error_rates[method].append((code, probability))
+
+    # === Обработка ===
+
+    def _sleep(self, endpoint: str):
+        delay = self.latency.get(endpoint)
+        if delay: time.sleep(delay)
+
+    def _pick_fault(self, method: str, params: dict) -> Optional[dict]:
+        with self.lock:
+            sid = params.get('captcha_sid')
+            if sid in self.pending_captchas and params.get('captcha_key') == self.captcha_answer:
+                self.pending_captchas.discard(sid)
+                return None
+
+            code = None
+            if self.script[method]:
+                code = self.script[method].popleft()
+            else:
+                for c, p in self.error_rates.get(method, ()):
+                    if self.rng.random() < p:
+                        code = c
+                        break
+            if code is None: return None
+
+            self.stats[f'error_{code}'] += 1
+            if code == 14:
+                sid = str(next(self.ids))
+                self.pending_captchas.add(sid)
+                return {'error_code': 14, 'error_msg': 'Captcha needed', 'captcha_sid': sid,
+                        'captcha_img': f'{self.base_url}/captcha/{sid}'}
+            if code == 9:
+                return {'error_code': 9, 'error_msg': 'Flood control'}
+            return {'error_code': code, 'error_msg': 'Injected error'}
+
+    def call_method(self, method: str, params: dict) -> dict:
+        self.stats[method] += 1
+        self._sleep(method)
+        uid = self.users.get(params.get('access_token', ''))
+        if uid is None:
+            return {'error': {'error_code': 5, 'error_msg': 'User authorization failed'}}
+
+        fault = self._pick_fault(method, params)
+        if fault:
+            fault['request_params'] = [{'key': 'method', 'value': method}]
+            return {'error': fault}
+
+        handler = getattr(self, '_m_' + method.replace('.', '_'), None)
+        if handler is None:
+            return {'error': {'error_code': 3, 'error_msg': f'Unknown method passed: {method}'}}
+        return {'response': handler(uid, params)}
+
+    def _m_users_get(self, uid, params):
+        return [{'id': uid, 'first_name': 'Fake', 'last_name': str(uid)}]
+
+    def _m_docs_getMessagesUploadServer(self, uid, params):
+        return {'upload_url': f'{self.base_url}/upload/{uid}'}
+
+    def _m_docs_save(self, uid, params):
+        with self.lock:
+            data = self.uploads.pop(params.get('file', ''), None)
+            if data is None:
+                raise _BadRequest('unknown file')
+            doc_id = next(self.ids)
+            doc = {'id': doc_id, 'owner_id': uid, 'title': params.get('title') or 'd.bin',
+                   'size': len(data), 'ext': 'bin', 'url': f'{self.base_url}/doc/{uid}_{doc_id}'}
+            self.docs[doc_id] = dict(doc, data=data)
+        return {'type': 'doc', 'doc': doc}
+
+    def _m_messages_send(self, uid, params):
+        peer_id = int(params['peer_id'])
+        attachments = []
+        for att in filter(None, params.get('attachment', '').split(',')):
+            doc_id = int(att.rsplit('_', 1)[1])
+            doc = self.docs.get(doc_id)
+            if doc:
+                attachments.append({'type': 'doc', 'doc': {k: v for k, v in doc.items() if k != 'data'}})
+
+        with self.cond:
+            mid = next(self.ids)
+            self.messages[mid] = {'id': mid, 'from_id': uid, 'peer_id': peer_id,
+                                  'date': int(time.time()), 'attachments': attachments}
+            extra = {}
+            for i, att in enumerate(attachments, 1):
+                extra[f'attach{i}_type'] = 'doc'
+                extra[f'attach{i}'] = f"{att['doc']['owner_id']}_{att['doc']['id']}"
+            now = int(time.time())
+            # У получателя — входящее от uid, у отправителя — исходящее к peer_id
+            self.updates[peer_id].append([4, mid, 0, uid, now, '', {}, extra, 0])
+            self.updates[uid].append([4, mid, OUTBOX_FLAG, peer_id, now, '', {}, extra, 0])
+            self.cond.notify_all()
+        return mid
+
+    def _m_messages_getById(self, uid, params):
+        ids = [int(x) for x in str(params.get('message_ids', '')).split(',') if x]
+        with self.lock:
+            items = [self.messages[i] for i in ids if i in self.messages]
+        return {'count': len(items), 'items': items}
+
+    def _m_messages_getLongPollServer(self, uid, params):
+        with self.lock:
+            key = self.lp_keys.setdefault(uid, f'lpkey{uid}')
+            ts = len(self.updates[uid])
+        netloc = urlsplit(self.base_url).netloc
+        return {'key': key, 'server': f'{netloc}/lp/{uid}', 'ts': ts, 'pts': ts}
+
+    def store_upload(self, data: bytes) -> str:
+        self.stats['upload'] += 1
+        self.stats['bytes_uploaded'] += len(data)
+        self._sleep('upload')
+        with self.lock:
+            token = f'file{next(self.ids)}'
+            self.uploads[token] = data
+        return token
+
+    def fetch_doc(self, doc_id: int) -> Optional[bytes]:
+        self.stats['download'] += 1
+        self._sleep('download')
+        with self.lock:
+            doc = self.docs.get(doc_id)
+        if doc is None: return None
+        self.stats['bytes_downloaded'] += doc['size']
+        return doc['data']
+
+    def longpoll_check(self, uid: int, params: dict) -> dict:
+        self.stats['longpoll'] += 1
+        self._sleep('longpoll')
+        if params.get('key') != self.lp_keys.get(uid):
+            return {'failed': 2}
+        ts = int(params.get('ts', 0))
+        wait = min(float(params.get('wait', 25)), self.longpoll_max_wait)
+        deadline = time.time() + wait
+        with self.cond:
+            while len(self.updates[uid]) <= ts:
+                remaining = deadline - time.time()
+                if remaining <= 0: break
+                self.cond.wait(remaining)
+            events = self.updates[uid][ts:]
+            return {'ts': ts + len(events), 'updates': events}
+
+
+class _BadRequest(Exception):
+    pass
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _params(self) -> dict:
+        parts = urlsplit(self.path)
+        params = {k: v[-1] for k, v in parse_qs(parts.query).items()}
+        if self.command == 'POST' and 'form-urlencoded' in self.headers.get('Content-Type', ''):
+            params.update({k: v[-1] for k, v in parse_qs(self._body().decode()).items()})
+        return params
+
+    def _body(self) -> bytes:
+        return self.body
+
+    def _send(self, code: int, body: bytes, ctype: str = 'application/json'):
+        self.send_response(code)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _json(self, obj):
+        self._send(200, json.dumps(obj).encode())
+
+    def do_GET(self):
+        self._dispatch()
+
+    def do_POST(self):
+        self._dispatch()
+
+    def _dispatch(self):
+        fake: FakeVkServer = self.server.fake
+        path = urlsplit(self.path).path.strip('/').split('/')
+        # Тело читаем сразу: иначе при ошибке оно останется в keep-alive соединении
+        self.body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            if path[0] == 'method' and len(path) == 2:
+                self._json(fake.call_method(path[1], self._params()))
+            elif path[0] == 'upload' and self.command == 'POST':
+                self._json({'file': fake.store_upload(self._multipart_file())})
+            elif path[0] == 'doc' and len(path) == 2:
+                data = fake.fetch_doc(int(path[1].rsplit('_', 1)[1]))
+                if data is None:
+                    self._send(404, b'not found', 'text/plain')
+                else:
+                    self._send(200, data, 'application/octet-stream')
+            elif path[0] == 'lp' and len(path) == 2:
+                self._json(fake.longpoll_check(int(path[1]), self._params()))
+            elif path[0] == 'captcha':
+                self._send(200, fake.captcha_answer.encode(), 'text/plain')
+            else:
+                self._send(404, b'not found', 'text/plain')
+        except _BadRequest as e:
+            self._json({'error': {'error_code': 100, 'error_msg': f'One of the parameters specified was missing or invalid: {e}'}})
+        except Exception as e:
+            self._send(500, str(e).encode(), 'text/plain')
+
+    def _multipart_file(self) -> bytes:
+        head = f"MIME-Version: 1.0\r\nContent-Type: {self.headers.get('Content-Type', '')}\r\n\r\n".encode()
+        msg = email.parser.BytesParser().parsebytes(head + self._body())
+        for part in msg.get_payload():
+            if part.get_param('name', header='content-disposition') == 'file':
+                return part.get_payload(decode=True)
+        raise _BadRequest('file field missing')
+
+
+def _parse_kv(items, convert):
+    result = {}
+    for item in items or []:
+        key, _, value = item.partition('=')
+        result[key] = convert(value)
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local fake VK API server for VKTransport")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--latency', action='append', metavar='ENDPOINT=SECONDS',
+                        help="method name, 'upload', 'download' or 'longpoll'")
+    parser.add_argument('--error-rate', action='append', metavar='METHOD=CODE:PROB',
+                        help="e.g. messages.send=9:0.05 or docs.save=14:0.01")
+    args = parser.parse_args()
+
+    server = FakeVkServer(args.host, args.port, seed=args.seed)
+    for endpoint, seconds in _parse_kv(args.latency, float).items():
+        server.set_latency(endpoint, seconds)
+    for method, spec in _parse_kv(args.error_rate, str).items():
+        code, _, prob = spec.partition(':')
+        server.set_error_rate(method, int(code), float(prob))
+
+    print(f"🧪 Fake VK API on {server.base_url}")
+    for token, uid in server.users.items():
+        print(f"   token {token} -> user {uid}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
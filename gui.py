@@ -19,6 +19,7 @@ import pyqtgraph as pg
 try:
     from main import VPNApplication
     from config import config
+    from metrics import metrics
 
     CORE_AVAILABLE = True
 except ImportError:
@@ -146,10 +147,11 @@ class VPNWorker(QThread):
                 asyncio.run_coroutine_threadsafe(self.app.shutdown(), self.loop)
 
     def get_stats(self):
-        if self.app and hasattr(self.app, 'handler'):
-            tap = getattr(self.app.handler, 'tap_interface', None)
-            if tap: return tap.packet_count
-        return 0
+        """Снимок реальных метрик ядра (реестр metrics в этом же процессе)"""
+        snap = metrics.snapshot()
+        self.bytes_sent = snap['televpn_upload_bytes_total']
+        self.bytes_recv = snap['televpn_download_bytes_total']
+        return snap
 
 
 class StatCard(QFrame):
@@ -512,8 +514,8 @@ class MainWindow(QMainWindow):
         self.timer = QTimer()
         self.timer.timeout.connect(self.update_stats)
         self.data_history = deque([0] * 60, maxlen=60)
-        self.last_pkts = 0
-        self.coef = 25
+        self.last_bytes = 0
+        self.last_tick = 0
 
     def switch_page(self, idx):
         self.stack.setCurrentIndex(idx)
@@ -547,6 +549,8 @@ class MainWindow(QMainWindow):
         self.dash.btn_toggle.style().polish(self.dash.btn_toggle)
         self.is_running = True
         self.start_time = time.time()
+        self.last_bytes = self._tap_bytes(self.worker.get_stats())
+        self.last_tick = time.monotonic()
         self.timer.start(1000)
 
     def stop_vpn(self):
@@ -576,23 +580,36 @@ class MainWindow(QMainWindow):
         h, m = divmod(m, 60)
         self.dash.card_time.update_data(f"{h:02}:{m:02}:{s:02}", "Время сессии")
 
-        pkts = self.worker.get_stats()
-        diff = pkts - self.last_pkts
-        self.last_pkts = pkts
+        snap = self.worker.get_stats()
+        now = time.monotonic()
+        tap_bytes = self._tap_bytes(snap)
+        interval = max(now - self.last_tick, 1e-3)
+        speed_kbs = (tap_bytes - self.last_bytes) / 1024 / interval
+        self.last_bytes = tap_bytes
+        self.last_tick = now
 
-        # Расчет скорости (примерный, считаем 1 пакет ~ 1 КБ для визуализации)
-        speed_kbs = self.coef * diff * 1.2
-        total_mb = (pkts * 1.2) / 1024
-
-        self.dash.card_speed.update_data(f"{speed_kbs:.1f} KB/s", "Текущая скорость")
+        # Всего — то, что реально ушло/пришло через мессенджер (после сжатия и шифрования)
+        total_mb = (self.worker.bytes_sent + self.worker.bytes_recv) / 1024 / 1024
+        batch = snap['televpn_batch_packets']
 
+        self.dash.card_speed.update_data(f"{speed_kbs:.1f} KB/s", f"Батч: ~{batch['p50']:.0f} пак.")
         self.dash.card_sent.update_data(f"{total_mb:.2f} MB", "Сжатых данных")
         #self.dash.card_recv.update_data(int(recv_kb), f"Всего: {pkts * 0.4 / 1024:.1f} MB")
-        self.dash.card_ping.update_data(f"{25 + (diff % 10)}", "мс (Latency)")
+        srtt = snap['televpn_tunnel_srtt_seconds']
+        if srtt:
+            jitter = snap['televpn_tunnel_rtt_jitter_seconds']
+            self.dash.card_ping.update_data(f"{srtt * 1000:.0f}", f"мс RTT (±{jitter * 1000:.0f})")
+        else:
+            upload = snap['televpn_upload_seconds']
+            self.dash.card_ping.update_data(f"{upload['p50'] * 1000:.0f}", "мс (загрузка p50)")
 
-        self.data_history.append(diff)
+        self.data_history.append(speed_kbs)
         self.dash.curve.setData(list(self.data_history))
 
+    @staticmethod
+    def _tap_bytes(snap):
+        return snap['televpn_tap_rx_bytes_total'] + snap['televpn_tap_tx_bytes_total']
+
     def append_log(self, text, level):
         color = "#FF5252" if level >= logging.ERROR else "#E1E1E1"
         self.dash.log_view.append(
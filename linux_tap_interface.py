@@ -0,0 +1,177 @@
+# --- START OF FILE linux_tap_interface.py ---
+"""
+TAP-устройство Linux через /dev/net/tun (TUNSETIFF, IFF_TAP | IFF_NO_PI).
+
+API как у RealTapInterface (TAP-Windows), выбирается в packet_handler.py
+по платформе. Кадры Ethernet без заголовка tun_pi; чтение — из
+неблокирующего дескриптора по готовности (loop.add_reader), без потока
+на каждый кадр. Интерфейс не persistent: закрытие дескриптора (или
+завершение процесса) удаляет его вместе с адресами и маршрутами.
+Нужны root или CAP_NET_ADMIN.
+"""
+import asyncio
+import fcntl
+import ipaddress
+import os
+import struct
+import subprocess
+
+from config import config
+from metrics import metrics
+
+TUNSETIFF = 0x400454CA
+IFF_TAP = 0x0002
+IFF_NO_PI = 0x1000
+IFNAMSIZ = 16
+DEFAULT_NAME = 'televpn0'
+
+
+def _interface_name() -> str:
+    """config.tap_interface_name, если это допустимое имя Linux (по умолчанию там имя Windows)"""
+    name = config.tap_interface_name
+    if name and len(name) < IFNAMSIZ and not any(c.isspace() or c in '/:' for c in name):
+        return name
+    return DEFAULT_NAME
+
+
+class LinuxTapInterface:
+    def __init__(self):
+        self.fd = None
+        self.tap_handle = None
+        self.interface_guid = None
+        self.interface_name = None
+        self.local_ip = None
+        self.buffer_size = 65535
+        self.is_running = False
+        self.packet_count = 0
+        self.ready = None
+
+    # === 1. Создание TAP ===
+    def find_tap_interface(self) -> bool:
+        """Создаёт TAP-интерфейс (аналог поиска адаптера TAP-Windows)"""
+        if self.fd is not None:
+            return True
+        name = _interface_name()
+        try:
+            fd = os.open('/dev/net/tun', os.O_RDWR | os.O_NONBLOCK)
+        except OSError as e:
+            print(f"❌ Cannot open /dev/net/tun: {e} (need root or CAP_NET_ADMIN, module tun)")
+            return False
+        try:
+            ifr = struct.pack(f'{IFNAMSIZ}sH22x', name.encode(), IFF_TAP | IFF_NO_PI)
+            ifr = fcntl.ioctl(fd, TUNSETIFF, ifr)
+        except OSError as e:
+            os.close(fd)
+            print(f"❌ TUNSETIFF {name} failed: {e}")
+            return False
+        self.fd = fd
+        self.interface_name = ifr[:IFNAMSIZ].rstrip(b'\0').decode()
+        self.interface_guid = self.interface_name
+        print(f"✅ Created TAP: {self.interface_name}")
+        return True
+
+    # === 2. Настройка IP ===
+    def set_ip_address(self, ip: str, netmask: str = "255.255.255.0") -> bool:
+        if not self.interface_name and not self.find_tap_interface():
+            return False
+        prefix = ipaddress.IPv4Network(f'0.0.0.0/{netmask}').prefixlen if netmask else 24
+        commands = f"link set dev {self.interface_name} up\n"
+        if ip:
+            commands = f"addr replace {ip}/{prefix} dev {self.interface_name}\n" + commands
+        result = subprocess.run(['ip', '-batch', '-'], input=commands, capture_output=True, text=True)
+        if result.returncode:
+            print(f"❌ Failed to set IP: {result.stderr.strip()}")
+            return False
+        self.local_ip = ip
+        print(f"✅ IP {ip} set for {self.interface_name}" if ip else f"✅ {self.interface_name} is up")
+        return True
+
+    # === 3. MAC ===
+    def get_mac_address(self) -> bytes:
+        if not self.interface_name:
+            return None
+        try:
+            with open(f'/sys/class/net/{self.interface_name}/address') as f:
+                return bytes.fromhex(f.read().strip().replace(':', ''))
+        except (OSError, ValueError) as e:
+            print(f"❌ Error getting MAC: {e}")
+        return None
+
+    # === 4. Открытие ===
+    def open_tap_device(self) -> bool:
+        """Дескриптор уже открыт в find_tap_interface"""
+        if self.fd is None and not self.find_tap_interface():
+            return False
+        self.tap_handle = self.fd
+        return True
+
+    # === 5. Чтение пакетов ===
+    async def read_packets(self, packet_handler):
+        if self.fd is None:
+            print("❌ TAP handle not initialized")
+            return
+
+        self.is_running = True
+        print("🚀 TAP packet reader started...")
+
+        loop = asyncio.get_running_loop()
+        self.ready = asyncio.Event()
+        loop.add_reader(self.fd, self.ready.set)
+        try:
+            while self.is_running:
+                await self.ready.wait()
+                self.ready.clear()
+                # Вычитываем всё, что накопилось, до EAGAIN
+                while self.is_running:
+                    try:
+                        data = self._read_from_tap()
+                    except OSError as e:
+                        print(f"❌ Error reading TAP: {e}")
+                        await asyncio.sleep(0.05)
+                        break
+                    if not data:
+                        break
+                    self.packet_count += 1
+                    metrics.tap_rx_packets.inc()
+                    metrics.tap_rx_bytes.inc(len(data))
+                    await packet_handler(data)
+        finally:
+            if self.fd is not None:
+                loop.remove_reader(self.fd)
+
+    def _read_from_tap(self) -> bytes:
+        """Неблокирующее чтение одного кадра; b'' — кадров больше нет"""
+        try:
+            return os.read(self.fd, self.buffer_size)
+        except BlockingIOError:
+            return b''
+
+    # === 6. Запись пакета ===
+    async def write_packet(self, packet: bytes) -> bool:
+        if self.fd is None:
+            return False
+        try:
+            os.write(self.fd, packet)
+        except BlockingIOError:
+            return False  # очередь устройства переполнена — кадр теряется, как на проводе
+        except OSError as e:
+            print(f"❌ Error writing TAP packet: {e}")
+            return False
+        metrics.tap_tx_packets.inc()
+        metrics.tap_tx_bytes.inc(len(packet))
+        return True
+
+    # === 7. Закрытие ===
+    def close(self):
+        """Закрывает дескриптор; ядро удаляет интерфейс"""
+        self.is_running = False
+        if self.ready is not None:
+            self.ready.set()
+        if self.fd is not None:
+            try:
+                asyncio.get_running_loop().remove_reader(self.fd)
+            except RuntimeError:
+                pass  # вне цикла событий
+            os.close(self.fd)
+            self.fd = self.tap_handle = None
+            print("✅ TAP device closed")
@@ -0,0 +1,275 @@
+# --- START OF FILE load_test.py ---
+"""
+Нагрузочный тест многоклиентского сервера.
+
+Один серверный PacketHandler с таблицей из N клиентов и N клиентских
+PacketHandler в одном процессе. У каждого клиента свой LoopbackLink
+(как отдельный чат) и свой ключ. Серверный TAP работает как эхо: пакет
+от клиента разворачивается (src <-> dst) и снова подаётся в TAP, так что
+обратный путь проходит маршрутизацию по IP назначения. Результат — JSON.
+
+Примеры:
+    python load_test.py --clients 32 --rate 5 --duration 10
+    python load_test.py --clients 64 --ideal --output load.json
+"""
+import argparse
+import asyncio
+import json
+import platform
+import sys
+import time
+
+from benchmark import _NoNetwork, build_frame, _percentile_ms, _pipeline_busy, REMOTE_IPS
+from client_table import ClientEntry, ip_to_int
+from config import config
+from fake_tap_interface import FakeTapInterface
+from loopback_transport import LoopbackLink, LinkModel, LoopbackTransport
+from packet_handler import PacketHandler
+
+SERVER_KEY = 'load-test-server-key-0123456789!'
+SERVER_MAC = b'\x02\x00\x00\x00\x01\x00'
+
+
+def client_key(i: int) -> str:
+    return f'load-test-client-{i:05d}'.ljust(32, '#')
+
+
+def client_ip(i: int) -> str:
+    # Без .0 / .255 — их отбрасывает фильтр
+    return f'10.8.{i // 250}.{i % 250 + 2}'
+
+
+def _echo_frame(frame: bytes) -> bytes:
+    """Разворот кадра: MAC, IP и порты меняются местами (контрольная сумма IP не меняется)"""
+    ihl = (frame[14] & 0x0F) * 4
+    l4 = 14 + ihl
+    return (frame[6:12] + frame[0:6] + frame[12:26] + frame[30:34] + frame[26:30] +
+            frame[34:l4] + frame[l4 + 2:l4 + 4] + frame[l4:l4 + 2] + frame[l4 + 4:])
+
+
+class EchoRecorder:
+    """Учёт по клиентам: отправлено, дошло до сервера, вернулось, ушло не тому клиенту"""
+
+    def __init__(self, n: int):
+        self.sent_at = {}
+        self.offered = [0] * n
+        self.at_server = [0] * n
+        self.returned = [0] * n
+        self.misrouted = 0
+        self.rtt = []
+        self.up = []
+        self.ip_index = {ip_to_int(client_ip(i)): i for i in range(n)}
+
+    @staticmethod
+    def tag(frame: bytes) -> bytes:
+        # Метка (клиент, seq) в начале payload UDP
+        return frame[42:50]
+
+    def sent(self, i: int, frame: bytes):
+        self.offered[i] += 1
+        self.sent_at[self.tag(frame)] = time.perf_counter()
+
+    def reached_server(self, frame: bytes):
+        i = self.ip_index.get(int.from_bytes(frame[26:30], 'big'))
+        if i is None: return
+        self.at_server[i] += 1
+        start = self.sent_at.get(self.tag(frame))
+        if start is not None:
+            self.up.append(time.perf_counter() - start)
+
+    def returned_to(self, i: int, frame: bytes):
+        if int.from_bytes(frame[30:34], 'big') != ip_to_int(client_ip(i)) or \
+                int.from_bytes(self.tag(frame)[:4], 'big') != i:
+            self.misrouted += 1
+            return
+        self.returned[i] += 1
+        start = self.sent_at.pop(self.tag(frame), None)
+        if start is not None:
+            self.rtt.append(time.perf_counter() - start)
+
+    def outstanding(self) -> int:
+        return len(self.sent_at)
+
+    def report(self, in_flight: int = 0) -> dict:
+        """in_flight — сколько из неразвернувшихся пакетов ещё в пути на момент среза"""
+        offered, returned = sum(self.offered), sum(self.returned)
+        lost = self.outstanding() - in_flight
+        rtt, up = sorted(self.rtt), sorted(self.up)
+        shares = [r / o for r, o in zip(self.returned, self.offered) if o]
+        # Индекс справедливости Джайна по доле доставленного у каждого клиента
+        jain = (sum(shares) ** 2 / (len(shares) * sum(x * x for x in shares))) if shares and any(shares) else 0.0
+        return {
+            'offered_packets': offered,
+            'reached_server': sum(self.at_server),
+            'returned_packets': returned,
+            'misrouted': self.misrouted,
+            'in_flight_packets': in_flight,
+            'lost_packets': lost,
+            # Только потерянные: не дождавшиеся конца прогона пакеты сюда не входят
+            'loss_ratio': round(lost / offered, 6) if offered else 0.0,
+            'uplink_ms': {'p50': _percentile_ms(up, 0.5), 'p99': _percentile_ms(up, 0.99)},
+            'rtt_ms': {'p50': _percentile_ms(rtt, 0.5), 'p99': _percentile_ms(rtt, 0.99),
+                       'max': round(rtt[-1] * 1000, 3) if rtt else None},
+            'per_client_returned': {'min': min(self.returned, default=0), 'max': max(self.returned, default=0)},
+            'fairness_jain': round(jain, 4),
+        }
+
+
+async def run_load_test(args) -> dict:
+    config.transport_type = 'loopback'
+    config.encryption_key = SERVER_KEY
+    config.compression_enabled = args.compression
+    config.batch_interval = args.batch_interval
+    # Пробы RTT не нужны: задержку меряем по эхо-пакетам
+    config.rtt_probe_interval = 0
+
+    if args.ideal:
+        model = LinkModel(latency=0, jitter=0, upload_bandwidth=0, upload_overhead=0, seed=args.seed)
+    else:
+        model = LinkModel(latency=args.latency, jitter=args.jitter, upload_bandwidth=args.bandwidth,
+                          upload_overhead=args.upload_overhead, loss=args.loss, seed=args.seed)
+
+    n = args.clients
+    entries = []
+    for i in range(n):
+        name = f'load-{i}'
+        LoopbackLink._links.pop(name, None)
+        LoopbackLink.get(name, model)
+        entries.append(ClientEntry(name, client_ip(i), peer=name, encryption_key=client_key(i)))
+
+    recorder = EchoRecorder(n)
+    server_tap = FakeTapInterface('load-server', SERVER_MAC)
+    server = PacketHandler(tap_interface=server_tap, network=_NoNetwork(), clients=entries)
+
+    def on_server_write(frame: bytes):
+        recorder.reached_server(frame)
+        server_tap.inject(_echo_frame(frame))
+
+    server_tap.on_write = on_server_write
+
+    clients, client_taps = [], []
+    for i, entry in enumerate(entries):
+        tap = FakeTapInterface(f'load-client-{i}', bytes([2, 0, 0, 1, i >> 8 & 0xFF, i & 0xFF]))
+        tap.on_write = (lambda idx: lambda frame: recorder.returned_to(idx, frame))(i)
+        transport = LoopbackTransport(LoopbackLink.get(entry.peer), entry.encryption_key)
+        clients.append(PacketHandler(transport=transport, tap_interface=tap, network=_NoNetwork()))
+        client_taps.append(tap)
+
+    if not await server.initialize('server'):
+        raise RuntimeError("server initialization failed")
+    for handler in clients:
+        if not await handler.initialize('client'):
+            raise RuntimeError("client initialization failed")
+
+    handlers = [server] + clients
+    readers = [asyncio.create_task(h.start_reading_packets()) for h in handlers]
+
+    # Расписание: клиенты шлют равномерно, со сдвигом фазы
+    schedule = []
+    per_client = int(args.rate * args.duration)
+    for i in range(n):
+        for seq in range(per_client):
+            payload = i.to_bytes(4, 'big') + seq.to_bytes(4, 'big') + bytes(args.payload)
+            frame = build_frame(client_ip(i), REMOTE_IPS[seq % len(REMOTE_IPS)], 17, 40000 + seq % 20000, 9,
+                                payload, src_mac=client_taps[i].mac, dst_mac=SERVER_MAC, seq=seq)
+            schedule.append(((seq + i / n) / args.rate, i, frame))
+    schedule.sort(key=lambda x: x[0])
+
+    loop = asyncio.get_running_loop()
+    cpu_start = time.process_time()
+    wall_start = loop.time()
+    for offset, i, frame in schedule:
+        delay = wall_start + offset - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        recorder.sent(i, frame)
+        client_taps[i].inject(frame)
+
+    # Ждём, пока конвейер не опустеет (батчер держит батч до batch_interval,
+    # поэтому "пусто" должно продержаться settle секунд), но не дольше drain
+    transports = [s.transport for s in server.clients] + [h.transport for h in clients]
+    links = [LoopbackLink.get(e.peer) for e in entries]
+    settle = 2 * config.batch_interval + 0.25
+    deadline = loop.time() + args.drain
+    idle_since = None
+    drained = False
+    while recorder.outstanding() and loop.time() < deadline:
+        if _pipeline_busy(transports, links):
+            idle_since = None
+        elif idle_since is None:
+            idle_since = loop.time()
+        elif loop.time() - idle_since >= settle:
+            drained = True  # всё, что не вернулось, потеряно
+            break
+        await asyncio.sleep(0.05)
+    # Срез по drain при непустом конвейере: оставшееся ещё в пути, а не потеряно
+    in_flight = 0 if drained else recorder.outstanding()
+    wall = loop.time() - wall_start
+    cpu = time.process_time() - cpu_start
+
+    sessions = server.clients.stats()
+    for tap in [server_tap] + client_taps:
+        tap.close()
+    for h in handlers:
+        await h.shutdown()
+    await asyncio.gather(*readers, return_exceptions=True)
+
+    return {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+        },
+        'params': {
+            'clients': n,
+            'rate_per_client': args.rate,
+            'duration': args.duration,
+            'payload': args.payload,
+            'compression': config.compression_enabled,
+            'batch_interval': config.batch_interval,
+            'link': vars(model),
+        },
+        'result': recorder.report(in_flight),
+        'server_sessions': {
+            'count': len(sessions),
+            'spoofed': sum(s['spoofed'] for s in sessions.values()),
+            'tx_packets': sum(s['tx_packets'] for s in sessions.values()),
+            'rx_packets': sum(s['rx_packets'] for s in sessions.values()),
+        },
+        'process': {'wall_s': round(wall, 3), 'cpu_s': round(cpu, 3)},
+        'drain_cut_off': bool(in_flight),
+    }
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Multi-client server load test (fake TAP + loopback links)")
+    p.add_argument('--clients', type=int, default=32)
+    p.add_argument('--rate', type=float, default=5, help="packets per second per client")
+    p.add_argument('--duration', type=float, default=10)
+    p.add_argument('--payload', type=int, default=200, help="extra UDP payload bytes per packet")
+    p.add_argument('--seed', type=int, default=1)
+    p.add_argument('--compression', action='store_true')
+    p.add_argument('--batch-interval', type=float, default=config.batch_interval or 0.05)
+    p.add_argument('--ideal', action='store_true', help="zero-latency links: measure CPU cost only")
+    p.add_argument('--latency', type=float, default=0.3)
+    p.add_argument('--jitter', type=float, default=0.05)
+    p.add_argument('--bandwidth', type=float, default=2_000_000)
+    p.add_argument('--upload-overhead', type=float, default=0.05)
+    p.add_argument('--loss', type=float, default=0.0)
+    p.add_argument('--drain', type=float, default=300.0,
+                   help="max seconds to wait for queues, worker pools and links to go idle")
+    p.add_argument('--output', help="write JSON here instead of stdout")
+    return p.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    json_out = sys.stdout
+    sys.stdout = sys.stderr
+    result = asyncio.run(run_load_test(args))
+    text = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+    else:
+        json_out.write(text + "\n")
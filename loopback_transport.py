@@ -0,0 +1,181 @@
+# --- START OF FILE loopback_transport.py ---
+import asyncio
+import random
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional
+
+from base_transport import BaseTransport
+from batch_buffer import BatchBuffer
+from metrics import metrics
+
+
+@dataclass
+class LinkModel:
+    """
+    Модель канала мессенджера для офлайн-замеров.
+
+    Все времена в секундах. Значения по умолчанию грубо соответствуют
+    загрузке документа в Telegram из домашней сети.
+    """
+    latency: float = 0.3                 # задержка доставки сообщения после загрузки
+    jitter: float = 0.05                 # случайная добавка к latency (0..jitter)
+    upload_bandwidth: float = 2_000_000  # байт/с на загрузку файла, 0 = без ограничения
+    upload_overhead: float = 0.05        # фиксированная стоимость одного send_file
+    loss: float = 0.0                    # вероятность потерять сообщение
+    reorder: float = 0.0                 # вероятность задержать сообщение (перестановка)
+    reorder_delay: float = 0.5           # на сколько задерживается "переставленное" сообщение
+    flood_wait_probability: float = 0.0  # вероятность получить FloodWait перед загрузкой
+    flood_wait: float = 3.0              # длительность паузы FloodWait
+    seed: Optional[int] = None           # фиксированный seed для воспроизводимых прогонов
+
+
+class LoopbackLink:
+    """
+    Канал между двумя LoopbackTransport в одном процессе.
+
+    Стороны регистрируются по режиму ('client' / 'server'). Каждое
+    направление загружает сообщения последовательно (как один аккаунт
+    мессенджера), задержка доставки и потери считаются по LinkModel.
+    """
+
+    _links: Dict[str, 'LoopbackLink'] = {}
+
+    def __init__(self, model: Optional[LinkModel] = None):
+        self.model = model or LinkModel()
+        self.rng = random.Random(self.model.seed)
+        self.endpoints: Dict[str, 'LoopbackTransport'] = {}
+        self.upload_locks: Dict[str, asyncio.Lock] = {}
+        self.stats = {'messages': 0, 'bytes': 0, 'lost': 0, 'reordered': 0, 'flood_waits': 0}
+        self.down_until = 0.0
+        # Сообщения, загруженные, но ещё не доставленные пиру (задержка канала)
+        self.in_transit = 0
+
+    @classmethod
+    def get(cls, name: str = 'default', model: Optional[LinkModel] = None) -> 'LoopbackLink':
+        """Именованный канал: обе стороны, открывшие одно имя, видят друг друга"""
+        link = cls._links.get(name)
+        if link is None:
+            link = cls._links[name] = cls(model)
+        elif model is not None:
+            link.model = model
+            link.rng = random.Random(model.seed)
+        return link
+
+    def attach(self, mode: str, transport: 'LoopbackTransport'):
+        self.endpoints[mode] = transport
+        self.upload_locks.setdefault(mode, asyncio.Lock())
+
+    def detach(self, mode: str):
+        self.endpoints.pop(mode, None)
+
+    def outage(self, seconds: float):
+        """Обрыв канала на seconds: загрузки падают с ConnectionError"""
+        self.down_until = time.monotonic() + seconds
+
+    @property
+    def is_down(self) -> bool:
+        return time.monotonic() < self.down_until
+
+    async def upload(self, mode: str, payload: bytes):
+        """Эмулирует send_file: ожидание FloodWait, загрузку и доставку пиру"""
+        m = self.model
+        if self.is_down:
+            raise ConnectionError("loopback link is down")
+        async with self.upload_locks[mode]:
+            if m.flood_wait_probability and self.rng.random() < m.flood_wait_probability:
+                self.stats['flood_waits'] += 1
+                await asyncio.sleep(m.flood_wait)
+
+            upload_time = m.upload_overhead
+            if m.upload_bandwidth:
+                upload_time += len(payload) / m.upload_bandwidth
+            if upload_time > 0:
+                await asyncio.sleep(upload_time)
+
+        self.stats['messages'] += 1
+        self.stats['bytes'] += len(payload)
+
+        if m.loss and self.rng.random() < m.loss:
+            self.stats['lost'] += 1
+            return
+
+        delay = m.latency + (self.rng.random() * m.jitter if m.jitter else 0.0)
+        if m.reorder and self.rng.random() < m.reorder:
+            self.stats['reordered'] += 1
+            delay += m.reorder_delay
+
+        peer_mode = 'server' if mode == 'client' else 'client'
+        self.in_transit += 1
+        asyncio.get_running_loop().call_later(delay, self._deliver, peer_mode, payload)
+
+    def _deliver(self, mode: str, payload: bytes):
+        self.in_transit -= 1
+        peer = self.endpoints.get(mode)
+        if peer and peer.is_connected:
+            peer.inbox.put_nowait(payload)
+
+
+class LoopbackTransport(BaseTransport):
+    """
+    Транспорт без мессенджера: клиентский и серверный PacketHandler
+    в одном процессе, соединённые через LoopbackLink.
+
+    Шифрование, сжатие и пакетирование работают как в боевых транспортах,
+    поэтому их изменения можно мерить без реальных аккаунтов.
+    """
+
+    def __init__(self, link: Optional[LoopbackLink] = None, encryption_key: Optional[str] = None):
+        super().__init__(encryption_key)
+        self.link = link or LoopbackLink.get()
+        self.mode = None
+        # Доставленные сообщения ждут здесь, как на сервере мессенджера
+        self.inbox = asyncio.Queue()
+        self.receiver_task = None
+
+    async def initialize(self, receive_callback: Callable, mode: str = 'server'):
+        self.receive_callback = receive_callback
+        self.mode = mode
+        self.link.attach(mode, self)
+        self.is_connected = True
+        self.sender_task = asyncio.create_task(self._batch_sender_worker())
+        self.receiver_task = asyncio.create_task(self._receiver_worker())
+        print(f"🔁 Loopback transport ready ({mode.upper()})")
+        return True
+
+    async def _send_batch_task(self, batch: BatchBuffer):
+        try:
+            batch = await self._encode_batch_async(batch)
+            start = time.perf_counter()
+            # Канал хранит сообщение у себя, как сервер мессенджера: копия здесь — это "сеть"
+            await self.link.upload(self.mode, batch.sealed.tobytes())
+            metrics.upload_seconds.time(start)
+            metrics.upload_bytes.inc(len(batch.sealed))
+            self._batch_uploaded(batch)
+        except Exception as e:
+            if not self._upload_failed(batch, e):
+                print(f"⚠️ Send Error: {e}")
+            return
+        self._release_batch(batch)
+
+    async def _reconnect(self) -> bool:
+        if self.link.is_down: return False
+        self.link.attach(self.mode, self)
+        return True
+
+    async def _receiver_worker(self):
+        while self.is_connected:
+            await self.download_pool.submit(await self.inbox.get())
+
+    async def _download_task(self, encrypted_data: bytes):
+        try:
+            batch_data = await self._decode_batch_async(encrypted_data)
+        except Exception:
+            print("⚠️ Batch decode failed")
+            return
+        await self._parse_batch_and_route(batch_data)
+
+    async def disconnect(self):
+        await super().disconnect()
+        if self.receiver_task: self.receiver_task.cancel()
+        if self.mode: self.link.detach(self.mode)
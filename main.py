@@ -5,26 +5,43 @@ import signal
 import sys
 import logging
 
-try:
+import transport_registry
+from config import config
+
+if config.handler_type == 'proxy':
     from proxy_handler import ProxyHandler as CurrentHandler
     HANDLER_TYPE = "PROXY"
-except ImportError:
+else:
     from packet_handler import PacketHandler as CurrentHandler
     HANDLER_TYPE = "VPN"
 
-from config import config
+from metrics import metrics, MetricsServer
+from control_server import ControlServer
+from profiler import StageProfiler
+from base_transport import BaseTransport
+from data_plane import DataPlane
 
 logger = logging.getLogger("VPN_Core")
 logger.setLevel(logging.INFO)
 
 
 class VPNApplication:
-    def __init__(self):
+    def __init__(self, daemon: bool = False, profile: bool = False):
         self.handler = CurrentHandler()
+        # Без GUI: управляющий сокет и остановка по SIGTERM
+        self.daemon = daemon
+        # --profile: замеры стадий (profiler.py); profile_capture — аргументы start_capture
+        self.profiler = StageProfiler() if profile else None
+        self.profile_capture = None
+        # Процессы сжатия и шифрования (data_plane.py), если config.data_plane_workers > 0
+        self.data_plane = None
+        self.control_server = None
         self.is_running = False
         self.mode = None
         self.traffic_started = False
         self.traffic_callback = None
+        self.traffic_pipeline = None
+        self.metrics_server = None
 
         self.auth_phone_callback = None
         self.auth_code_callback = None
@@ -51,40 +68,68 @@ class VPNApplication:
                 t.captcha_callback = self.auth_code_callback
                 t.two_factor_callback = self.auth_code_callback # <--- ВАЖНОЕ ДОБАВЛЕНИЕ
 
+        if config.data_plane_workers > 0 and self.data_plane is None:
+            self.data_plane = DataPlane(config.data_plane_workers)
+            self.data_plane.start()
+            BaseTransport.data_plane = self.data_plane
+
         success = await self.handler.initialize(mode)
         if not success:
             logger.error("❌ Ошибка инициализации Handler")
             return False
 
-        # Хуки трафика
-        if mode == 'client':
-            orig = self.handler._handle_tap_packet
-
-            async def wrapped(pkt):
-                await orig(pkt)
-                if not self.traffic_started and not self.handler._is_garbage(pkt):
-                    self.traffic_started = True
-                    if self.traffic_callback: self.traffic_callback()
-
-            self.handler._handle_tap_packet = wrapped
-
-        elif mode == 'server':
-            t = self.handler.transport
-            orig_recv = t.receive_callback
-
-            async def wrapped_recv(pkt):
-                if orig_recv: await orig_recv(pkt)
-                if not self.traffic_started:
-                    self.traffic_started = True
-                    if self.traffic_callback: self.traffic_callback()
-
-            t.receive_callback = wrapped_recv
+        # Начало трафика — разовая стадия батча: клиент VPN смотрит на отправленные
+        # из TAP пакеты, сервер и режим прокси — на принятые из туннеля
+        if mode == 'client' and HANDLER_TYPE == "VPN":
+            self.traffic_pipeline = self.handler.ingress
+        else:
+            self.traffic_pipeline = self.handler.egress
+        if not self.traffic_started:
+            self.traffic_pipeline.add_batch('traffic_start', self._on_traffic_batch)
+
+        if self.profiler:
+            self.profiler.instrument(self.handler, mode)
+            if self.profile_capture:
+                self.profiler.start_capture(**self.profile_capture)
+            print("📊 Stage profiling on: report on shutdown" +
+                  (", SIGUSR1" if hasattr(signal, 'SIGUSR1') else '') + ", control command 'profile'")
+
+        if config.metrics_port:
+            self.metrics_server = MetricsServer(metrics, port=config.metrics_port)
+            try:
+                await self.metrics_server.start()
+            except OSError as e:
+                logger.warning(f"⚠️ Metrics endpoint disabled: {e}")
+                self.metrics_server = None
+
+        if self.daemon:
+            self.control_server = ControlServer(self)
+            try:
+                await self.control_server.start()
+            except OSError as e:
+                logger.warning(f"⚠️ Control socket disabled: {e}")
+                self.control_server = None
 
         self.is_running = True
+        transport_registry.print_startup_report()
         return True
 
+    def _on_traffic_batch(self, packets: int, nbytes: int):
+        if not packets: return  # батч из одних служебных кадров
+        self.traffic_started = True
+        self.traffic_pipeline.remove('traffic_start')
+        if self.traffic_callback: self.traffic_callback()
+
     async def run_async(self, mode: str):
         if not await self.initialize(mode): return
+        if self.daemon and sys.platform != 'win32':
+            loop = asyncio.get_running_loop()
+            task = asyncio.current_task()
+            for sig in (signal.SIGTERM, signal.SIGINT):
+                loop.add_signal_handler(sig, task.cancel)
+        if self.profiler and hasattr(signal, 'SIGUSR1'):
+            asyncio.get_running_loop().add_signal_handler(
+                signal.SIGUSR1, lambda: print(self.profiler.format_report()))
         try:
             await self.handler.start_reading_packets()
         except asyncio.CancelledError:
@@ -96,8 +141,20 @@ class VPNApplication:
 
     async def shutdown(self):
         logger.info("🛑 Остановка...")
+        if self.metrics_server:
+            await self.metrics_server.stop()
+            self.metrics_server = None
+        if self.control_server:
+            await self.control_server.stop()
+            self.control_server = None
         if hasattr(self.handler, 'shutdown'):
             await self.handler.shutdown()
+        if self.data_plane:
+            BaseTransport.data_plane = None
+            await self.data_plane.stop()
+            self.data_plane = None
+        if self.profiler:
+            print(self.profiler.format_report())
 
 
 if __name__ == "__main__":
@@ -107,9 +164,28 @@ if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument('mode', nargs='?', choices=['server', 'client'])
+    parser.add_argument('--daemon', action='store_true',
+                        help="headless: control socket (see control_server.py), stop on SIGTERM")
+    parser.add_argument('--profile', action='store_true',
+                        help="time every hot-path stage; report on shutdown / SIGUSR1 / control 'profile'")
+    parser.add_argument('--profile-capture', type=float, metavar='SECONDS',
+                        help="also run cProfile (or --profile-sampler) for this window; implies --profile")
+    parser.add_argument('--profile-delay', type=float, default=0.0, metavar='SECONDS',
+                        help="start the capture window this long after startup")
+    parser.add_argument('--profile-sampler', action='store_true',
+                        help="sample the event loop stack instead of cProfile (much cheaper)")
+    parser.add_argument('--profile-output', metavar='PATH',
+                        help="cProfile stats file (pstats) or sampler text report, e.g. televpn.prof")
+    parser.add_argument('--data-plane', type=int, metavar='N',
+                        help="N gzip/GOST worker processes per direction (overrides data_plane_workers, 0 = off)")
     args = parser.parse_args()
+    if args.data_plane is not None:
+        config.data_plane_workers = args.data_plane
 
-    app = VPNApplication()
+    app = VPNApplication(daemon=args.daemon, profile=args.profile or bool(args.profile_capture))
+    if args.profile_capture:
+        app.profile_capture = {'seconds': args.profile_capture, 'sampler': args.profile_sampler,
+                               'path': args.profile_output, 'delay': args.profile_delay}
     signal.signal(signal.SIGINT, lambda s, f: asyncio.create_task(app.shutdown()))
 
     if args.mode:
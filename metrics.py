@@ -0,0 +1,264 @@
+# --- START OF FILE metrics.py ---
+import asyncio
+import time
+from array import array
+from bisect import bisect_left
+from typing import Callable, Dict, Optional, Sequence
+
+# Границы корзин гистограмм по умолчанию
+SECONDS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+BYTES_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+COUNT_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 4096)
+
+
+class Counter:
+    """Монотонный счётчик. inc() — одно сложение, без блокировок"""
+    __slots__ = ('name', 'help', 'value')
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Gauge:
+    """Текущее значение: задаётся set() или вычисляется функцией при чтении"""
+    __slots__ = ('name', 'help', '_value', 'fn')
+    kind = 'gauge'
+
+    def __init__(self, name: str, help: str, fn: Optional[Callable[[], float]] = None):
+        self.name = name
+        self.help = help
+        self._value = 0
+        self.fn = fn
+
+    def set(self, value):
+        self._value = value
+
+    @property
+    def value(self):
+        if self.fn is None:
+            return self._value
+        try:
+            return self.fn()
+        except Exception:
+            return 0
+
+
+class Histogram:
+    """
+    Гистограмма с фиксированными корзинами. Массив счётчиков выделяется
+    один раз, observe() — bisect и инкремент элемента array.
+    """
+    __slots__ = ('name', 'help', 'bounds', 'counts', 'sum', 'count')
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, bounds: Sequence[float] = SECONDS_BUCKETS):
+        self.name = name
+        self.help = help
+        self.bounds = tuple(bounds)
+        self.counts = array('Q', bytes(8 * (len(self.bounds) + 1)))
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self, start: float):
+        """observe(perf_counter() - start): удобно для замеров стадий"""
+        self.observe(time.perf_counter() - start)
+
+    def quantile(self, q: float) -> float:
+        """Оценка квантиля линейной интерполяцией внутри корзины"""
+        if not self.count: return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for i, c in enumerate(self.counts):
+            if cumulative + c >= rank and c:
+                if i >= len(self.bounds):
+                    return self.bounds[-1]
+                lower = self.bounds[i - 1] if i else 0.0
+                return lower + (self.bounds[i] - lower) * (rank - cumulative) / c
+            cumulative += c
+        return self.bounds[-1]
+
+    @property
+    def mean(self) -> float:
+        return self.sum / self.count if self.count else 0.0
+
+
+class MetricsRegistry:
+    """Реестр метрик процесса: выдача в формате Prometheus и снимок для GUI"""
+
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+
+    def _register(self, metric):
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            return existing
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str = '') -> Counter:
+        return self._register(Counter(name, help))
+
+    def gauge(self, name: str, help: str = '', fn: Optional[Callable[[], float]] = None) -> Gauge:
+        gauge = self._register(Gauge(name, help))
+        if fn is not None:
+            gauge.fn = fn
+        return gauge
+
+    def histogram(self, name: str, help: str = '', bounds: Sequence[float] = SECONDS_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, bounds))
+
+    def get(self, name: str):
+        return self._metrics.get(name)
+
+    def render(self) -> str:
+        """Текстовый формат экспозиции Prometheus (0.0.4)"""
+        lines = []
+        for m in self._metrics.values():
+            if m.help:
+                lines.append(f"# HELP {m.name} {m.help}")
+            lines.append(f"# TYPE {m.name} {m.kind}")
+            if m.kind == 'histogram':
+                cumulative = 0
+                for bound, c in zip(m.bounds, m.counts):
+                    cumulative += c
+                    lines.append(f'{m.name}_bucket{{le="{bound}"}} {cumulative}')
+                lines.append(f'{m.name}_bucket{{le="+Inf"}} {m.count}')
+                lines.append(f"{m.name}_sum {m.sum}")
+                lines.append(f"{m.name}_count {m.count}")
+            else:
+                lines.append(f"{m.name} {m.value}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict:
+        """Плоский словарь для GUI и управляющего API"""
+        snap = {}
+        for name, m in self._metrics.items():
+            if m.kind == 'histogram':
+                snap[name] = {'count': m.count, 'sum': m.sum, 'mean': m.mean,
+                              'p50': m.quantile(0.5), 'p99': m.quantile(0.99)}
+            else:
+                snap[name] = m.value
+        return snap
+
+
+class TunnelMetrics(MetricsRegistry):
+    """Стандартный набор метрик туннеля. Атрибуты используются на горячем пути"""
+
+    def __init__(self):
+        super().__init__()
+        # TAP
+        self.tap_rx_packets = self.counter('televpn_tap_rx_packets_total', 'Frames read from the TAP device')
+        self.tap_rx_bytes = self.counter('televpn_tap_rx_bytes_total', 'Bytes read from the TAP device')
+        self.tap_tx_packets = self.counter('televpn_tap_tx_packets_total', 'Frames written to the TAP device')
+        self.tap_tx_bytes = self.counter('televpn_tap_tx_bytes_total', 'Bytes written to the TAP device')
+        # Пакетирование
+        self.filter_dropped = self.counter('televpn_filter_dropped_total', 'TAP frames dropped by the packet filter')
+        self.bypass_dropped = self.counter('televpn_bypass_dropped_total', 'Client TAP packets to bypass prefixes dropped before upload')
+        self.unroutable_dropped = self.counter('televpn_unroutable_dropped_total', 'Server TAP packets with no client for the destination IP')
+        self.spoofed_dropped = self.counter('televpn_spoofed_dropped_total', 'Client packets with a source IP not assigned to that client')
+        self.tcp_retransmits_suppressed = self.counter('televpn_tcp_retransmits_suppressed_total', 'Duplicate TCP segments not uploaded')
+        self.tcp_retransmit_bytes_suppressed = self.counter('televpn_tcp_retransmit_bytes_suppressed_total', 'Bytes of duplicate TCP segments not uploaded')
+        self.dns_queries = self.counter('televpn_dns_queries_total', 'DNS queries received by the client forwarder')
+        self.dns_cache_hits = self.counter('televpn_dns_cache_hits_total', 'DNS queries answered from a fresh cache entry')
+        self.dns_negative_hits = self.counter('televpn_dns_negative_hits_total', 'DNS cache hits on NXDOMAIN / no-data entries')
+        self.dns_stale_served = self.counter('televpn_dns_stale_served_total', 'Expired DNS entries served while refreshing')
+        self.dns_prefetches = self.counter('televpn_dns_prefetches_total', 'Popular DNS names refreshed before expiry')
+        self.dns_tunnel_queries = self.counter('televpn_dns_tunnel_queries_total', 'DNS queries sent through the tunnel')
+        self.dns_tunnel_failures = self.counter('televpn_dns_tunnel_failures_total', 'DNS queries with no answer within dns_timeout')
+        self.dns_tunnel_seconds = self.histogram('televpn_dns_tunnel_seconds', 'DNS round trip through the tunnel')
+        self.proxy_streams = self.counter('televpn_proxy_streams_total', 'Proxy streams opened')
+        self.proxy_open_failures = self.counter('televpn_proxy_open_failures_total', 'Proxy streams the server could not connect')
+        self.proxy_resets = self.counter('televpn_proxy_resets_total', 'Proxy streams reset')
+        self.proxy_retransmits = self.counter('televpn_proxy_retransmits_total', 'Proxy DATA/CLOSE frames resent after RTO')
+        self.proxy_bytes_sent = self.counter('televpn_proxy_bytes_sent_total', 'Stream bytes read from local sockets and sent to the peer')
+        self.proxy_bytes_received = self.counter('televpn_proxy_bytes_received_total', 'Stream bytes from the peer written to local sockets')
+        self.wan_chunks_sent = self.counter('televpn_wan_chunks_sent_total', 'Chunks sent in full by the WAN optimizer')
+        self.wan_chunk_hits = self.counter('televpn_wan_chunk_hits_total', 'Chunks replaced with references to the peer chunk store')
+        self.wan_bytes_saved = self.counter('televpn_wan_bytes_saved_total', 'Batch bytes saved by chunk references')
+        self.wan_hit_ratio = self.gauge('televpn_wan_hit_ratio', 'Share of chunks sent as references',
+                                        lambda: self.wan_chunk_hits.value / max(1, self.wan_chunk_hits.value + self.wan_chunks_sent.value))
+        self.wan_misses = self.counter('televpn_wan_misses_total', 'References to chunks missing from the local store')
+        self.wan_dropped_packets = self.counter('televpn_wan_dropped_packets_total', 'Received packets dropped because of missing chunks')
+        self.wan_resyncs = self.counter('televpn_wan_resyncs_total', 'Chunk store resets requested by the peer')
+        self.mss_clamped = self.counter('televpn_mss_clamped_total', 'SYN / SYN-ACK packets with the TCP MSS option lowered')
+        self.queue_dropped = self.counter('televpn_send_queue_dropped_total', 'Packets dropped on send queue overflow')
+        self.batches_sent = self.counter('televpn_batches_sent_total', 'Batches handed to the transport')
+        self.batch_bytes = self.histogram('televpn_batch_bytes', 'Raw batch size, bytes', BYTES_BUCKETS)
+        self.batch_packets = self.histogram('televpn_batch_packets', 'Packets per batch', COUNT_BUCKETS)
+        # Криптография
+        self.encrypt_seconds = self.histogram('televpn_encrypt_seconds', 'Batch encryption time')
+        self.decrypt_seconds = self.histogram('televpn_decrypt_seconds', 'Batch decryption time')
+        self.data_plane_jobs = self.counter('televpn_data_plane_jobs_total', 'Batches sealed or opened by data plane worker processes')
+        self.data_plane_fallbacks = self.counter('televpn_data_plane_fallbacks_total', 'Batches processed in the main process with the data plane on')
+        self.data_plane_restarts = self.counter('televpn_data_plane_restarts_total', 'Data plane worker processes restarted after exiting')
+        # Мессенджер
+        self.upload_bytes = self.counter('televpn_upload_bytes_total', 'Encrypted bytes uploaded to the messenger')
+        self.upload_errors = self.counter('televpn_upload_errors_total', 'Failed batch uploads')
+        self.upload_seconds = self.histogram('televpn_upload_seconds', 'Batch upload time')
+        self.reconnects = self.counter('televpn_reconnects_total', 'Transport reconnects after a lost connection')
+        self.reconnect_seconds = self.histogram('televpn_reconnect_seconds', 'Time from connection loss to reconnect')
+        self.reconnect_dropped_bytes = self.counter('televpn_reconnect_dropped_bytes_total', 'Batch bytes dropped over reconnect_buffer_bytes')
+        self.download_bytes = self.counter('televpn_download_bytes_total', 'Encrypted bytes downloaded from the messenger')
+        self.download_seconds = self.histogram('televpn_download_seconds', 'Batch download time')
+        self.vk_inbox_dropped = self.counter('televpn_vk_inbox_dropped_total', 'VK messages dropped because a session inbox was full')
+        self.batches_received = self.counter('televpn_batches_received_total', 'Batches decoded successfully')
+        self.decode_errors = self.counter('televpn_decode_errors_total', 'Batches that failed to decrypt/decompress')
+        # RTT туннеля по эхо-пробам (control_frames.py)
+        self.tunnel_rtt_seconds = self.histogram('televpn_tunnel_rtt_seconds', 'Tunnel round-trip time samples')
+        self.tunnel_srtt = self.gauge('televpn_tunnel_srtt_seconds', 'Smoothed tunnel RTT')
+        self.tunnel_rtt_jitter = self.gauge('televpn_tunnel_rtt_jitter_seconds', 'Tunnel RTT variation (rttvar)')
+
+
+class MetricsServer:
+    """HTTP /metrics на localhost (asyncio, без зависимостей)"""
+
+    def __init__(self, registry: MetricsRegistry, host: str = '127.0.0.1', port: int = 9464):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        print(f"📈 Metrics: http://{self.host}:{self.port}/metrics")
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), timeout=5)
+            while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request.decode('latin-1').split()
+            if len(parts) >= 2 and parts[1].split('?')[0] in ('/metrics', '/'):
+                body = self.registry.render().encode()
+                status = '200 OK'
+            else:
+                body = b'not found\n'
+                status = '404 Not Found'
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except Exception:
+            pass
+        finally:
+            writer.close()
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+
+# Глобальный реестр (как config и network_manager)
+metrics = TunnelMetrics()
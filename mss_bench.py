@@ -0,0 +1,111 @@
+# --- START OF FILE mss_bench.py ---
+"""
+Стоимость ограничения MSS на пакет.
+
+Три случая: обычный пакет (только проверка is_syn — так проходит почти
+весь трафик), SYN с переписыванием MSS и поправкой суммы по RFC 1624, и
+для сравнения тот же SYN с полным пересчётом контрольной суммы TCP.
+Переписанные SYN проверяются полным пересчётом. Результат — JSON,
+нс на пакет.
+
+Примеры:
+    python mss_bench.py
+    python mss_bench.py --packets 200000 --mss 1360 --output mss.json
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+
+from mss_clamp import MssClamp
+
+
+def checksum(data: bytes) -> int:
+    if len(data) & 1:
+        data += b'\x00'
+    s = sum(int.from_bytes(data[i:i + 2], 'big') for i in range(0, len(data), 2))
+    while s >> 16:
+        s = (s & 0xFFFF) + (s >> 16)
+    return ~s & 0xFFFF
+
+
+def tcp_checksum(packet: bytes) -> int:
+    ihl = (packet[0] & 0x0F) * 4
+    segment = bytearray(packet[ihl:])
+    segment[16:18] = b'\x00\x00'
+    pseudo = packet[12:20] + b'\x00\x06' + len(segment).to_bytes(2, 'big')
+    return checksum(pseudo + bytes(segment))
+
+
+def build_packet(flags: int, options: bytes, payload: bytes = b'') -> bytes:
+    tcp_len = 20 + len(options)
+    total = 20 + tcp_len + len(payload)
+    ip = bytes((0x45, 0)) + total.to_bytes(2, 'big') + bytes((0, 1, 0x40, 0, 64, 6, 0, 0)) + \
+        bytes((10, 8, 0, 2, 93, 184, 216, 34))
+    tcp = bytearray((0xC3, 0x50, 0, 80) + (0, 0, 0, 1) + (0, 0, 0, 0) +
+                    ((tcp_len // 4) << 4, flags) + (0xFF, 0xFF) + (0, 0, 0, 0)) + options + payload
+    packet = bytearray(ip + tcp)
+    packet[36:38] = tcp_checksum(bytes(packet)).to_bytes(2, 'big')
+    return bytes(packet)
+
+
+# MSS 1460 + SACK + timestamps + window scale (как у Linux); второй вариант — MSS на нечётном смещении
+SYN_OPTIONS = b'\x02\x04\x05\xb4\x04\x02\x08\x0a\x00\x00\x00\x01\x00\x00\x00\x00\x01\x03\x03\x07'
+SYN_OPTIONS_ODD = b'\x01\x02\x04\x05\xb4\x01\x01\x01'
+
+
+def measure(fn, packets) -> float:
+    start = time.perf_counter_ns()
+    for p in packets:
+        fn(p)
+    return (time.perf_counter_ns() - start) / len(packets)
+
+
+def run(args) -> dict:
+    clamp = MssClamp(args.mss)
+    data = [build_packet(0x10, b'', bytes(args.payload)) for _ in range(args.packets)]
+    syns = [bytearray(build_packet(0x02, SYN_OPTIONS if i & 1 else SYN_OPTIONS_ODD)) for i in range(args.packets)]
+    full = [bytearray(p) for p in syns]
+
+    def full_recompute(p: bytearray):
+        clamp.clamp(p)
+        p[36:38] = tcp_checksum(bytes(p)).to_bytes(2, 'big')
+
+    result = {'meta': {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+                       'platform': platform.platform()},
+              'params': {'packets': args.packets, 'mss': args.mss, 'payload': args.payload},
+              'ns_per_packet': {
+                  'data_packet_check': round(measure(MssClamp.is_syn, data), 1),
+                  'syn_incremental': round(measure(clamp.clamp, syns), 1),
+                  'syn_full_recompute': round(measure(full_recompute, full), 1),
+              }}
+    ok = all(int.from_bytes(p[36:38], 'big') == tcp_checksum(bytes(p)) and
+             int.from_bytes(p[42:44] if p[40] == 2 else p[43:45], 'big') == args.mss for p in syns)
+    result['checksums_valid'] = ok
+    for name, ns in result['ns_per_packet'].items():
+        print(f"📏 {name}: {ns:.0f} ns/packet")
+    print("✅ checksums valid" if ok else "❌ checksum mismatch")
+    return result
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Per-packet cost of TCP MSS clamping")
+    p.add_argument('--packets', type=int, default=50000)
+    p.add_argument('--mss', type=int, default=1360)
+    p.add_argument('--payload', type=int, default=1200, help="payload of non-SYN packets, bytes")
+    p.add_argument('--output', help="write JSON report here instead of stdout")
+    return p.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    json_out = sys.stdout
+    sys.stdout = sys.stderr
+    report = run(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+    else:
+        json_out.write(text + "\n")
@@ -0,0 +1,106 @@
+# --- START OF FILE mss_clamp.py ---
+"""
+Ограничение MSS в SYN / SYN-ACK (MSS clamping).
+
+Стороны TCP объявляют MSS по MTU своих интерфейсов и не знают ни о TAP с
+уменьшенным MTU, ни о дополнительной инкапсуляции на пути сервера. Слишком
+большие сегменты режутся на фрагменты или теряются (PMTUD через туннель с
+RTT в секунды почти не работает). Поэтому опция MSS в SYN переписывается
+на min(объявленный, clamp). Контрольная сумма TCP не пересчитывается
+целиком, а поправляется на разницу одного слова (RFC 1624).
+"""
+from config import config
+
+TCP_SYN = 0x02
+OPT_END = 0
+OPT_NOP = 1
+OPT_MSS = 2
+IP_TCP_HEADERS = 40  # IPv4 + TCP без опций
+IPV6_EXTRA = 20      # заголовок IPv6 на 20 байт длиннее: MSS для него меньше
+
+
+def clamp_value() -> int:
+    """MSS по MTU туннеля минус заголовки и инкапсуляция на пути (config.mss_overhead)"""
+    return (config.mtu or 1500) - IP_TCP_HEADERS - config.mss_overhead
+
+
+def checksum_update(csum: int, old: int, new: int) -> int:
+    """HC' = ~(~HC + ~m + m') — RFC 1624, уравнение 3"""
+    s = (~csum & 0xFFFF) + (~old & 0xFFFF) + new
+    s = (s & 0xFFFF) + (s >> 16)
+    s = (s & 0xFFFF) + (s >> 16)
+    return ~s & 0xFFFF
+
+
+class MssClamp:
+    def __init__(self, mss: int):
+        self.mss = mss
+        self.syns = 0
+        self.clamped = 0
+
+    @staticmethod
+    def is_syn(packet, ip_off: int = 0) -> bool:
+        """
+        Быстрая проверка без разбора: TCP, флаг SYN; IPv4 — первый фрагмент,
+        IPv6 — TCP сразу за основным заголовком
+        """
+        if len(packet) < ip_off + 40:
+            return False
+        version = packet[ip_off] >> 4
+        if version == 6:
+            l4 = ip_off + 40
+            if packet[ip_off + 6] != 6:
+                return False
+        elif version == 4:
+            if packet[ip_off + 9] != 6 or (packet[ip_off + 6] & 0x1F) or packet[ip_off + 7]:
+                return False
+            l4 = ip_off + (packet[ip_off] & 0x0F) * 4
+        else:
+            return False
+        return len(packet) > l4 + 13 and bool(packet[l4 + 13] & TCP_SYN)
+
+    def clamp(self, packet: bytearray, ip_off: int = 0) -> bool:
+        """
+        Переписать MSS в SYN на месте. ip_off — начало IP-заголовка
+        (14 для кадра TAP). True — пакет изменён.
+        """
+        if not self.is_syn(packet, ip_off):
+            return False
+        self.syns += 1
+        if packet[ip_off] >> 4 == 6:
+            l4, limit = ip_off + 40, self.mss - IPV6_EXTRA
+        else:
+            l4, limit = ip_off + (packet[ip_off] & 0x0F) * 4, self.mss
+        end = min(len(packet), l4 + (packet[l4 + 12] >> 4) * 4)
+        i = l4 + 20
+        while i < end:
+            kind = packet[i]
+            if kind == OPT_END:
+                return False
+            if kind == OPT_NOP:
+                i += 1
+                continue
+            if i + 1 >= end or packet[i + 1] < 2:
+                return False  # битые опции не трогаем
+            if kind == OPT_MSS and packet[i + 1] == 4 and i + 4 <= end:
+                old = (packet[i + 2] << 8) | packet[i + 3]
+                if old <= limit:
+                    return False
+                new = limit
+                packet[i + 2] = new >> 8
+                packet[i + 3] = new & 0xFF
+                # Слово на нечётном смещении от начала TCP входит в сумму байтами наоборот
+                if (i + 2 - l4) & 1:
+                    old = ((old & 0xFF) << 8) | (old >> 8)
+                    new = ((new & 0xFF) << 8) | (new >> 8)
+                csum = (packet[l4 + 16] << 8) | packet[l4 + 17]
+                csum = checksum_update(csum, old, new)
+                packet[l4 + 16] = csum >> 8
+                packet[l4 + 17] = csum & 0xFF
+                self.clamped += 1
+                return True
+            i += packet[i + 1]
+        return False
+
+    def stats(self) -> dict:
+        return {'mss': self.mss, 'syns': self.syns, 'clamped': self.clamped}
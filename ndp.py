@@ -0,0 +1,44 @@
+# --- START OF FILE ndp.py ---
+"""
+Neighbor Discovery (RFC 4861) для TAP — аналог ответа на ARP.
+
+ОС ищет MAC следующего узла (адрес пира в туннеле) сообщением Neighbor
+Solicitation; за TAP никого нет, поэтому Neighbor Advertisement с MAC
+пира собирает обработчик пакетов.
+"""
+import socket
+import struct
+
+ICMPV6_NS = 135
+ICMPV6_NA = 136
+_NA_FLAGS = 0x60000000  # Solicited + Override
+_OPT_TARGET_LLADDR = 2
+
+
+def ip6_to_int(ip: str) -> int:
+    return int.from_bytes(socket.inet_pton(socket.AF_INET6, ip), 'big')
+
+
+def icmpv6_checksum(src: bytes, dst: bytes, message: bytes) -> int:
+    """Сумма по псевдозаголовку IPv6 (адреса, длина, next header 58) и сообщению"""
+    data = src + dst + struct.pack('!I3xB', len(message), 58) + message
+    if len(data) & 1:
+        data += b'\x00'
+    s = sum(struct.unpack(f'!{len(data) // 2}H', data))
+    while s >> 16:
+        s = (s & 0xFFFF) + (s >> 16)
+    return ~s & 0xFFFF
+
+
+def solicitation_target(frame, l4: int) -> bytes:
+    """Адрес, который ищет NS (кадр TAP, l4 — начало ICMPv6)"""
+    return bytes(frame[l4 + 8:l4 + 24])
+
+
+def neighbor_advertisement(mac: bytes, dst_mac: bytes, target: bytes, dst_ip: bytes) -> bytes:
+    """Кадр NA: target живёт на mac; отправитель — сам target, получатель — автор NS"""
+    body = bytearray(struct.pack('!BBHI', ICMPV6_NA, 0, 0, _NA_FLAGS) + target +
+                     bytes((_OPT_TARGET_LLADDR, 1)) + mac)
+    body[2:4] = icmpv6_checksum(target, dst_ip, bytes(body)).to_bytes(2, 'big')
+    ip = struct.pack('!IHBB', 6 << 28, len(body), 58, 255) + target + dst_ip
+    return dst_mac + mac + b'\x86\xdd' + ip + bytes(body)
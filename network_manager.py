@@ -1,11 +1,48 @@
 # --- START OF FILE network_manager.py ---
 import subprocess
 import asyncio
+import ipaddress
+import shutil
 import socket
+import sys
+import time
 from config import config
+from dns_cache import DnsCache
+from prefix_set import bypass_set
+
+# DNS адаптера, если DNS-форвардер клиента не запущен (запросы идут через туннель)
+DEFAULT_DNS = ('8.8.8.8', '1.1.1.1')
+
+
+def api_domains():
+    """Домены API, адреса которых должны идти мимо VPN"""
+    # Telegram домены
+    domains = ['api.telegram.org', 'telegram.org']
+
+    # VK домены (API, Загрузка, LongPoll)
+    if config.transport_type == 'vk':
+        domains.extend([
+            'api.vk.com', 'vk.com', 'im.vk.com', 'pu.vk.com', 'login.vk.com'
+        ])
+    return domains
+
+
+async def resolve_api_ips(dns: DnsCache, on_change=None):
+    """IP адреса Telegram и VK (/32) — из кэша сразу, устаревшие обновляются в фоне"""
+    async def changed(ips):
+        await on_change([f"{ip}/32" for ip in ips])
+
+    ips = await dns.get(api_domains(), changed if on_change else None)
+    return [f"{ip}/32" for ip in ips]
 
 
 class NetworkManager:
+    def __init__(self):
+        self.dns = DnsCache(ttl=config.dns_cache_ttl)
+        self.gateway = None
+        # Установленные исключения для API (для фонового обновления и очистки)
+        self.api_routes = []
+
     def _run_ps(self, cmd):
         full_cmd = f'powershell -NoProfile -ExecutionPolicy Bypass -Command "{cmd}"'
         try:
@@ -45,38 +82,30 @@ class NetworkManager:
         self._run_ps(
             f'New-NetFirewallRule -DisplayName "VPN_OUT" -Direction Outbound -InterfaceAlias "{interface_name}" -Action Allow -Enabled True')
 
-    def _resolve_api_ips(self):
-        """Резолвит IP адреса Telegram и VK для исключения из VPN"""
-        # Telegram домены
-        domains = ['api.telegram.org', 'telegram.org']
+    async def _on_api_ips_changed(self, routes):
+        """Фоновое обновление DNS: меняем только разницу маршрутов"""
+        if not self.gateway: return
+        added = [r for r in routes if r not in self.api_routes]
+        removed = [r for r in self.api_routes if r not in routes]
+        print(f"🔄 API addresses changed: +{len(added)} -{len(removed)} routes")
 
-        # VK домены (API, Загрузка, LongPoll)
-        if config.transport_type == 'vk':
-            domains.extend([
-                'api.vk.com', 'vk.com', 'im.vk.com', 'pu.vk.com', 'login.vk.com'
-            ])
+        def apply():
+            for subnet in added:
+                self._run_ps(f"route add {subnet} {self.gateway} metric 1")
+            for subnet in removed:
+                self._run_ps(f"route delete {subnet.split('/')[0]}")
 
-        ips = []
-        for d in domains:
-            try:
-                # Получаем все IP для домена (IPv4)
-                addr_info = socket.getaddrinfo(d, 443, family=socket.AF_INET, proto=socket.IPPROTO_TCP)
-                for res in addr_info:
-                    ip = res[4][0]
-                    if ip not in ips:
-                        ips.append(f"{ip}/32")
-                        print(f"🌍 Resolved {d} -> {ip}")
-            except:
-                pass
-        return list(set(ips))
-
-    async def setup_client_network(self, vpn_server_ip, interface_name):
+        await asyncio.get_running_loop().run_in_executor(None, apply)
+        self.api_routes = routes
+
+    async def setup_client_network(self, vpn_server_ip, interface_name, dns_servers=None):
         print(f"🌐 Setting up Client Routing on {interface_name}...")
 
         gw = self._get_default_gateway()
         if not gw:
             print("⚠️ ERROR: Default Gateway not found!")
             return
+        self.gateway = gw
 
         if_index = self._get_interface_index(interface_name)
         if not if_index:
@@ -86,8 +115,9 @@ class NetworkManager:
         self._set_mtu(if_index)
 
         # 1. Собираем все IP, которые НЕ должны идти через VPN
-        # ИСПРАВЛЕНИЕ: config.telegram_subnets уже содержит все диапазоны (и ТГ, и ВК)
-        routes_to_exclude = config.telegram_subnets + self._resolve_api_ips()
+        # Подсети ТГ/ВК и списки префиксов — слитые в минимальный набор маршрутов
+        self.api_routes = await resolve_api_ips(self.dns, self._on_api_ips_changed)
+        routes_to_exclude = bypass_set().to_cidrs() + self.api_routes
 
         print(f"🛡️ Excluding {len(routes_to_exclude)} routes (API & Subnets) from VPN...")
 
@@ -100,15 +130,50 @@ class NetworkManager:
         self._run_ps(f"route add 0.0.0.0 mask 128.0.0.0 {vpn_server_ip} metric 1 IF {if_index}")
         self._run_ps(f"route add 128.0.0.0 mask 128.0.0.0 {vpn_server_ip} metric 1 IF {if_index}")
 
+        if config.ipv6_enabled:
+            self._setup_client_ipv6(if_index)
+
         # DNS
-        self._run_ps(f"Set-DnsClientServerAddress -InterfaceIndex {if_index} -ServerAddresses ('8.8.8.8','1.1.1.1')")
+        servers = ','.join(f"'{s}'" for s in dns_servers or DEFAULT_DNS)
+        self._run_ps(f"Set-DnsClientServerAddress -InterfaceIndex {if_index} -ServerAddresses ({servers})")
         self._configure_firewall(interface_name)
 
+    def _get_default_gateway6(self):
+        """(следующий узел, индекс интерфейса) маршрута ::/0 или None"""
+        cmd = ("powershell -Command \"Get-NetRoute -DestinationPrefix '::/0' -ErrorAction SilentlyContinue | "
+               "Sort-Object RouteMetric | Select-Object -First 1 | ForEach-Object { $_.NextHop + ' ' + $_.ifIndex }\"")
+        try:
+            parts = subprocess.run(cmd, capture_output=True, text=True, shell=True).stdout.split()
+            if len(parts) == 2 and parts[0] != '::':
+                return parts[0], parts[1]
+        except Exception:
+            pass
+        return None
+
+    def _setup_client_ipv6(self, if_index):
+        # Set-IPAddress TAP снимает все адреса, поэтому IPv6 назначается здесь, после него
+        self._run_ps(f"New-NetIPAddress -InterfaceIndex {if_index} -IPAddress {config.client_ip6} "
+                     f"-PrefixLength {config.prefix6} -ErrorAction SilentlyContinue")
+        gw6 = self._get_default_gateway6()
+        if gw6:
+            for subnet in config.telegram_subnets6:
+                self._run_ps(f"New-NetRoute -DestinationPrefix {subnet} -InterfaceIndex {gw6[1]} "
+                             f"-NextHop {gw6[0]} -RouteMetric 1 -ErrorAction SilentlyContinue")
+        for prefix in ('::/1', '8000::/1'):
+            self._run_ps(f"New-NetRoute -DestinationPrefix {prefix} -InterfaceIndex {if_index} "
+                         f"-NextHop {config.server_ip6} -RouteMetric 1 -ErrorAction SilentlyContinue")
+
     async def setup_server_network(self, interface_name):
         print(f"🌐 Setting up Server NAT on {interface_name}...")
 
         if_index = self._get_interface_index(interface_name)
         if if_index: self._set_mtu(if_index)
+        if if_index and config.ipv6_enabled:
+            self._run_ps(f"New-NetIPAddress -InterfaceIndex {if_index} -IPAddress {config.server_ip6} "
+                         f"-PrefixLength {config.prefix6} -ErrorAction SilentlyContinue")
+            self._run_ps(f"Set-NetIPInterface -InterfaceIndex {if_index} -AddressFamily IPv6 -Forwarding Enabled")
+            # NetNat не умеет NAT66: префикс клиентов нужно маршрутизировать на этот сервер
+            print("⚠️ IPv6: no NAT66 on Windows, route the client prefix to this host")
 
         subprocess.run(
             r"reg add HKLM\SYSTEM\CurrentControlSet\Services\Tcpip\Parameters /v IPEnableRouter /t REG_DWORD /d 1 /f",
@@ -127,13 +192,235 @@ class NetworkManager:
         # Удаляем маршруты VPN
         self._run_ps("route delete 0.0.0.0 mask 128.0.0.0")
         self._run_ps("route delete 128.0.0.0 mask 128.0.0.0")
+        if config.ipv6_enabled:
+            for prefix in ['::/1', '8000::/1'] + config.telegram_subnets6:
+                self._run_ps(f"Remove-NetRoute -DestinationPrefix {prefix} -Confirm:$false -ErrorAction SilentlyContinue")
 
-        # Удаляем исключения для API
-        # ИСПРАВЛЕНИЕ: только telegram_subnets (там всё есть)
-        routes_to_cleanup = config.telegram_subnets + self._resolve_api_ips()
+        # Удаляем исключения для API: установленные или из кэша, без запросов DNS
+        self.dns.cancel()
+        api_routes = self.api_routes or [f"{ip}/32" for ip in self.dns.cached(api_domains())]
+        routes_to_cleanup = bypass_set().to_cidrs() + api_routes
+        self.api_routes = []
         for subnet in routes_to_cleanup:
             base_ip = subnet.split('/')[0]
             self._run_ps(f"route delete {base_ip}")
 
 
-network_manager = NetworkManager()
\ No newline at end of file
+class LinuxNetworkManager:
+    """
+    Linux: маршруты одним вызовом ``ip -batch``, NAT сервера — одним
+    атомарным набором правил ``nft -f``. API как у NetworkManager.
+    """
+
+    NFT_TABLE = 'televpn'
+
+    def __init__(self):
+        self.timings = []
+        self.dns = DnsCache(ttl=config.dns_cache_ttl)
+        self.gateway = None
+        # Что реально установлено — чтобы cleanup не резолвил домены заново
+        self.installed_routes = []
+        self.api_routes = []
+        self.nat_installed = False
+
+    async def _exec(self, *args, stdin: str = None):
+        """Запуск без shell; возвращает (код, stderr)"""
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *args, stdin=subprocess.PIPE if stdin is not None else subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        except FileNotFoundError:
+            return 127, f"{args[0]}: not found"
+        _, err = await proc.communicate(stdin.encode() if stdin is not None else None)
+        return proc.returncode, err.decode(errors='replace').strip()
+
+    async def _timed(self, step: str, coro):
+        start = time.perf_counter()
+        result = await coro
+        self.timings.append((step, time.perf_counter() - start))
+        return result
+
+    async def _ip_batch(self, commands, quiet: bool = False):
+        """Все команды ip за один процесс; -force — не останавливаться на ошибке"""
+        if not commands: return 0, ''
+        code, err = await self._timed(f"ip -batch ({len(commands)} cmds)",
+                                      self._exec('ip', '-force', '-batch', '-', stdin="\n".join(commands) + "\n"))
+        if code and err and not quiet:
+            print(f"⚠️ ip -batch: {err.splitlines()[0]}")
+        return code, err
+
+    def _get_default_gateway(self):
+        """Шлюз по умолчанию из /proc/net/route (без запуска процессов)"""
+        try:
+            with open('/proc/net/route') as f:
+                for line in f.readlines()[1:]:
+                    parts = line.split()
+                    if parts[1] == '00000000' and parts[7] == '00000000':
+                        gw = socket.inet_ntoa(int(parts[2], 16).to_bytes(4, 'little'))
+                        if not gw.startswith("10.8."):
+                            return gw
+        except Exception:
+            pass
+        return None
+
+    async def _on_api_ips_changed(self, routes):
+        """Фоновое обновление DNS: одна ip -batch с разницей маршрутов"""
+        if not self.gateway: return
+        added = [r for r in routes if r not in self.api_routes]
+        removed = [r for r in self.api_routes if r not in routes]
+        print(f"🔄 API addresses changed: +{len(added)} -{len(removed)} routes")
+        await self._ip_batch([f"route replace {r} via {self.gateway} metric 1" for r in added] +
+                             [f"route del {r}" for r in removed], quiet=True)
+        self.installed_routes = [r for r in self.installed_routes if r not in removed] + added
+        self.api_routes = routes
+        self.timings = []
+
+    def _report(self, title: str):
+        total = sum(t for _, t in self.timings)
+        steps = ", ".join(f"{name} {t * 1000:.0f}ms" for name, t in self.timings)
+        print(f"⏱️ {title}: {total * 1000:.0f}ms ({steps})")
+        self.timings = []
+
+    async def setup_client_network(self, vpn_server_ip, interface_name, dns_servers=None):
+        print(f"🌐 Setting up Client Routing on {interface_name}...")
+
+        gw = self._get_default_gateway()
+        if not gw:
+            print("⚠️ ERROR: Default Gateway not found!")
+            return
+
+        self.gateway = gw
+        self.api_routes = await self._timed("resolve", resolve_api_ips(self.dns, self._on_api_ips_changed))
+        routes_to_exclude = list(dict.fromkeys(bypass_set().to_cidrs() + self.api_routes))
+        print(f"🛡️ Excluding {len(routes_to_exclude)} routes (API & Subnets) from VPN...")
+
+        commands = [f"link set dev {interface_name} up"]
+        if config.mtu:
+            commands.append(f"link set dev {interface_name} mtu {config.mtu}")
+        commands += [f"route replace {subnet} via {gw} metric 1" for subnet in routes_to_exclude]
+        # Весь остальной трафик — в VPN (две половины перебивают дефолтный маршрут)
+        commands += [f"route replace 0.0.0.0/1 via {vpn_server_ip} dev {interface_name}",
+                     f"route replace 128.0.0.0/1 via {vpn_server_ip} dev {interface_name}"]
+        if config.ipv6_enabled:
+            commands += self._client_ipv6_commands(interface_name)
+            routes_to_exclude = routes_to_exclude + config.telegram_subnets6
+
+        tasks = [self._ip_batch(commands)]
+        if shutil.which('resolvectl'):
+            tasks.append(self._timed("resolvectl", self._exec('resolvectl', 'dns', interface_name, *(dns_servers or DEFAULT_DNS))))
+        await asyncio.gather(*tasks)
+
+        self.installed_routes = routes_to_exclude
+        self._report("Client network up")
+
+    def _get_default_gateway6(self):
+        """(следующий узел, интерфейс) маршрута ::/0 из /proc/net/ipv6_route"""
+        try:
+            with open('/proc/net/ipv6_route') as f:
+                for line in f:
+                    parts = line.split()
+                    if parts[0] == '0' * 32 and parts[1] == '00' and parts[4] != '0' * 32:
+                        return str(ipaddress.IPv6Address(int(parts[4], 16))), parts[9]
+        except Exception:
+            pass
+        return None
+
+    def _client_ipv6_commands(self, interface_name: str):
+        commands = [f"addr replace {config.client_ip6}/{config.prefix6} dev {interface_name} nodad"]
+        gw6 = self._get_default_gateway6()
+        for subnet in config.telegram_subnets6:
+            # Без своего IPv6 адреса мессенджеров недоступны — лишь бы не в туннель (петля)
+            commands.append(f"route replace {subnet} via {gw6[0]} dev {gw6[1]} metric 1" if gw6
+                            else f"route replace unreachable {subnet}")
+        commands += [f"route replace ::/1 via {config.server_ip6} dev {interface_name}",
+                     f"route replace 8000::/1 via {config.server_ip6} dev {interface_name}"]
+        return commands
+
+    def _nat_ruleset(self, interface_name: str) -> str:
+        # Пустая таблица + delete: правила заменяются целиком одной транзакцией
+        t = self.NFT_TABLE
+        return f"""table ip {t}
+delete table ip {t}
+table ip {t} {{
+    chain postrouting {{
+        type nat hook postrouting priority srcnat; policy accept;
+        ip saddr {config.subnet}/24 oifname != "{interface_name}" masquerade
+    }}
+    chain forward {{
+        type filter hook forward priority filter; policy accept;
+        iifname "{interface_name}" accept
+        oifname "{interface_name}" ct state established,related accept
+    }}
+}}
+""" + (self._nat6_ruleset(interface_name) if config.ipv6_enabled else '')
+
+    def _nat6_ruleset(self, interface_name: str) -> str:
+        t = self.NFT_TABLE
+        prefix = ipaddress.IPv6Network(f"{config.server_ip6}/{config.prefix6}", strict=False)
+        return f"""table ip6 {t}
+delete table ip6 {t}
+table ip6 {t} {{
+    chain postrouting {{
+        type nat hook postrouting priority srcnat; policy accept;
+        ip6 saddr {prefix} oifname != "{interface_name}" masquerade
+    }}
+    chain forward {{
+        type filter hook forward priority filter; policy accept;
+        iifname "{interface_name}" accept
+        oifname "{interface_name}" ct state established,related accept
+    }}
+}}
+"""
+
+    async def setup_server_network(self, interface_name):
+        print(f"🌐 Setting up Server NAT on {interface_name}...")
+
+        try:
+            with open('/proc/sys/net/ipv4/ip_forward', 'w') as f:
+                f.write('1')
+        except OSError as e:
+            print(f"⚠️ ip_forward: {e}")
+
+        commands = [f"link set dev {interface_name} up"]
+        if config.mtu:
+            commands.append(f"link set dev {interface_name} mtu {config.mtu}")
+        if config.ipv6_enabled:
+            try:
+                with open('/proc/sys/net/ipv6/conf/all/forwarding', 'w') as f:
+                    f.write('1')
+            except OSError as e:
+                print(f"⚠️ ipv6 forwarding: {e}")
+            commands.append(f"addr replace {config.server_ip6}/{config.prefix6} dev {interface_name} nodad")
+        (_, _), (code, err) = await asyncio.gather(
+            self._ip_batch(commands),
+            self._timed("nft -f", self._exec('nft', '-f', '-', stdin=self._nat_ruleset(interface_name))))
+        if code:
+            print(f"⚠️ nft: {err}")
+        else:
+            self.nat_installed = True
+            print("✅ Server NAT Configured")
+        self._report("Server network up")
+
+    async def cleanup(self, interface_name):
+        print("🧹 Cleaning up routes...")
+        self.dns.cancel()
+        routes = self.installed_routes or \
+            bypass_set().to_cidrs() + [f"{ip}/32" for ip in self.dns.cached(api_domains())]
+        commands = ["route del 0.0.0.0/1", "route del 128.0.0.0/1"] + [f"route del {subnet}" for subnet in routes]
+        tasks = [
+            # При очистке часть маршрутов может отсутствовать — это нормально
+            self._ip_batch(commands, quiet=True),
+            self._timed("nft delete", self._exec('nft', 'delete', 'table', 'ip', self.NFT_TABLE))]
+        if config.ipv6_enabled:
+            v6 = ["route del ::/1", "route del 8000::/1"]
+            if not self.installed_routes:
+                v6 += [f"route del {subnet}" for subnet in config.telegram_subnets6]
+            tasks += [self._ip_batch(v6, quiet=True), self._exec('nft', 'delete', 'table', 'ip6', self.NFT_TABLE)]
+        await asyncio.gather(*tasks)
+        self.installed_routes = []
+        self.api_routes = []
+        self.nat_installed = False
+        self._report("Cleanup")
+
+
+network_manager = LinuxNetworkManager() if sys.platform.startswith('linux') else NetworkManager()
\ No newline at end of file
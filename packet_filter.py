@@ -0,0 +1,271 @@
+# --- START OF FILE packet_filter.py ---
+"""
+Фильтр кадров TAP: декларативные правила -> целочисленные таблицы.
+
+Правило описывает условия (все должны совпасть) и действие. Правила
+проверяются по порядку, срабатывает первое совпавшее. При компиляции:
+    протоколы  -> bytearray(256) (1 — протокол подходит)
+    порты      -> bytearray(65536) битовая карта портов назначения
+    подсети    -> пары (сеть, маска) в int, отдельно для IPv4 и IPv6
+Кадр проверяется по уже разобранному PacketView (accept_view), пачка —
+classify_batch() по столбцам PacketBatch (векторно через NumPy, если он
+установлен).
+"""
+import socket
+import struct
+from array import array
+from dataclasses import dataclass
+from typing import List, Optional, Sequence, Tuple, Union
+
+from packet_view import PacketView, PacketBatch, ETH_IPV4, ETH_IPV6, ETH_ARP
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+ACCEPT = 'accept'
+DROP = 'drop'
+
+
+@dataclass
+class FilterRule:
+    name: str
+    action: str = DROP
+    # Пусто — правило для IPv4 и IPv6; иначе совпадает по EtherType.
+    # Правило с подсетями только одного семейства к другому не применяется
+    ethertypes: Tuple[int, ...] = ()
+    dst_cidrs: Tuple[str, ...] = ()
+    src_cidrs: Tuple[str, ...] = ()
+    protocols: Tuple[int, ...] = ()
+    # Порты назначения TCP/UDP: число или диапазон (от, до) включительно
+    dst_ports: Tuple[Union[int, Tuple[int, int]], ...] = ()
+    # Широковещание: адрес назначения на .255
+    broadcast: bool = False
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'FilterRule':
+        """Правило из config.json (списки -> кортежи)"""
+        kwargs = {k: tuple(tuple(p) if isinstance(p, list) else p for p in v) if isinstance(v, list) else v
+                  for k, v in data.items() if k in cls.__annotations__}
+        return cls(**kwargs)
+
+
+def default_rules() -> List[FilterRule]:
+    """Правила, повторяющие прежний PacketHandler._is_garbage, и то же для IPv6"""
+    return [
+        FilterRule('arp', ACCEPT, ethertypes=(ETH_ARP,)),
+        # Neighbor Solicitation идёт на solicited-node multicast — на него отвечает обработчик NDP
+        FilterRule('ndp', ACCEPT, ethertypes=(ETH_IPV6,), protocols=(58,), dst_cidrs=('ff02::1:ff00:0/104',)),
+        FilterRule('multicast_ff', ethertypes=(ETH_IPV6,), dst_cidrs=('ff00::/8',)),
+        FilterRule('link_local_fe80', ethertypes=(ETH_IPV6,), dst_cidrs=('fe80::/10',)),
+        FilterRule('blocked_ips', dst_cidrs=('255.255.255.255/32', '224.0.0.251/32',
+                                             '224.0.0.252/32', '239.255.255.250/32')),
+        FilterRule('multicast_224', dst_cidrs=('224.0.0.0/8',)),
+        FilterRule('broadcast', broadcast=True),
+        FilterRule('netbios_smb_ssdp_mdns_llmnr', protocols=(17,),
+                   dst_ports=(137, 138, 139, 445, 1900, 5353, 5355)),
+    ]
+
+
+def _parse_cidr(cidr: str) -> Tuple[int, int]:
+    addr, _, prefix = cidr.partition('/')
+    bits = int(prefix) if prefix else 32
+    mask = (0xFFFFFFFF << (32 - bits)) & 0xFFFFFFFF
+    return struct.unpack('!I', socket.inet_aton(addr))[0] & mask, mask
+
+
+def _parse_cidr6(cidr: str) -> Tuple[int, int]:
+    addr, _, prefix = cidr.partition('/')
+    bits = int(prefix) if prefix else 128
+    full = (1 << 128) - 1
+    mask = (full << (128 - bits)) & full
+    return int.from_bytes(socket.inet_pton(socket.AF_INET6, addr), 'big') & mask, mask
+
+
+def _split_cidrs(cidrs) -> Tuple[list, list]:
+    """Подсети IPv4 и IPv6 по отдельности"""
+    v4 = [_parse_cidr(c) for c in cidrs if ':' not in c]
+    v6 = [_parse_cidr6(c) for c in cidrs if ':' in c]
+    return v4, v6
+
+
+class _CompiledRule:
+    __slots__ = ('name', 'drop', 'ethertypes', 'dst_nets', 'src_nets', 'dst_nets6', 'src_nets6',
+                 'protocols', 'ports', 'broadcast', 'v4', 'v6')
+
+    def __init__(self, rule: FilterRule):
+        self.name = rule.name
+        self.drop = rule.action == DROP
+        self.ethertypes = frozenset(rule.ethertypes) if rule.ethertypes else frozenset((ETH_IPV4, ETH_IPV6))
+        self.dst_nets, self.dst_nets6 = _split_cidrs(rule.dst_cidrs)
+        self.src_nets, self.src_nets6 = _split_cidrs(rule.src_cidrs)
+        # Применимость к семействам: подсети заданы, но ни одной своего семейства — не совпадает
+        self.v4 = ETH_IPV4 in self.ethertypes and \
+            not (rule.dst_cidrs and not self.dst_nets) and not (rule.src_cidrs and not self.src_nets)
+        self.v6 = ETH_IPV6 in self.ethertypes and not rule.broadcast and \
+            not (rule.dst_cidrs and not self.dst_nets6) and not (rule.src_cidrs and not self.src_nets6)
+        self.protocols = None
+        if rule.protocols:
+            self.protocols = bytearray(256)
+            for p in rule.protocols: self.protocols[p] = 1
+        self.ports = None
+        if rule.dst_ports:
+            self.ports = bytearray(65536)
+            for p in rule.dst_ports:
+                lo, hi = (p, p) if isinstance(p, int) else p
+                self.ports[lo:hi + 1] = b'\x01' * (hi - lo + 1)
+        self.broadcast = rule.broadcast
+
+    @property
+    def ip_only(self) -> bool:
+        """Есть ли условия на заголовок IP (для не-IP кадров правило тогда не совпадает)"""
+        return bool(self.dst_nets or self.src_nets or self.dst_nets6 or self.src_nets6 or
+                    self.protocols or self.ports or self.broadcast)
+
+
+class PacketFilter:
+    """
+    Скомпилированный набор правил. accept(frame) — быстрая проверка одного
+    кадра, classify_batch(frames) — вердикты для пачки.
+    Счётчики срабатываний: hits[i] для правила i, default_hits — без совпадений.
+    """
+
+    def __init__(self, rules: Optional[Sequence[FilterRule]] = None,
+                 default_action: str = ACCEPT, non_ip_action: str = DROP):
+        self.rules = list(rules if rules is not None else default_rules())
+        self.default_drop = default_action == DROP
+        self.non_ip_drop = non_ip_action == DROP
+        self._compiled = [_CompiledRule(r) for r in self.rules]
+        # Плоские кортежи для classify(): отдельно для IPv4, IPv6 и прочих EtherType
+        self._ip = [(i, r.protocols, r.ports, r.broadcast, r.dst_nets, r.src_nets)
+                    for i, r in enumerate(self._compiled) if r.v4]
+        self._ip6 = [(i, r.protocols, r.ports, False, r.dst_nets6, r.src_nets6)
+                     for i, r in enumerate(self._compiled) if r.v6]
+        self._non_ip = [(i, r.ethertypes) for i, r in enumerate(self._compiled) if not r.ip_only]
+        self.hits = array('Q', bytes(8 * len(self._compiled)))
+        self.default_hits = 0
+        self.malformed = 0
+        self._np_tables = None
+
+    # --- Один кадр ---
+
+    def classify(self, view: PacketView) -> int:
+        """Индекс сработавшего правила; -1 — ни одно не совпало"""
+        ethertype = view.ethertype
+        if ethertype == ETH_IPV4:
+            rules = self._ip
+        elif ethertype == ETH_IPV6:
+            rules = self._ip6
+        else:
+            for i, ethertypes in self._non_ip:
+                if ethertype in ethertypes: return i
+            return -1
+
+        proto, dst, src, dport = view.protocol, view.dst, view.src, view.dport
+        for i, protocols, ports, broadcast, dst_nets, src_nets in rules:
+            if protocols is not None and not protocols[proto]: continue
+            if ports is not None and (dport < 0 or not ports[dport]): continue
+            if broadcast and (dst & 0xFF) != 0xFF: continue
+            if dst_nets:
+                for n, m in dst_nets:
+                    if dst & m == n: break
+                else:
+                    continue
+            if src_nets:
+                for n, m in src_nets:
+                    if src & m == n: break
+                else:
+                    continue
+            return i
+        return -1
+
+    def accept_view(self, view: PacketView) -> bool:
+        """True — кадр пропускаем. Обновляет счётчики"""
+        if view.malformed:
+            self.malformed += 1
+            return False
+        i = self.classify(view)
+        if i >= 0:
+            self.hits[i] += 1
+            return not self._compiled[i].drop
+        self.default_hits += 1
+        if not view.is_ip and self.non_ip_drop:
+            return False
+        return not self.default_drop
+
+    def accept(self, frame: bytes) -> bool:
+        return self.accept_view(PacketView(frame))
+
+    # --- Пачка кадров ---
+
+    def classify_batch(self, batch) -> List[bool]:
+        """
+        Вердикты (True — пропустить) для пачки: PacketBatch или список
+        кадров. Без NumPy — поштучно
+        """
+        if not isinstance(batch, PacketBatch):
+            batch = PacketBatch.from_frames(batch)
+        if np is None or len(batch) < 8:
+            return [self.accept_view(v) for v in batch]
+        return self._classify_numpy(batch).tolist()
+
+    def _tables(self):
+        if self._np_tables is None:
+            self._np_tables = [(
+                np.array(sorted(r.ethertypes), dtype=np.uint16),
+                None if r.protocols is None else np.frombuffer(bytes(r.protocols), dtype=np.bool_),
+                None if r.ports is None else np.frombuffer(bytes(r.ports), dtype=np.bool_),
+                np.array(r.dst_nets, dtype=np.uint32).reshape(-1, 2),
+                np.array(r.src_nets, dtype=np.uint32).reshape(-1, 2),
+            ) for r in self._compiled]
+        return self._np_tables
+
+    def _classify_numpy(self, batch: PacketBatch):
+        # Столбцы PacketBatch — array, frombuffer не копирует данные
+        n = len(batch)
+        ethertype = np.frombuffer(batch.ethertype, dtype=np.int32)
+        proto = np.frombuffer(batch.protocol, dtype=np.uint8)
+        src = np.frombuffer(batch.src, dtype=np.uint32)
+        dst = np.frombuffer(batch.dst, dtype=np.uint32)
+        dport = np.frombuffer(batch.dport, dtype=np.int32)
+        is_ip = ethertype == ETH_IPV4
+        has_port = dport >= 0
+        dport = np.where(has_port, dport, 0)
+
+        malformed = np.frombuffer(batch.malformed, dtype=np.bool_)
+        # IPv6 — поштучно ниже: 128-битные адреса в столбцы uint32 не ложатся
+        is_ip6 = ethertype == ETH_IPV6
+        undecided = ~malformed & ~is_ip6
+        verdict = np.zeros(n, dtype=np.bool_)
+
+        for i, (r, (eth, protos, ports, dst_nets, src_nets)) in enumerate(zip(self._compiled, self._tables())):
+            m = undecided & np.isin(ethertype, eth)
+            if r.ip_only:
+                if not r.v4: continue
+                m &= is_ip
+                if protos is not None: m &= protos[proto]
+                if ports is not None: m &= has_port & ports[dport]
+                if r.broadcast: m &= (dst & 0xFF) == 0xFF
+                if len(dst_nets): m &= ((dst[:, None] & dst_nets[:, 1]) == dst_nets[:, 0]).any(axis=1)
+                if len(src_nets): m &= ((src[:, None] & src_nets[:, 1]) == src_nets[:, 0]).any(axis=1)
+            hit = int(np.count_nonzero(m))
+            if hit:
+                self.hits[i] += hit
+                verdict[m] = not r.drop
+                undecided &= ~m
+
+        rest = int(np.count_nonzero(undecided))
+        self.default_hits += rest
+        self.malformed += int(np.count_nonzero(malformed))
+        verdict[undecided & is_ip] = not self.default_drop
+        verdict[undecided & ~is_ip] = not self.non_ip_drop
+        for i in np.flatnonzero(is_ip6 & ~malformed).tolist():
+            verdict[i] = self.accept_view(batch[i])
+        return verdict
+
+    def stats(self) -> dict:
+        out = {r.name: self.hits[i] for i, r in enumerate(self.rules)}
+        out['default'] = self.default_hits
+        out['malformed'] = self.malformed
+        return out
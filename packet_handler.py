@@ -1,40 +1,89 @@
 # --- START OF FILE packet_handler.py ---
 import asyncio
+import functools
 import socket
-import struct
+import sys
 from config import config
-from telegram_transport import TelegramBotTransport
-from vk_transport import VKTransport
-from real_tap_interface import RealTapInterface
+from transport_registry import create_transport, get_transport_class
+if sys.platform.startswith('linux'):
+    from linux_tap_interface import LinuxTapInterface as TapInterface
+else:
+    from real_tap_interface import RealTapInterface as TapInterface
 from network_manager import network_manager
+from packet_filter import PacketFilter, FilterRule, default_rules
+from packet_view import PacketView, ETH_IPV4, ETH_IPV6, ETH_ARP, PROTO_ICMPV6
+from metrics import metrics
+from client_table import ClientTable, ClientSession, ClientEntry
+from prefix_set import bypass_set
+from dns_forwarder import DnsForwarder, DnsRelay
+from mss_clamp import MssClamp, clamp_value
+from ndp import ICMPV6_NS, ip6_to_int, neighbor_advertisement, solicitation_target
+from pipeline import Pipeline
 
 
 class PacketHandler:
-    def __init__(self):
-        self.tap_interface = RealTapInterface()
+    def __init__(self, transport=None, tap_interface=None, network=None, clients=None):
+        # tap_interface / network подменяются в стенде замеров (benchmark.py),
+        # clients — список ClientEntry для многоклиентского сервера (по умолчанию из config)
+        self.tap_interface = tap_interface or TapInterface()
+        self.network = network or network_manager
 
-        # Выбор транспорта
-        if config.transport_type == 'vk':
-            self.transport = VKTransport()
+        # Выбор транспорта (можно передать готовый, например LoopbackTransport для замеров).
+        # Модуль транспорта (Telethon / vk_api) импортируется только здесь
+        if transport is not None:
+            self.transport = transport
         else:
-            self.transport = TelegramBotTransport()
+            self.transport = create_transport(config.transport_type)
 
         self.is_running = False
         self.mode = None
         self.my_mac = None
         self.peer_mac = b'\x02\x00\x00\x00\x00\x01'
-        self.blocked_ips = {'255.255.255.255', '224.0.0.251', '224.0.0.252', '239.255.255.250'}
-        self.blocked_ports = {137, 138, 139, 445, 1900, 5353, 5355}
+        # Правила из config.json проверяются раньше стандартных
+        rules = [FilterRule.from_dict(r) for r in config.filter_rules] + default_rules()
+        self.packet_filter = PacketFilter(rules)
+        # MSS в SYN / SYN-ACK обоих направлений (mss_clamp.py)
+        self.mss_clamp = MssClamp(clamp_value()) if config.mss_clamp else None
+        # IPv6 в туннеле только при заданных server_ip6 / client_ip6; адрес пира — для NDP
+        self.ipv6 = config.ipv6_enabled
+        self.peer_ip6 = 0
+        # Клиент: адреса, которые ОС должна была отправить мимо туннеля
+        self.bypass = bypass_set()
+
+        # Сервер: туннельный IP клиента -> его сессия (транспорт, счётчики)
+        self.clients = ClientTable()
+        self.client_entries = clients if clients is not None else \
+            [ClientEntry.from_dict(c) for c in config.clients]
+        # DNS: кэширующий форвардер клиента и ретрансляторы сервера (по одному на транспорт)
+        self.dns_forwarder = None
+        self.dns_relays = []
+        # Стадии TAP -> туннель и туннель -> TAP (pipeline.py), собираются в initialize
+        self.ingress = Pipeline('ingress')
+        self.egress = Pipeline('egress')
 
     async def initialize(self, mode: str):
         self.mode = mode
+        self._build_pipelines(mode)
+        if self.ipv6:
+            self.peer_ip6 = ip6_to_int(config.get_ip6_for_mode('client' if mode == 'server' else 'server'))
 
         print("🧹 Pre-start network cleanup...")
-        await network_manager.cleanup(config.tap_interface_name)
+        await self.network.cleanup(config.tap_interface_name)
         ip = config.get_ip_for_mode(mode)
 
-        if not await self.transport.initialize(self._handle_transport_packet, mode=mode):
-            return False
+        if mode == 'server':
+            metrics.gauge('televpn_clients', 'Client sessions on the server', fn=lambda: len(self.clients))
+        if mode == 'server' and self.client_entries:
+            if not await self._init_client_sessions():
+                return False
+        else:
+            self._attach(self.transport)
+            if not await self.transport.initialize(self._handle_transport_packet, mode=mode):
+                return False
+            if mode == 'server':
+                # Один клиент: весь обратный трафик идёт в единственный транспорт
+                self.clients.add(ClientSession(ClientEntry('default', config.client_ip), self.transport, ip=0))
+                await self._start_dns_relay(self.transport)
 
         if not self.tap_interface.find_tap_interface():
             return False
@@ -46,56 +95,196 @@ class PacketHandler:
         self.my_mac = self.tap_interface.get_mac_address() or b'\x00\xff\x00\xff\x00\xff'
 
         if mode == 'client':
-            await network_manager.setup_client_network(config.server_ip, self.tap_interface.interface_name)
+            dns_servers = None
+            if config.dns_forwarder and ip:
+                forwarder = DnsForwarder(self.transport)
+                if await forwarder.start(ip):
+                    self.dns_forwarder = forwarder
+                    dns_servers = [ip]
+            await self.network.setup_client_network(config.server_ip, self.tap_interface.interface_name, dns_servers)
         else:
-            await network_manager.setup_server_network(self.tap_interface.interface_name)
+            await self.network.setup_server_network(self.tap_interface.interface_name)
 
         self.is_running = True
         return True
 
+    def _make_transport(self, entry: ClientEntry, owner=None):
+        """Отдельный транспорт клиента: свой чат/peer, батчер и ключ"""
+        key = entry.encryption_key or None
+        cls = get_transport_class(config.transport_type)
+        if config.transport_type == 'vk':
+            transport = cls(peer_id=entry.peer, encryption_key=key, owner=owner)
+        elif config.transport_type == 'loopback':
+            from loopback_transport import LoopbackLink
+            transport = cls(LoopbackLink.get(entry.peer or entry.name), key)
+        elif config.transport_type == 'telegram':
+            transport = cls(chat_id=entry.peer, encryption_key=key, owner=owner)
+        else:
+            # Сторонний транспорт: общий контракт — peer и ключ
+            transport = cls(peer=entry.peer, encryption_key=key)
+        # Колбэки GUI (капча, 2FA), заданные в main.py для основного транспорта
+        for attr in ('captcha_callback', 'two_factor_callback'):
+            if hasattr(self.transport, attr):
+                setattr(transport, attr, getattr(self.transport, attr))
+        return transport
+
+    async def _init_client_sessions(self) -> bool:
+        owner = None
+        for entry in self.client_entries:
+            transport = self._make_transport(entry, owner)
+            session = ClientSession(entry, transport)
+            callback = functools.partial(self._handle_client_packet, session)
+            self._attach(transport)
+            if not await transport.initialize(callback, mode='server'):
+                print(f"❌ Client {entry.name} ({entry.ip}): transport init failed")
+                continue
+            self.clients.add(session)
+            await self._start_dns_relay(transport)
+            # Telegram и VK: одно подключение на все чаты клиентов, держит его первая сессия
+            if owner is None and getattr(transport, 'owns_client', False):
+                owner = transport
+            print(f"👥 Client {entry.name}: {entry.ip} <-> {entry.peer or entry.name}")
+
+        if not len(self.clients):
+            return False
+        # Основной транспорт (для main.py / GUI) — первая сессия
+        self.transport = next(iter(self.clients)).transport
+        return True
+
+    def _build_pipelines(self, mode: str):
+        """Стадии выключенных возможностей не регистрируются вовсе"""
+        self.ingress.add('filter', self._filter_stage)
+        if not self.ipv6:
+            self.ingress.add('ipv4_only', self._ipv4_frame_stage)
+            self.egress.add('ipv4_only', self._ipv4_packet_stage)
+        if self.mss_clamp:
+            self.ingress.add('mss_clamp', self._clamp_frame_stage)
+            self.egress.add('mss_clamp', self._clamp_packet_stage)
+        if mode != 'server' and len(self.bypass):
+            self.ingress.add('bypass', self._bypass_stage)
+
+    def _attach(self, transport):
+        """Стадии батча вызывает транспорт"""
+        transport.tx_pipeline = self.ingress
+        transport.rx_pipeline = self.egress
+
+    async def _start_dns_relay(self, transport):
+        if not config.dns_forwarder: return
+        relay = DnsRelay(transport)
+        if await relay.start():
+            self.dns_relays.append(relay)
+
     async def start_reading_packets(self):
         await self.tap_interface.read_packets(self._handle_tap_packet)
 
-    def _is_garbage(self, packet: bytes) -> bool:
-        if len(packet) < 14: return True
-        eth_type = packet[12:14]
-        if eth_type == b'\x08\x06': return False
-        if eth_type != b'\x08\x00': return True
+    # --- Стадии конвейеров ---
 
-        ip_header = packet[14:34]
-        dst_ip = socket.inet_ntoa(ip_header[16:20])
-        if dst_ip in self.blocked_ips or dst_ip.startswith("224.") or dst_ip.endswith(".255"):
-            return True
+    def _filter_stage(self, view: PacketView):
+        if self.packet_filter.accept_view(view): return view
+        metrics.filter_dropped.inc()
+        return None
 
-        protocol = ip_header[9]
-        if protocol == 17:  # UDP
-            ihl = (ip_header[0] & 0x0F) * 4
-            udp_start = 14 + ihl
-            dst_port = struct.unpack('!H', packet[udp_start + 2:udp_start + 4])[0]
-            if dst_port in self.blocked_ports: return True
-        return False
+    @staticmethod
+    def _ipv4_frame_stage(view: PacketView):
+        if view.ethertype == ETH_IPV6:
+            metrics.filter_dropped.inc()
+            return None
+        return view
+
+    @staticmethod
+    def _ipv4_packet_stage(ip_packet):
+        return None if ip_packet[0] >> 4 == 6 else ip_packet
+
+    def _clamp_frame_stage(self, view: PacketView):
+        if view.tcp_flags & 0x02:
+            frame = view.frame if isinstance(view.frame, bytearray) else bytearray(view.frame)
+            if self.mss_clamp.clamp(frame, 14):
+                view.frame = frame
+                metrics.mss_clamped.inc()
+        return view
 
-    async def _handle_tap_packet(self, packet: bytes):
-        if not self.is_running or self._is_garbage(packet): return
-        eth_type = packet[12:14]
+    def _clamp_packet_stage(self, ip_packet):
+        if MssClamp.is_syn(ip_packet):
+            packet = bytearray(ip_packet)
+            if self.mss_clamp.clamp(packet):
+                metrics.mss_clamped.inc()
+                return packet
+        return ip_packet
 
-        if eth_type == b'\x08\x06':
-            await self._handle_arp(packet)
-        elif eth_type == b'\x08\x00':
-            await self.transport.send_data(packet[14:])
+    def _bypass_stage(self, view: PacketView):
+        if view.ethertype == ETH_IPV4 and self.bypass.contains(view.dst):
+            # Маршрут мимо VPN не сработал — не тратим на пакет загрузку
+            metrics.bypass_dropped.inc()
+            return None
+        return view
+
+    # --- Пути пакетов ---
+
+    async def _handle_tap_packet(self, packet: bytes) -> bool:
+        """True — кадр прошёл стадии ingress и ушёл в туннель"""
+        if not self.is_running: return False
+        # Заголовки разбираются один раз, дальше все работают с view
+        view = PacketView(packet)
+        for stage in self.ingress.stages:
+            view = stage(view)
+            if view is None: return False
+
+        if view.ethertype == ETH_ARP:
+            await self._handle_arp(view)
+            return False
+        elif view.ethertype == ETH_IPV4 or view.ethertype == ETH_IPV6:
+            v6 = view.ethertype == ETH_IPV6
+            if v6:
+                l4 = 14 + view.ihl
+                if view.protocol == PROTO_ICMPV6 and view.length > l4 and view.frame[l4] == ICMPV6_NS:
+                    await self._handle_ndp(view)
+                    return False
+            if self.mode != 'server':
+                await self.transport.send_data(view)
+                return True
+            session = self.clients.route6(view.dst) if v6 else self.clients.route(view.dst)
+            if session is None:
+                metrics.unroutable_dropped.inc()
+                return False
+            session.tx_packets += 1
+            session.tx_bytes += view.length - 14
+            await session.transport.send_data(view)
+            return True
+        return False
+
+    async def _handle_client_packet(self, session: ClientSession, ip_packet: bytes):
+        """Пакет от клиента многоклиентского сервера: источник должен совпадать с его IP"""
+        if ip_packet[0] >> 4 == 6:
+            src, expected = int.from_bytes(ip_packet[8:24], 'big'), session.ip6
+        else:
+            src, expected = int.from_bytes(ip_packet[12:16], 'big'), session.ip
+        # У клиента без ip6 (expected = 0) чужим считается любой IPv6-пакет
+        if session.ip and src != expected:
+            session.spoofed += 1
+            metrics.spoofed_dropped.inc()
+            return
+        session.rx_packets += 1
+        session.rx_bytes += len(ip_packet)
+        await self._handle_transport_packet(ip_packet)
 
     async def _handle_transport_packet(self, ip_packet: bytes):
-        if not self.is_running: return
-        eth = self.my_mac + self.peer_mac + b'\x08\x00'
+        if not self.is_running or not ip_packet: return
+        for stage in self.egress.stages:
+            ip_packet = stage(ip_packet)
+            if ip_packet is None: return
+        # Семейство — по версии в первом полубайте записи
+        eth = self.my_mac + self.peer_mac + (b'\x86\xdd' if ip_packet[0] >> 4 == 6 else b'\x08\x00')
         await self.tap_interface.write_packet(eth + ip_packet)
 
-    async def _handle_arp(self, packet: bytes):
+    async def _handle_arp(self, view: PacketView):
         try:
+            packet = view.frame
             arp_body = packet[14:]
             if arp_body[6:8] == b'\x00\x01':
                 t_ip = socket.inet_ntoa(arp_body[24:28])
                 should_reply = (self.mode == 'client' and t_ip == config.server_ip) or \
-                               (self.mode == 'server' and t_ip == config.client_ip)
+                               (self.mode == 'server' and (t_ip == config.client_ip or
+                                                           int.from_bytes(arp_body[24:28], 'big') in self.clients))
                 if should_reply:
                     req_mac = packet[6:12]
                     reply = (req_mac + self.peer_mac + b'\x08\x06' +
@@ -106,8 +295,28 @@ class PacketHandler:
         except:
             pass
 
+    async def _handle_ndp(self, view: PacketView):
+        """Neighbor Solicitation для адреса пира (клиентов на сервере) — ответ с MAC пира"""
+        frame = view.frame
+        l4 = 14 + view.ihl
+        if view.length < l4 + 24: return
+        target = solicitation_target(frame, l4)
+        t_ip = int.from_bytes(target, 'big')
+        should_reply = t_ip == self.peer_ip6 or (self.mode == 'server' and self.clients.has_ip6(t_ip))
+        src = bytes(frame[22:38])
+        # Проверку уникальности адреса (DAD, источник ::) не подтверждаем
+        if should_reply and any(src):
+            await self.tap_interface.write_packet(neighbor_advertisement(self.peer_mac, bytes(frame[6:12]), target, src))
+
     async def shutdown(self):
         self.is_running = False
-        await self.transport.disconnect()
+        if self.dns_forwarder: self.dns_forwarder.stop()
+        for relay in self.dns_relays:
+            relay.stop()
+        transports = [s.transport for s in self.clients] or [self.transport]
+        # Сначала сессии, общее подключение (Telegram, VK) закрывает его владелец — последним
+        for t in sorted(transports, key=lambda t: getattr(t, 'owns_client', False)):
+            await t.disconnect()
         if self.tap_interface.interface_name:
-            await network_manager.cleanup(self.tap_interface.interface_name)
\ No newline at end of file
+            await self.network.cleanup(self.tap_interface.interface_name)
+        self.tap_interface.close()
\ No newline at end of file
@@ -0,0 +1,171 @@
+# --- START OF FILE packet_view.py ---
+"""
+Разобранный один раз кадр TAP.
+
+IPv4 и IPv6: для IPv6 ihl — длина заголовка вместе с цепочкой заголовков
+расширения (hop-by-hop, routing, destination options, fragment), protocol —
+последний next header, адреса — 128-битные int.
+
+PacketView создаётся при чтении с TAP и дальше передаётся фильтру,
+обработчику ARP, транспорту и статистике — заголовки больше никто не
+режет. PacketBatch хранит те же поля столбцами array для пачки кадров
+(numpy.frombuffer по ним работает без копирования).
+"""
+from array import array
+from typing import Iterable, List
+
+ETH_IPV4 = 0x0800
+ETH_ARP = 0x0806
+ETH_IPV6 = 0x86DD
+
+PROTO_TCP = 6
+PROTO_UDP = 17
+PROTO_ICMPV6 = 58
+
+# Заголовки расширения IPv6, которые пропускаются до транспортного уровня
+_IPV6_EXTENSIONS = frozenset((0, 43, 60))
+_IPV6_FRAGMENT = 44
+
+
+def ethertype_for(ip_packet) -> int:
+    """EtherType по версии в первом полубайте IP-пакета (так семейство едет в каждой записи батча)"""
+    return ETH_IPV6 if ip_packet and ip_packet[0] >> 4 == 6 else ETH_IPV4
+
+
+class PacketView:
+    """
+    Метаданные Ethernet/IPv4/IPv6/TCP/UDP. Адреса — int (big-endian),
+    порты -1, если их нет. malformed — кадр короче заголовков.
+    """
+    __slots__ = ('frame', 'length', 'ethertype', 'ihl', 'protocol', 'src', 'dst',
+                 'sport', 'dport', 'tcp_flags', 'malformed')
+
+    def __init__(self, frame: bytes):
+        self.frame = frame
+        n = self.length = len(frame)
+        self.ihl = self.protocol = self.src = self.dst = self.tcp_flags = 0
+        self.sport = self.dport = -1
+        if n < 14:
+            self.ethertype = -1
+            self.malformed = True
+            return
+        self.ethertype = ethertype = (frame[12] << 8) | frame[13]
+        if ethertype == ETH_IPV6:
+            self._parse_ipv6(frame, n)
+            return
+        if ethertype != ETH_IPV4:
+            self.malformed = False
+            return
+        if n < 34:
+            self.malformed = True
+            return
+        self.malformed = False
+        self.ihl = ihl = (frame[14] & 0x0F) * 4
+        self.protocol = proto = frame[23]
+        self.src = int.from_bytes(frame[26:30], 'big')
+        self.dst = int.from_bytes(frame[30:34], 'big')
+        l4 = 14 + ihl
+        if (proto == PROTO_TCP or proto == PROTO_UDP) and n >= l4 + 4:
+            self.sport = (frame[l4] << 8) | frame[l4 + 1]
+            self.dport = (frame[l4 + 2] << 8) | frame[l4 + 3]
+            if proto == PROTO_TCP and n >= l4 + 14:
+                self.tcp_flags = frame[l4 + 13]
+
+    def _parse_ipv6(self, frame, n: int):
+        if n < 54:
+            self.malformed = True
+            return
+        self.malformed = False
+        self.src = int.from_bytes(frame[22:38], 'big')
+        self.dst = int.from_bytes(frame[38:54], 'big')
+        proto, l4 = frame[20], 54
+        while proto in _IPV6_EXTENSIONS or proto == _IPV6_FRAGMENT:
+            if n < l4 + 8:
+                self.malformed = True
+                return
+            if proto == _IPV6_FRAGMENT:
+                if (frame[l4 + 2] << 8 | frame[l4 + 3]) & 0xFFF8:
+                    # Не первый фрагмент: портов в нём нет
+                    proto, l4 = frame[l4], l4 + 8
+                    self.protocol, self.ihl = proto, l4 - 14
+                    return
+                proto, l4 = frame[l4], l4 + 8
+            else:
+                proto, l4 = frame[l4], l4 + (frame[l4 + 1] + 1) * 8
+        self.protocol = proto
+        self.ihl = l4 - 14
+        if (proto == PROTO_TCP or proto == PROTO_UDP) and n >= l4 + 4:
+            self.sport = (frame[l4] << 8) | frame[l4 + 1]
+            self.dport = (frame[l4 + 2] << 8) | frame[l4 + 3]
+            if proto == PROTO_TCP and n >= l4 + 14:
+                self.tcp_flags = frame[l4 + 13]
+
+    @property
+    def is_ip(self) -> bool:
+        return self.ethertype == ETH_IPV4 or self.ethertype == ETH_IPV6
+
+    @property
+    def is_ipv6(self) -> bool:
+        return self.ethertype == ETH_IPV6
+
+    @property
+    def is_ipv4(self) -> bool:
+        return self.ethertype == ETH_IPV4
+
+    @property
+    def is_arp(self) -> bool:
+        return self.ethertype == ETH_ARP
+
+    @property
+    def ip_packet(self) -> memoryview:
+        """IP-пакет без заголовка Ethernet, без копирования"""
+        return memoryview(self.frame)[14:]
+
+    def __repr__(self):
+        return (f"PacketView(ethertype=0x{self.ethertype & 0xFFFF:04x}, proto={self.protocol}, "
+                f"src=0x{self.src:08x}, dst=0x{self.dst:08x}, ports={self.sport}->{self.dport}, len={self.length})")
+
+
+class PacketBatch:
+    """Пачка кадров: сами PacketView плюс их поля столбцами array"""
+
+    def __init__(self, views: Iterable[PacketView] = ()):
+        self.views: List[PacketView] = []
+        self.length = array('i')
+        self.ethertype = array('i')
+        self.protocol = array('B')
+        # 'I' — 4 байта на всех поддерживаемых платформах; у IPv6 здесь 0 (адреса — в views)
+        self.src = array('I')
+        self.dst = array('I')
+        self.sport = array('i')
+        self.dport = array('i')
+        self.tcp_flags = array('B')
+        self.malformed = array('B')
+        for v in views:
+            self.append(v)
+
+    @classmethod
+    def from_frames(cls, frames: Iterable[bytes]) -> 'PacketBatch':
+        return cls(PacketView(f) for f in frames)
+
+    def append(self, view: PacketView):
+        self.views.append(view)
+        self.length.append(view.length)
+        self.ethertype.append(view.ethertype)
+        self.protocol.append(view.protocol)
+        v4 = view.ethertype == ETH_IPV4
+        self.src.append(view.src if v4 else 0)
+        self.dst.append(view.dst if v4 else 0)
+        self.sport.append(view.sport)
+        self.dport.append(view.dport)
+        self.tcp_flags.append(view.tcp_flags)
+        self.malformed.append(view.malformed)
+
+    def __len__(self):
+        return len(self.views)
+
+    def __getitem__(self, i) -> PacketView:
+        return self.views[i]
+
+    def __iter__(self):
+        return iter(self.views)
@@ -0,0 +1,83 @@
+# --- START OF FILE pipeline.py ---
+"""
+Конвейер обработки пакетов одного направления.
+
+PacketHandler держит два конвейера:
+  * ingress — кадры из TAP в туннель: стадия получает PacketView;
+  * egress — пакеты из туннеля в TAP: стадия получает IP-пакет (bytes / bytearray).
+
+Стадия пакета — обычная функция ``fn(item) -> item | None``: вернуть тот
+же (или изменённый) объект, чтобы пакет шёл дальше, или None, чтобы
+выбросить его. Стадии собираются один раз при старте (фильтр, MSS, обход
+туннеля...), и выключенная возможность просто не регистрирует стадию —
+на горячем пути остаётся цикл по кортежу без проверок флагов.
+
+Стадии батча ``fn(packets, nbytes)`` вызывает транспорт один раз на батч:
+ingress — при отправке собранного батча, egress — после разбора принятого.
+Это место для событий и статистики, которым не нужен каждый пакет
+(например, "пошёл трафик" в main.py).
+
+Добавлять и убирать стадии можно и на ходу: кортеж пересобирается, а уже
+идущий по старому кортежу пакет доходит до конца.
+"""
+from typing import Callable
+
+
+class Pipeline:
+    def __init__(self, name: str):
+        self.name = name
+        # Кортежи функций — то, что читает горячий путь
+        self.stages = ()
+        self.batch_stages = ()
+        self._stages = []        # [(имя, функция)]
+        self._batch_stages = []
+
+    def add(self, name: str, fn: Callable, before: str = None):
+        """Стадия пакета; before — вставить перед стадией с этим именем"""
+        self._insert(self._stages, name, fn, before)
+        self.stages = tuple(f for _, f in self._stages)
+
+    def add_batch(self, name: str, fn: Callable):
+        """Стадия батча: fn(число пакетов, байт)"""
+        self._insert(self._batch_stages, name, fn, None)
+        self.batch_stages = tuple(f for _, f in self._batch_stages)
+
+    @staticmethod
+    def _insert(stages: list, name: str, fn: Callable, before):
+        if any(n == name for n, _ in stages):
+            raise ValueError(f"stage already registered: {name}")
+        index = len(stages)
+        if before is not None:
+            index = next((i for i, (n, _) in enumerate(stages) if n == before), index)
+        stages.insert(index, (name, fn))
+
+    def get(self, name: str) -> Callable:
+        for n, fn in self._stages + self._batch_stages:
+            if n == name:
+                return fn
+        raise KeyError(name)
+
+    def replace(self, name: str, fn: Callable):
+        """Подменить функцию стадии (обёртка замеров в benchmark.py)"""
+        for stages in (self._stages, self._batch_stages):
+            for i, (n, _) in enumerate(stages):
+                if n == name:
+                    stages[i] = (name, fn)
+        self.stages = tuple(f for _, f in self._stages)
+        self.batch_stages = tuple(f for _, f in self._batch_stages)
+
+    def remove(self, name: str):
+        self._stages = [(n, f) for n, f in self._stages if n != name]
+        self._batch_stages = [(n, f) for n, f in self._batch_stages if n != name]
+        self.stages = tuple(f for _, f in self._stages)
+        self.batch_stages = tuple(f for _, f in self._batch_stages)
+
+    def run_batch(self, packets: int, nbytes: int):
+        for fn in self.batch_stages:
+            fn(packets, nbytes)
+
+    def __contains__(self, name: str) -> bool:
+        return any(n == name for n, _ in self._stages + self._batch_stages)
+
+    def describe(self) -> dict:
+        return {'packet': [n for n, _ in self._stages], 'batch': [n for n, _ in self._batch_stages]}
@@ -0,0 +1,126 @@
+# --- START OF FILE prefix_set.py ---
+"""
+Набор IPv4-префиксов для раздельного туннелирования.
+
+CIDR переводятся в диапазоны [начало, конец] (int), сортируются и
+сливаются, если пересекаются или идут подряд. Хранятся два array('I'):
+проверка адреса — один bisect, а минимальный набор маршрутов для ОС
+получается разбиением каждого диапазона на выровненные блоки.
+"""
+import socket
+import struct
+from array import array
+from bisect import bisect_right
+from typing import Iterable, List, Optional, Tuple
+
+from config import config
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def parse_cidr(cidr: str) -> Tuple[int, int]:
+    """'10.0.0.0/8' -> (первый, последний адрес)"""
+    addr, _, prefix = cidr.strip().partition('/')
+    bits = int(prefix) if prefix else 32
+    if not 0 <= bits <= 32:
+        raise ValueError(f"bad prefix length in {cidr!r}")
+    size = 1 << (32 - bits)
+    start = struct.unpack('!I', socket.inet_aton(addr))[0] & ~(size - 1) & 0xFFFFFFFF
+    return start, start + size - 1
+
+
+def _int_to_ip(value: int) -> str:
+    return socket.inet_ntoa(struct.pack('!I', value))
+
+
+class PrefixSet:
+    """Слитые диапазоны адресов; contains() — O(log n)"""
+
+    def __init__(self, cidrs: Iterable[str] = ()):
+        self.starts = array('I')
+        self.ends = array('I')
+        self.source_count = 0
+        self.update(cidrs)
+
+    def update(self, cidrs: Iterable[str]):
+        ranges = list(zip(self.starts, self.ends))
+        for cidr in cidrs:
+            ranges.append(parse_cidr(cidr))
+            self.source_count += 1
+        self._build(ranges)
+
+    def _build(self, ranges: List[Tuple[int, int]]):
+        ranges.sort()
+        starts, ends = array('I'), array('I')
+        for start, end in ranges:
+            # Пересекается или примыкает к предыдущему — расширяем его
+            if ends and start <= ends[-1] + 1:
+                if end > ends[-1]: ends[-1] = end
+            else:
+                starts.append(start)
+                ends.append(end)
+        self.starts, self.ends = starts, ends
+
+    @classmethod
+    def from_files(cls, paths: Iterable[str], cidrs: Iterable[str] = ()) -> 'PrefixSet':
+        """Списки префиксов: по одному CIDR в строке, '#' — комментарий"""
+        def lines():
+            yield from cidrs
+            for path in paths:
+                try:
+                    with open(path, 'r', encoding='utf-8') as f:
+                        for line in f:
+                            line = line.split('#', 1)[0].strip()
+                            if line: yield line
+                except OSError as e:
+                    print(f"⚠️ Prefix list {path}: {e}")
+        return cls(lines())
+
+    def contains(self, ip: int) -> bool:
+        i = bisect_right(self.starts, ip) - 1
+        return i >= 0 and ip <= self.ends[i]
+
+    __contains__ = contains
+
+    def contains_many(self, ips):
+        """Пачка адресов (массив uint32) -> массив bool. Нужен NumPy"""
+        starts = np.frombuffer(self.starts, dtype=np.uint32)
+        ends = np.frombuffer(self.ends, dtype=np.uint32)
+        ips = np.asarray(ips, dtype=np.uint32)
+        i = np.searchsorted(starts, ips, side='right') - 1
+        return (i >= 0) & (ips <= ends[np.maximum(i, 0)])
+
+    def to_cidrs(self) -> List[str]:
+        """Минимальный набор CIDR, покрывающий ровно эти диапазоны"""
+        out = []
+        for start, end in zip(self.starts, self.ends):
+            while start <= end:
+                # Самый большой выровненный блок, начинающийся в start и не выходящий за end
+                size = start & -start if start else 1 << 32
+                while size > end - start + 1:
+                    size >>= 1
+                out.append(f"{_int_to_ip(start)}/{32 - size.bit_length() + 1}")
+                start += size
+        return out
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __repr__(self):
+        return f"PrefixSet({self.source_count} prefixes -> {len(self)} ranges)"
+
+
+_bypass: Optional[PrefixSet] = None
+
+
+def bypass_set() -> PrefixSet:
+    """Префиксы мимо VPN: config.telegram_subnets + файлы bypass_prefix_files (строится один раз)"""
+    global _bypass
+    if _bypass is None:
+        _bypass = PrefixSet.from_files(config.bypass_prefix_files, config.telegram_subnets)
+        if _bypass.source_count:
+            print(f"🧭 Bypass prefixes: {_bypass.source_count} -> {len(_bypass.to_cidrs())} routes")
+    return _bypass
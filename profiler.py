@@ -0,0 +1,269 @@
+# --- START OF FILE profiler.py ---
+"""
+Профилирование горячего пути по стадиям (main.py --profile).
+
+Каждая стадия направления (uplink / downlink — относительно клиента:
+на сервере TAP -> туннель это downlink) оборачивается замером:
+  * время стадии (perf_counter) — в гистограмму с фиксированными
+    корзинами от микросекунды, она же видна в /metrics как
+    televpn_stage_<направление>_<стадия>_seconds;
+  * CPU потока (thread_time) — только у синхронных стадий и эксклюзивно:
+    вложенная стадия (gzip внутри encode) не засчитывается внешней.
+Асинхронные стадии (загрузка, скачивание, запись в TAP) засыпают, поэтому
+у них меряется только время. Всё, что не попало ни в одну стадию, — строка
+"other" (CPU процесса минус сумма стадий).
+
+Дополнительно — снимок на заданное окно: cProfile (детерминированный,
+дороже) или сэмплер стека цикла событий (sys._current_frames, почти
+бесплатный). Отчёт печатается при остановке, по SIGUSR1 и командой
+управляющего сокета {"cmd": "profile"}.
+"""
+import asyncio
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter as Tally
+from typing import Optional
+
+from metrics import metrics
+
+STAGE_BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 0.001, 0.0025, 0.005,
+                 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class _Stage:
+    __slots__ = ('direction', 'name', 'hist', 'cpu_ns', 'is_async')
+
+    def __init__(self, direction: str, name: str, is_async: bool):
+        self.direction = direction
+        self.name = name
+        self.is_async = is_async
+        metric = f"televpn_stage_{direction}_{name}_seconds"
+        self.hist = metrics.histogram(metric, f'{direction} {name} stage time (--profile)', STAGE_BUCKETS)
+        self.cpu_ns = 0
+
+
+class StackSampler:
+    """Сэмплер стека одного потока: раз в interval секунд смотрит его текущий кадр"""
+
+    def __init__(self, thread_id: int, interval: float = 0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.self_counts = Tally()
+        self.total_counts = Tally()
+        self.samples = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            self.samples += 1
+            self.self_counts[self._label(frame)] += 1
+            seen = set()
+            while frame is not None:
+                label = self._label(frame)
+                if label not in seen:
+                    seen.add(label)
+                    self.total_counts[label] += 1
+                frame = frame.f_back
+
+    @staticmethod
+    def _label(frame) -> str:
+        code = frame.f_code
+        return f"{os.path.basename(code.co_filename)}:{code.co_firstlineno}({code.co_name})"
+
+    def stop(self, limit: int = 25) -> str:
+        self.stop_event.set()
+        self.thread.join()
+        n = max(1, self.samples)
+        lines = [f"{self.samples} samples every {self.interval * 1000:.0f} ms", "", "  self%  total%  function"]
+        for label, count in self.self_counts.most_common(limit):
+            lines.append(f"{100 * count / n:6.1f}  {100 * self.total_counts[label] / n:6.1f}  {label}")
+        lines += ["", "  total%  function (inclusive)"]
+        for label, count in self.total_counts.most_common(limit):
+            lines.append(f"{100 * count / n:7.1f}  {label}")
+        return "\n".join(lines)
+
+
+class StageProfiler:
+    def __init__(self):
+        self.stages = {}  # (направление, стадия) -> _Stage
+        self.local = threading.local()
+        self.started = time.perf_counter()
+        self.started_cpu = time.process_time()
+        self.capture_task: Optional[asyncio.Task] = None
+        self.last_capture = ''
+
+    # --- Обёртки ---
+
+    def _stage(self, direction: str, name: str, is_async: bool) -> _Stage:
+        stage = self.stages.get((direction, name))
+        if stage is None:
+            stage = self.stages[(direction, name)] = _Stage(direction, name, is_async)
+        return stage
+
+    def wrap(self, obj, attr: str, direction: str, name: str):
+        fn = getattr(obj, attr, None)
+        if fn is None: return
+        setattr(obj, attr, self._wrapped(fn, direction, name))
+
+    def wrap_stage(self, pipeline, stage: str, direction: str, name: str):
+        pipeline.replace(stage, self._wrapped(pipeline.get(stage), direction, name))
+
+    def _wrapped(self, fn, direction: str, name: str):
+        perf, thread_cpu = time.perf_counter_ns, time.thread_time_ns
+        if asyncio.iscoroutinefunction(fn):
+            hist = self._stage(direction, name, True).hist
+
+            async def timed(*args, **kwargs):
+                start = perf()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    hist.observe((perf() - start) / 1e9)
+            return timed
+
+        stage = self._stage(direction, name, False)
+        hist, local = stage.hist, self.local
+
+        def timed(*args, **kwargs):
+            try:
+                stack = local.stack
+            except AttributeError:
+                stack = local.stack = []
+            # В стеке — CPU вложенных стадий, его вычитаем из своего
+            stack.append(0)
+            start, cpu = perf(), thread_cpu()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                cpu = thread_cpu() - cpu
+                hist.observe((perf() - start) / 1e9)
+                stage.cpu_ns += cpu - stack.pop()
+                if stack:
+                    stack[-1] += cpu
+        return timed
+
+    def instrument(self, handler, mode: str):
+        """Обернуть горячий путь обработчика; вызывать после handler.initialize()"""
+        tx, rx = ('uplink', 'downlink') if mode == 'client' else ('downlink', 'uplink')
+        tap = getattr(handler, 'tap_interface', None)
+        if tap is not None:
+            self.wrap(tap, '_read_from_tap', tx, 'tap_read')
+            self.wrap(handler, '_handle_tap_packet', tx, 'tap_ingress')
+            self.wrap(tap, 'write_packet', rx, 'tap_write')
+        for pipeline, direction in ((handler.ingress, tx), (handler.egress, rx)):
+            for stage in pipeline.describe()['packet']:
+                self.wrap_stage(pipeline, stage, direction, stage)
+        clients = getattr(handler, 'clients', None)
+        transports = [s.transport for s in clients] if clients else [handler.transport]
+        for t in transports:
+            self.instrument_transport(t, tx, rx, 'tap_egress' if tap is not None else 'deliver')
+
+    def instrument_transport(self, t, tx: str, rx: str, deliver: str = 'deliver'):
+        self.wrap(t, '_append_to_buffer', tx, 'batch')
+        self.wrap(t, '_encode_batch', tx, 'encode')
+        if t.data_plane is not None:
+            # gzip и ГОСТ в процессах data plane: здесь видно только ожидание
+            self.wrap(t, '_encode_batch_async', tx, 'seal')
+            self.wrap(t, '_decode_batch_async', rx, 'open')
+        self.wrap(t.wan, 'encode_into', tx, 'wan')
+        self.wrap(t.compressor, 'compress_into', tx, 'gzip')
+        self.wrap(t.crypto, 'encrypt_into', tx, 'encrypt')
+        # Пулы держат свою ссылку на функцию задания
+        self.wrap(t.upload_pool, 'handler', tx, 'upload')
+        self.wrap(t.download_pool, 'handler', rx, 'download')
+        self.wrap(t, '_decode_batch', rx, 'decode')
+        self.wrap(t.crypto, 'decrypt', rx, 'decrypt')
+        self.wrap(t.compressor, 'decompress', rx, 'gunzip')
+        self.wrap(t.wan, 'decode', rx, 'wan')
+        self.wrap(t, '_parse_batch_and_route', rx, 'deframe')
+        self.wrap(t, 'receive_callback', rx, deliver)
+
+    # --- Снимок cProfile / сэмплера ---
+
+    def start_capture(self, seconds: float, sampler: bool = False, path: Optional[str] = None,
+                      delay: float = 0.0) -> bool:
+        """Снимок на seconds секунд через delay; False — предыдущий ещё идёт"""
+        if self.capture_task is not None and not self.capture_task.done():
+            return False
+        self.capture_task = asyncio.create_task(self._capture(seconds, sampler, path, delay))
+        return True
+
+    async def _capture(self, seconds: float, sampler: bool, path: Optional[str], delay: float):
+        if delay > 0:
+            await asyncio.sleep(delay)
+        kind = 'sampler' if sampler else 'cProfile'
+        print(f"🔬 {kind} capture for {seconds:g}s...")
+        if sampler:
+            stack_sampler = StackSampler(threading.get_ident())
+            stack_sampler.start()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                text = stack_sampler.stop()
+        else:
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                profile.disable()
+            if path:
+                profile.dump_stats(path)
+            out = io.StringIO()
+            pstats.Stats(profile, stream=out).sort_stats('cumulative').print_stats(30)
+            text = out.getvalue()
+        if path and sampler:
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(text)
+        self.last_capture = text
+        print(f"🔬 {kind} capture done" + (f" -> {path}" if path else '') + "\n" + text)
+
+    # --- Отчёт ---
+
+    def report(self) -> dict:
+        wall = time.perf_counter() - self.started
+        cpu = time.process_time() - self.started_cpu
+        directions = {}
+        staged_cpu = 0
+        for (direction, name), stage in self.stages.items():
+            h = stage.hist
+            entry = {'calls': h.count, 'wall_ms': round(h.sum * 1000, 3),
+                     'mean_us': round(h.mean * 1e6, 1),
+                     'p50_us': round(h.quantile(0.5) * 1e6, 1), 'p99_us': round(h.quantile(0.99) * 1e6, 1)}
+            if not stage.is_async:
+                staged_cpu += stage.cpu_ns
+                entry['cpu_ms'] = round(stage.cpu_ns / 1e6, 3)
+                entry['cpu_share'] = round(stage.cpu_ns / 1e9 / cpu, 4) if cpu else 0.0
+            directions.setdefault(direction, {})[name] = entry
+        other = max(0.0, cpu - staged_cpu / 1e9)
+        return {'wall_s': round(wall, 3), 'process_cpu_s': round(cpu, 3),
+                'other_cpu_ms': round(other * 1000, 3),
+                'other_cpu_share': round(other / cpu, 4) if cpu else 0.0,
+                'directions': directions}
+
+    def format_report(self) -> str:
+        r = self.report()
+        lines = [f"📊 Stage profile: {r['wall_s']:.1f}s wall, {r['process_cpu_s']:.2f}s process CPU",
+                 f"{'stage':<22}{'calls':>9}{'time ms':>12}{'mean us':>10}{'p50 us':>10}"
+                 f"{'p99 us':>10}{'CPU ms':>11}{'CPU %':>7}"]
+        for direction, stages in r['directions'].items():
+            lines.append(f"[{direction}]")
+            for name, s in stages.items():
+                if not s['calls']: continue  # выключенная возможность (wan, gzip)
+                cpu = f"{s['cpu_ms']:>11.1f}{100 * s['cpu_share']:>7.1f}" if 'cpu_ms' in s else f"{'(async)':>11}{'':>7}"
+                lines.append(f"  {name:<20}{s['calls']:>9}{s['wall_ms']:>12.1f}{s['mean_us']:>10.1f}"
+                             f"{s['p50_us']:>10.1f}{s['p99_us']:>10.1f}{cpu}")
+        lines.append(f"  {'other':<20}{'':>51}{r['other_cpu_ms']:>11.1f}{100 * r['other_cpu_share']:>7.1f}")
+        return "\n".join(lines)
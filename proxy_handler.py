@@ -0,0 +1,591 @@
+# --- START OF FILE proxy_handler.py ---
+"""
+Режим прокси: SOCKS5 на клиенте, TCP-потоки поверх транспорта.
+
+В режиме VPN через мессенджер идут IP-пакеты, и TCP приложения сам
+управляет перегрузкой на канале с RTT в секунды — окно почти всё время
+пустое. Здесь TCP завершается локально: клиент принимает соединения на
+SOCKS5 (только CONNECT), сервер открывает настоящие сокеты, а между ними
+идут кадры потоков. Каждый кадр — обычная запись батча:
+    [тип: 1 байт][id потока: 4 байта][данные кадра]
+
+Батчи загружаются параллельно и приходят в любом порядке, поэтому данные
+несут смещение в потоке и собираются по нему. Поток не отправляет больше,
+чем разрешил пир (кадр WINDOW — разрешённое смещение): один медленный
+получатель не забивает очередь транспорта остальным.
+
+Сообщения мессенджера теряются, поэтому WINDOW несёт и подтверждение —
+сколько получено подряд (CLOSE занимает одно смещение, как FIN в TCP), —
+и смещения кусков, пришедших за дырой (SACK). Неподтверждённые данные и
+CLOSE повторяются по RTO (RTT туннеля и замеры по подтверждениям), OPEN —
+пока нет ответа, а WINDOW — пока пир молчит: он мог упереться в окно,
+которое потерялось. Кадры закрытого потока получают повтор последнего
+подтверждения (или RESET, если поток сброшен).
+"""
+import asyncio
+import errno
+import socket
+import struct
+import time
+from collections import OrderedDict, deque
+from typing import Dict, Optional
+
+from config import config
+from control_frames import RttEstimator
+from metrics import metrics
+from pipeline import Pipeline
+from transport_registry import create_transport
+
+FRAME_OPEN = 1       # [порт: 2][хост, utf-8]
+FRAME_OPEN_OK = 2
+FRAME_OPEN_FAIL = 3  # [код ответа SOCKS5: 1]
+FRAME_DATA = 4       # [смещение: 8][данные]
+FRAME_WINDOW = 5     # [разрешённое смещение: 8][получено подряд: 8][смещения за дырой: 8 × n]
+FRAME_CLOSE = 6      # [конечное смещение: 8] — отправитель больше не пишет
+FRAME_RESET = 7
+
+_HEADER = struct.Struct('!BI')
+_OFFSET = struct.Struct('!Q')
+_WINDOW = struct.Struct('!QQ')
+_PORT = struct.Struct('!H')
+
+# Данных в одном кадре: запись батча ограничена 65535 байтами
+CHUNK = 16384
+
+# RTO, с: до первых замеров RTT, пределы и наибольший множитель отката
+RTO_INITIAL = 3.0
+RTO_MIN = 1.0
+RTO_MAX = 60.0
+MAX_BACKOFF = 64
+# Смещений кусков за дырой в одном WINDOW
+SACK_BLOCKS = 32
+# Сколько закрытых потоков помнить, чтобы отвечать на их запоздалые кадры
+CLOSED_MEMORY = 4096
+
+SOCKS_VERSION = 5
+SOCKS_OK = 0x00
+SOCKS_FAILURE = 0x01
+SOCKS_NET_UNREACHABLE = 0x03
+SOCKS_HOST_UNREACHABLE = 0x04
+SOCKS_REFUSED = 0x05
+SOCKS_CMD_UNSUPPORTED = 0x07
+SOCKS_ATYP_UNSUPPORTED = 0x08
+
+
+def _reply_code(exc: BaseException) -> int:
+    if isinstance(exc, socket.gaierror) or isinstance(exc, asyncio.TimeoutError):
+        return SOCKS_HOST_UNREACHABLE
+    if isinstance(exc, ConnectionRefusedError):
+        return SOCKS_REFUSED
+    if isinstance(exc, OSError) and exc.errno in (errno.ENETUNREACH, errno.EHOSTUNREACH):
+        return SOCKS_NET_UNREACHABLE
+    return SOCKS_FAILURE
+
+
+def _socks_reply(code: int) -> bytes:
+    # BND.ADDR / BND.PORT клиентам не нужны: 0.0.0.0:0
+    return bytes((SOCKS_VERSION, code, 0, 1)) + bytes(6)
+
+
+class ProxyStream:
+    """Один TCP-поток: локальный сокет <-> кадры через транспорт"""
+
+    def __init__(self, handler: 'ProxyHandler', sid: int, reader=None, writer=None):
+        self.handler = handler
+        self.sid = sid
+        self.reader: Optional[asyncio.StreamReader] = reader
+        self.writer: Optional[asyncio.StreamWriter] = writer
+        # Задача, которая ведёт поток (abort() её отменяет)
+        self.task: Optional[asyncio.Task] = None
+        self.opened = asyncio.get_running_loop().create_future()
+        self.last_activity = time.monotonic()
+        # Таймеры повторов работают, пока поток перекачивает (run)
+        self.running = False
+        self.complete = False
+
+        # Отправка: сколько отдали и до какого смещения пир разрешает
+        self.sent = 0
+        self.send_limit = config.proxy_window
+        self.credit = asyncio.Event()
+        # Отправленное без подтверждения: [смещение, данные, время отправки, был повтор]
+        self.unacked = deque()
+        self.sacked = set()
+        self.acked = 0
+        self.acked_event = asyncio.Event()
+        self.fin_sent_at: Optional[float] = None
+        self.backoff = 1
+
+        # Приём: следующее ожидаемое смещение, ранние куски, готовое к записи
+        self.recv_next = 0
+        self.early: Dict[int, bytes] = {}
+        self.ready = deque()
+        self.ready_event = asyncio.Event()
+        self.consumed = 0
+        self.granted = config.proxy_window
+        self.fin_offset: Optional[int] = None
+        # Когда пир последний раз что-то прислал и что мы ему подтвердили
+        self.heard_at = time.monotonic()
+        self.window_sent_at = self.heard_at
+        self.ack_sent = 0
+        self.window_backoff = 1
+
+    @property
+    def ack(self) -> int:
+        """Получено подряд; принятый CLOSE — ещё одно смещение"""
+        if self.fin_offset is not None and self.recv_next >= self.fin_offset:
+            return self.fin_offset + 1
+        return self.recv_next
+
+    # --- Кадры от пира ---
+
+    def on_data(self, offset: int, data: bytes):
+        self.last_activity = self.heard_at = time.monotonic()
+        self.window_backoff = 1
+        if offset < self.recv_next:
+            # Повтор уже принятого: наше подтверждение, видимо, потерялось
+            self._ack_soon()
+        elif offset == self.recv_next:
+            self.ready.append(data)
+            self.recv_next += len(data)
+            while self.recv_next in self.early:
+                chunk = self.early.pop(self.recv_next)
+                self.ready.append(chunk)
+                self.recv_next += len(chunk)
+            self.ready_event.set()
+        elif offset > self.recv_next:
+            self.early[offset] = data
+
+    def on_window(self, limit: int, ack: int, sacked=()):
+        now = time.monotonic()
+        if limit > self.send_limit:
+            self.last_activity = now
+            self.send_limit = limit
+            self.credit.set()
+        self.sacked.update(sacked)
+        if ack > self.acked:
+            self.last_activity = now
+            self.acked = ack
+            self.backoff = 1
+            sample = None
+            while self.unacked and self.unacked[0][0] + len(self.unacked[0][1]) <= ack:
+                offset, _, sent_at, resent = self.unacked.popleft()
+                self.sacked.discard(offset)
+                if not resent:
+                    sample = now - sent_at  # алгоритм Карна: по повторам не меряем
+            if sample is not None:
+                self.handler.ack_rtt.update(sample)
+            self.acked_event.set()
+
+    def on_close(self, final_offset: int):
+        self.heard_at = time.monotonic()
+        if self.fin_offset is not None:
+            self._ack_soon()  # повтор CLOSE: подтверждение потерялось
+        self.fin_offset = final_offset
+        self.ready_event.set()
+
+    def _ack_soon(self):
+        # Повторы приходят пачкой в одном батче — хватит одного WINDOW на батч
+        if time.monotonic() - self.window_sent_at >= config.batch_interval:
+            self.handler.spawn(self._send_window())
+
+    async def _send_window(self):
+        self.window_sent_at = time.monotonic()
+        self.ack_sent = self.ack
+        sack = b''.join(_OFFSET.pack(offset) for offset in sorted(self.early)[:SACK_BLOCKS])
+        await self.handler.send_frame(FRAME_WINDOW, self.sid, _WINDOW.pack(self.granted, self.ack_sent) + sack)
+
+    async def _send_data(self, offset: int, data: bytes):
+        # Подтверждение приёма едет тем же батчем, если есть что подтвердить
+        if self.ack > self.ack_sent:
+            await self._send_window()
+        await self.handler.send_frame(FRAME_DATA, self.sid, _OFFSET.pack(offset) + data)
+
+    async def on_timer(self, now: float, rto: float):
+        """Повторы по RTO (зовёт ProxyHandler._retransmit_loop)"""
+        # Отправка: всё, что ушло дольше RTO назад и не подтверждено (и не дошло за дырой)
+        deadline = now - min(rto * self.backoff, RTO_MAX)
+        expired = [chunk for chunk in self.unacked if chunk[2] <= deadline and chunk[0] not in self.sacked]
+        fin_expired = (self.fin_sent_at is not None and self.fin_sent_at <= deadline
+                       and self.acked <= self.sent)
+        if expired or fin_expired:
+            self.backoff = min(self.backoff * 2, MAX_BACKOFF)
+            for chunk in expired:
+                chunk[2] = now
+                chunk[3] = True
+                metrics.proxy_retransmits.inc()
+                await self._send_data(chunk[0], chunk[1])
+            if fin_expired:
+                self.fin_sent_at = now
+                metrics.proxy_retransmits.inc()
+                await self.handler.send_frame(FRAME_CLOSE, self.sid, _OFFSET.pack(self.sent))
+
+        # Приём: отложенное подтверждение (ответные данные могли бы его подвезти)
+        if self.ack > self.ack_sent and now - self.heard_at >= 2 * config.batch_interval:
+            await self._send_window()
+        # Пир молчит, пока не прислал CLOSE: мог упереться в окно, а наш WINDOW потеряться
+        elif self.fin_offset is None and now - max(self.heard_at, self.window_sent_at) >= \
+                min(rto * self.window_backoff, RTO_MAX):
+            self.window_backoff = min(self.window_backoff * 2, MAX_BACKOFF)
+            await self._send_window()
+
+    # --- Перекачка ---
+
+    async def run(self):
+        pumps = [asyncio.create_task(self._pump_local()), asyncio.create_task(self._pump_tunnel())]
+        self.running = True
+        try:
+            await asyncio.gather(*pumps)
+            self.complete = True
+        except (ConnectionError, OSError):
+            self.abort(notify=True)
+        finally:
+            for pump in pumps:
+                pump.cancel()
+            self._close()
+
+    async def _pump_local(self):
+        """Локальный сокет -> кадры DATA в пределах окна пира"""
+        while True:
+            while self.sent >= self.send_limit:
+                self.credit.clear()
+                await self.credit.wait()
+            data = await self.reader.read(min(CHUNK, self.send_limit - self.sent))
+            if not data:
+                break
+            self.last_activity = time.monotonic()
+            self.unacked.append([self.sent, data, self.last_activity, False])
+            await self._send_data(self.sent, data)
+            self.sent += len(data)
+            self.handler.bytes_out.inc(len(data))
+        self.fin_sent_at = time.monotonic()
+        await self.handler.send_frame(FRAME_CLOSE, self.sid, _OFFSET.pack(self.sent))
+        # Своя половина закрыта, когда пир подтвердил всё, включая CLOSE
+        while self.acked <= self.sent:
+            self.acked_event.clear()
+            await self.acked_event.wait()
+
+    async def _pump_tunnel(self):
+        """Собранные по порядку данные -> локальный сокет, затем WINDOW пиру"""
+        window = config.proxy_window
+        while True:
+            if not self.ready:
+                if self.fin_offset is not None and self.recv_next >= self.fin_offset:
+                    if self.writer.can_write_eof():
+                        self.writer.write_eof()
+                    await self._send_window()  # подтверждение CLOSE
+                    return
+                self.ready_event.clear()
+                await self.ready_event.wait()
+                continue
+            data = b''.join(self.ready)
+            self.ready.clear()
+            self.writer.write(data)
+            await self.writer.drain()
+            self.consumed += len(data)
+            self.handler.bytes_in.inc(len(data))
+            # Окно двигаем четвертями: кадр WINDOW на каждый кусок — лишний трафик
+            if self.consumed + window - self.granted >= window // 4:
+                self.granted = self.consumed + window
+                await self._send_window()
+
+    def abort(self, notify: bool = False):
+        """Сброс потока; notify — сообщить пиру кадром RESET"""
+        if self.handler.streams.get(self.sid) is not self:
+            return
+        metrics.proxy_resets.inc()
+        if notify:
+            self.handler.spawn(self.handler.send_frame(FRAME_RESET, self.sid))
+        if not self.opened.done():
+            self.opened.set_result(SOCKS_FAILURE)
+        self._close()
+        if self.task and self.task is not asyncio.current_task():
+            self.task.cancel()
+
+    def _close(self):
+        if self.handler.streams.get(self.sid) is self:
+            del self.handler.streams[self.sid]
+            self.handler.remember_closed(self.sid, self.ack if self.complete else None)
+        if self.writer:
+            self.writer.close()
+
+
+class ProxyHandler:
+    def __init__(self, transport=None):
+        # Транспорт можно передать готовый (LoopbackTransport для замеров)
+        self.transport = transport if transport is not None else create_transport(config.transport_type)
+        self.is_running = False
+        self.mode = None
+        self.streams: Dict[int, ProxyStream] = {}
+        # RTT по подтверждениям потоков: в отличие от проб эха видит очереди и батчер
+        self.ack_rtt = RttEstimator()
+        # Закрытые потоки: id -> последнее подтверждение (None — поток сброшен)
+        self.closed: OrderedDict = OrderedDict()
+        self.next_sid = 1
+        self.listener: Optional[asyncio.AbstractServer] = None
+        self.stop_event: Optional[asyncio.Event] = None
+        self.reaper_task = None
+        self.retransmit_task = None
+        # Кадры, отправленные из синхронного кода (подтверждения, RESET); отменяются в shutdown
+        self.frame_tasks = set()
+        self.peer_mode_warned = False
+        self.bytes_out = metrics.proxy_bytes_sent
+        self.bytes_in = metrics.proxy_bytes_received
+        # Через туннель идут кадры потоков, а не IP-пакеты: у конвейеров только стадии батча
+        self.ingress = Pipeline('ingress')
+        self.egress = Pipeline('egress')
+        self.transport.tx_pipeline = self.ingress
+        self.transport.rx_pipeline = self.egress
+        # Потерянный кадр поток повторит по RTO, но выбрасывать их незачем:
+        # очередь и так ограничена окнами потоков
+        self.transport.drop_oldest = False
+
+    async def initialize(self, mode: str):
+        self.mode = mode
+        self.stop_event = asyncio.Event()
+        metrics.gauge('televpn_proxy_streams_active', 'Open proxy streams', fn=lambda: len(self.streams))
+
+        if mode == 'server' and config.clients:
+            # Потоки не привязаны к IP клиента: обслуживается основной чат/peer
+            print("⚠️ Proxy mode serves a single client; 'clients' from config are ignored")
+        if not await self.transport.initialize(self._handle_frame, mode=mode):
+            return False
+
+        if mode == 'client':
+            try:
+                self.listener = await asyncio.start_server(self._on_socks_client,
+                                                           config.proxy_listen_host, config.proxy_port)
+            except OSError as e:
+                print(f"❌ SOCKS5 listener failed: {e}")
+                await self.transport.disconnect()
+                return False
+            print(f"🧦 SOCKS5 proxy on {config.proxy_listen_host}:{config.proxy_port}")
+
+        self.reaper_task = asyncio.create_task(self._reap_idle())
+        self.retransmit_task = asyncio.create_task(self._retransmit_loop())
+        self.is_running = True
+        return True
+
+    async def start_reading_packets(self):
+        # Работа идёт в колбэках сокетов и транспорта — ждём остановки
+        await self.stop_event.wait()
+
+    async def send_frame(self, ftype: int, sid: int, body: bytes = b''):
+        await self.transport.send_data(_HEADER.pack(ftype, sid) + body)
+
+    def spawn(self, coro):
+        """Отправка кадра отдельной задачей: ссылка хранится до завершения, ошибка печатается"""
+        task = asyncio.create_task(coro)
+        self.frame_tasks.add(task)
+        task.add_done_callback(self._frame_task_done)
+
+    def _frame_task_done(self, task: asyncio.Task):
+        self.frame_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"⚠️ Proxy frame send failed: {task.exception()}")
+
+    def rto(self) -> float:
+        """
+        RTO по RFC 6298: большее из оценок по RTT туннеля (пробы эха) и по
+        подтверждениям потоков. Пробы не видят ожидания в батчере: кадр ждёт
+        до batch_interval, подтверждение — ещё до трёх.
+        """
+        candidates = []
+        rtt = self.transport.rtt
+        if rtt.srtt is not None:
+            candidates.append(rtt.srtt + 4 * rtt.jitter + 4 * config.batch_interval)
+        if self.ack_rtt.srtt is not None:
+            candidates.append(self.ack_rtt.srtt + 4 * self.ack_rtt.jitter)
+        if not candidates:
+            return RTO_INITIAL
+        return min(RTO_MAX, max(RTO_MIN, *candidates))
+
+    def remember_closed(self, sid: int, ack: Optional[int]):
+        self.closed[sid] = ack
+        self.closed.move_to_end(sid)
+        if len(self.closed) > CLOSED_MEMORY:
+            self.closed.popitem(last=False)
+
+    # --- Клиент: SOCKS5 ---
+
+    async def _on_socks_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            target = await asyncio.wait_for(self._socks_handshake(reader, writer), config.proxy_connect_timeout)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError, ValueError):
+            target = None
+        if target is None:
+            writer.close()
+            return
+
+        host, port = target
+        sid = self.next_sid
+        self.next_sid = (self.next_sid + 1) & 0xFFFFFFFF or 1
+        stream = ProxyStream(self, sid, reader, writer)
+        stream.task = asyncio.current_task()
+        self.streams[sid] = stream
+        metrics.proxy_streams.inc()
+        request = _PORT.pack(port) + host.encode()
+        await self.send_frame(FRAME_OPEN, sid, request)
+
+        deadline = time.monotonic() + config.proxy_connect_timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            try:
+                code = await asyncio.wait_for(asyncio.shield(stream.opened), max(0.0, min(self.rto(), remaining)))
+                break
+            except asyncio.TimeoutError:
+                if remaining <= self.rto():
+                    code = SOCKS_HOST_UNREACHABLE
+                    stream.abort(notify=True)
+                    break
+            # Потерялся OPEN или ответ на него: сервер на повтор ответит снова
+            await self.send_frame(FRAME_OPEN, sid, request)
+        try:
+            writer.write(_socks_reply(code))
+            await writer.drain()
+        except (ConnectionError, OSError):
+            stream.abort(notify=True)
+            return
+        if code != SOCKS_OK:
+            metrics.proxy_open_failures.inc()
+            stream._close()
+            return
+        await stream.run()
+
+    async def _socks_handshake(self, reader, writer):
+        """(host, port) запроса CONNECT или None (ответ с ошибкой уже отправлен)"""
+        version, nmethods = await reader.readexactly(2)
+        if version != SOCKS_VERSION:
+            raise ValueError("not a SOCKS5 client")
+        methods = await reader.readexactly(nmethods)
+        if 0 not in methods:
+            # Поддерживается только "без аутентификации": прокси слушает localhost
+            writer.write(b'\x05\xff')
+            return None
+        writer.write(b'\x05\x00')
+
+        _, cmd, _, atyp = await reader.readexactly(4)
+        if atyp == 1:
+            host = socket.inet_ntoa(await reader.readexactly(4))
+        elif atyp == 3:
+            size = (await reader.readexactly(1))[0]
+            host = (await reader.readexactly(size)).decode('ascii', 'replace')
+        elif atyp == 4:
+            host = socket.inet_ntop(socket.AF_INET6, await reader.readexactly(16))
+        else:
+            writer.write(_socks_reply(SOCKS_ATYP_UNSUPPORTED))
+            return None
+        port = _PORT.unpack(await reader.readexactly(2))[0]
+        if cmd != 1:
+            writer.write(_socks_reply(SOCKS_CMD_UNSUPPORTED))
+            return None
+        return host, port
+
+    # --- Сервер: настоящие сокеты ---
+
+    async def _connect(self, stream: ProxyStream, host: str, port: int):
+        try:
+            stream.reader, stream.writer = await asyncio.wait_for(asyncio.open_connection(host, port),
+                                                                  config.proxy_connect_timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            self.streams.pop(stream.sid, None)
+            metrics.proxy_open_failures.inc()
+            await self.send_frame(FRAME_OPEN_FAIL, stream.sid, bytes((_reply_code(e),)))
+            return
+        await self.send_frame(FRAME_OPEN_OK, stream.sid)
+        await stream.run()
+
+    # --- Кадры из транспорта ---
+
+    async def _handle_frame(self, frame: bytes):
+        if not self.is_running or len(frame) < _HEADER.size:
+            return
+        ftype, sid = _HEADER.unpack_from(frame)
+        if ftype >> 4 in (4, 6):
+            # Версия IP в первом полубайте: пир работает в режиме VPN
+            if not self.peer_mode_warned:
+                self.peer_mode_warned = True
+                print("⚠️ Peer sends IP packets: set handler_type to 'proxy' on both ends")
+            return
+        body = frame[_HEADER.size:]
+        stream = self.streams.get(sid)
+
+        if ftype == FRAME_OPEN:
+            if self.mode != 'server' or sid in self.closed or len(body) < 3:
+                return
+            if stream is not None:
+                # Повтор OPEN: наш OPEN_OK потерялся (пока соединяемся — ответим потом)
+                if stream.writer is not None:
+                    await self.send_frame(FRAME_OPEN_OK, sid)
+                return
+            port = _PORT.unpack_from(body)[0]
+            host = bytes(body[2:]).decode('utf-8', 'replace')
+            stream = ProxyStream(self, sid)
+            self.streams[sid] = stream
+            metrics.proxy_streams.inc()
+            stream.task = asyncio.create_task(self._connect(stream, host, port))
+        elif stream is None:
+            # Хвост закрытого потока: пир не получил наше последнее подтверждение или RESET
+            if ftype in (FRAME_DATA, FRAME_CLOSE, FRAME_WINDOW):
+                ack = self.closed.get(sid)
+                if ack is None:
+                    await self.send_frame(FRAME_RESET, sid)
+                elif ftype != FRAME_WINDOW:
+                    await self.send_frame(FRAME_WINDOW, sid, _WINDOW.pack(ack, ack))
+            return
+        elif ftype == FRAME_DATA:
+            stream.on_data(_OFFSET.unpack_from(body)[0], bytes(body[_OFFSET.size:]))
+        elif ftype == FRAME_WINDOW:
+            if len(body) >= _WINDOW.size:
+                limit, ack = _WINDOW.unpack_from(body)
+                sacked = [_OFFSET.unpack_from(body, pos)[0] for pos in range(_WINDOW.size, len(body) - 7, _OFFSET.size)]
+                stream.on_window(limit, ack, sacked)
+        elif ftype == FRAME_CLOSE:
+            stream.on_close(_OFFSET.unpack_from(body)[0])
+        elif ftype == FRAME_RESET:
+            stream.abort()
+        elif ftype in (FRAME_OPEN_OK, FRAME_OPEN_FAIL) and not stream.opened.done():
+            stream.opened.set_result(SOCKS_OK if ftype == FRAME_OPEN_OK else (body[0] if body else SOCKS_FAILURE))
+
+    async def _retransmit_loop(self):
+        """Один таймер на все потоки: повторы по RTO и отложенные подтверждения"""
+        while True:
+            await asyncio.sleep(max(0.05, config.batch_interval))
+            now = time.monotonic()
+            rto = self.rto()
+            for stream in list(self.streams.values()):
+                if stream.running:
+                    await stream.on_timer(now, rto)
+
+    async def _reap_idle(self):
+        """
+        Потоки без активности дольше proxy_idle_timeout сбрасываются: если
+        батч с их данными потерялся, сборка по смещению стоит навсегда.
+        """
+        while True:
+            await asyncio.sleep(min(30.0, config.proxy_idle_timeout))
+            deadline = time.monotonic() - config.proxy_idle_timeout
+            for stream in list(self.streams.values()):
+                if stream.last_activity < deadline:
+                    stream.abort(notify=True)
+
+    def stats(self) -> dict:
+        return {'streams': len(self.streams),
+                'buffered': sum(sum(map(len, s.early.values())) for s in self.streams.values()),
+                'unacked': sum(s.sent - min(s.acked, s.sent) for s in self.streams.values())}
+
+    async def shutdown(self):
+        self.is_running = False
+        if self.listener:
+            self.listener.close()
+            self.listener = None
+        if self.reaper_task:
+            self.reaper_task.cancel()
+        if self.retransmit_task:
+            self.retransmit_task.cancel()
+        for stream in list(self.streams.values()):
+            stream.abort()
+        for task in list(self.frame_tasks):
+            task.cancel()
+        if self.stop_event:
+            self.stop_event.set()
+        await self.transport.disconnect()
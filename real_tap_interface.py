@@ -1,11 +1,14 @@
 # --- START OF FILE real_tap_interface.py ---
 
 import os
+import sys
 import asyncio
 import subprocess
 import ctypes
 from ctypes import wintypes
 
+from metrics import metrics
+
 
 class RealTapInterface:
     """Работа с TAP-Windows6 напрямую через \\\\.\\Global\\{GUID}.tap"""
@@ -22,6 +25,10 @@ class RealTapInterface:
     # === 1. Поиск TAP интерфейса ===
     def find_tap_interface(self) -> bool:
         """Находит TAP-интерфейс и GUID через PowerShell"""
+        if sys.platform != 'win32':
+            # На Linux packet_handler берёт linux_tap_interface; других бэкендов TAP нет
+            print(f"❌ TAP-Windows is not available on {sys.platform}: no TAP backend for this OS")
+            return False
         try:
             ps_script = '''
             $tap = Get-NetAdapter | Where-Object {$_.InterfaceDescription -like "*TAP*"} | Select-Object -First 1
@@ -165,6 +172,8 @@ class RealTapInterface:
                 data = await loop.run_in_executor(None, self._read_from_tap)
                 if data:
                     self.packet_count += 1
+                    metrics.tap_rx_packets.inc()
+                    metrics.tap_rx_bytes.inc(len(data))
                     await packet_handler(data)
             except Exception as e:
                 print(f"❌ Error reading TAP: {e}")
@@ -194,6 +203,8 @@ class RealTapInterface:
 
             loop = asyncio.get_event_loop()
             await loop.run_in_executor(None, lambda: self._write_to_tap(packet))
+            metrics.tap_tx_packets.inc()
+            metrics.tap_tx_bytes.inc(len(packet))
             return True
         except Exception as e:
             print(f"❌ Error writing TAP packet: {e}")
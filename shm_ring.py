@@ -0,0 +1,117 @@
+# --- START OF FILE shm_ring.py ---
+"""
+Кольцевой буфер одного писателя и одного читателя (SPSC) в
+multiprocessing.shared_memory — канал данных между процессами data plane.
+
+Раскладка сегмента:
+    [head: 8][...][tail: 8][...][данные: size]
+head и tail — счётчики байт, только растут (позиция — по модулю size).
+tail пишет только писатель, head — только читатель, поэтому блокировки
+не нужны. Запись: [длина: 4][данные], выровнена на 8 байт, так что
+заголовок всегда помещается до конца области; не влезающая целиком
+запись начинается с нуля, а остаток помечается WRAP.
+
+Порядок записей данных и счётчика держится тем, что читатель смотрит в
+кольцо только после "звонка" через Pipe (системный вызов — барьер);
+сам звонок — забота вызывающего (data_plane.py).
+"""
+import struct
+from multiprocessing import shared_memory
+from typing import Optional
+
+_COUNTER = struct.Struct('<Q')
+_LENGTH = struct.Struct('<I')
+HEAD_OFFSET = 0
+TAIL_OFFSET = 64  # счётчики в разных строках кэша
+DATA_OFFSET = 128
+WRAP = 0xFFFFFFFF
+
+
+def _aligned(n: int) -> int:
+    return (n + 7) & ~7
+
+
+class ShmRing:
+    def __init__(self, size: int, name: Optional[str] = None):
+        """Новый сегмент на size байт данных или (name) подключение к созданному другим процессом"""
+        self.size = _aligned(max(size, 4096))
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=DATA_OFFSET + self.size)
+            self.owner = True
+            _COUNTER.pack_into(self.shm.buf, HEAD_OFFSET, 0)
+            _COUNTER.pack_into(self.shm.buf, TAIL_OFFSET, 0)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        self.buf = self.shm.buf
+
+    def attach_args(self) -> tuple:
+        """Аргументы ShmRing(...) для другого процесса"""
+        return self.size, self.shm.name
+
+    def _head(self) -> int:
+        return _COUNTER.unpack_from(self.buf, HEAD_OFFSET)[0]
+
+    def _tail(self) -> int:
+        return _COUNTER.unpack_from(self.buf, TAIL_OFFSET)[0]
+
+    def __len__(self):
+        """Занято байт (с заголовками и выравниванием)"""
+        return self._tail() - self._head()
+
+    def fits(self, n: int) -> bool:
+        """Запись n байт в принципе помещается в пустое кольцо"""
+        return _aligned(4 + n) <= self.size // 2
+
+    def push(self, *parts) -> bool:
+        """Записать части одной записью; False — места сейчас нет"""
+        n = sum(len(p) for p in parts)
+        need = _aligned(4 + n)
+        head, tail = self._head(), self._tail()
+        pos = tail % self.size
+        skip = self.size - pos if pos + need > self.size else 0
+        if tail + skip + need - head > self.size:
+            return False
+        buf = self.buf
+        if skip:
+            _LENGTH.pack_into(buf, DATA_OFFSET + pos, WRAP)
+            tail += skip
+            pos = 0
+        at = DATA_OFFSET + pos
+        _LENGTH.pack_into(buf, at, n)
+        at += 4
+        for p in parts:
+            buf[at:at + len(p)] = p
+            at += len(p)
+        _COUNTER.pack_into(buf, TAIL_OFFSET, tail + need)
+        return True
+
+    def pop(self) -> Optional[bytes]:
+        """Следующая запись (копия) или None, если кольцо пусто"""
+        head, tail = self._head(), self._tail()
+        buf = self.buf
+        while head < tail:
+            pos = head % self.size
+            n = _LENGTH.unpack_from(buf, DATA_OFFSET + pos)[0]
+            if n == WRAP:
+                head += self.size - pos
+                continue
+            at = DATA_OFFSET + pos + 4
+            data = bytes(buf[at:at + n])
+            _COUNTER.pack_into(buf, HEAD_OFFSET, head + _aligned(4 + n))
+            return data
+        if head != self._head():
+            _COUNTER.pack_into(buf, HEAD_OFFSET, head)
+        return None
+
+    def close(self):
+        self.buf = None
+        try:
+            self.shm.close()
+        except BufferError:
+            pass  # ещё живы memoryview на сегмент — освободит сборщик
+        if self.owner:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,104 @@
+# --- START OF FILE tcp_dedup.py ---
+"""
+Подавление повторных передач TCP до загрузки в мессенджер.
+
+RTT туннеля — секунды, поэтому TCP на стороне TAP успевает
+перепослать сегмент, который ещё лежит в очереди отправки или летит в
+загрузке. Такой повтор — тот же поток, тот же seq и та же длина в
+пространстве номеров (данные + SYN/FIN). Отпечатки этих сегментов лежат
+в таблице фиксированного размера с прямой адресацией (array, без
+объектов на запись): коллизия просто вытесняет старую запись, так что
+память ограничена, а ошибка возможна только в сторону "пропустить".
+
+Подавление привязано к судьбе оригинала, а не к часам:
+  * в очереди или в неотправленном батче (pending) — повтор подавляется;
+    транспорт хранит отпечатки пакетов батча в BatchBuffer.fingerprints;
+  * загружен (sent) — ещё window секунд, пока он идёт до пира;
+  * выброшен (переполнение очереди или backlog, ошибка загрузки) —
+    транспорт зовёт forget(), и первый же настоящий повтор TCP уходит.
+PENDING_LIMIT — страховка на случай потерянного без forget() батча.
+"""
+from array import array
+
+from packet_view import PacketView, PROTO_TCP, ETH_IPV6
+
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+TCP_RST = 0x04
+
+_MASK64 = 0xFFFFFFFFFFFFFFFF
+PENDING_LIMIT = 60.0
+
+
+class RetransmitFilter:
+    def __init__(self, slots: int = 4096):
+        size = 1 << max(0, slots - 1).bit_length()
+        self.mask = size - 1
+        self.keys = array('Q', bytes(8 * size))
+        self.stamps = array('d', bytes(8 * size))
+        # 1 — оригинал ещё не загружен (stamps — время постановки), 0 — загружен (время загрузки)
+        self.pending = bytearray(size)
+        self.suppressed = 0
+        self.suppressed_bytes = 0
+        self.forgotten = 0
+
+    @staticmethod
+    def fingerprint(view: PacketView) -> int:
+        """Отпечаток сегмента с данными / SYN / FIN; 0 — пакет не отслеживается"""
+        if view.protocol != PROTO_TCP or view.malformed or view.sport < 0:
+            return 0
+        flags = view.tcp_flags
+        if flags & TCP_RST:
+            return 0
+        frame = view.frame
+        l4 = 14 + view.ihl
+        if view.length < l4 + 20:
+            return 0
+        if view.ethertype == ETH_IPV6:
+            total = ((frame[18] << 8) | frame[19]) + 40  # payload length + фиксированный заголовок
+        else:
+            total = (frame[16] << 8) | frame[17]
+        data_offset = (frame[l4 + 12] >> 4) * 4
+        # Длина в пространстве номеров: SYN и FIN занимают по одному номеру
+        seg_len = total - view.ihl - data_offset + ((flags & TCP_SYN) >> 1) + (flags & TCP_FIN)
+        if seg_len <= 0:
+            return 0  # чистые ACK не трогаем
+        seq = int.from_bytes(frame[l4 + 4:l4 + 8], 'big')
+        return (hash((view.src, view.dst, view.sport, view.dport, seq, seg_len)) & _MASK64) or 1
+
+    def is_retransmit(self, key: int, now: float, window: float, nbytes: int = 0) -> bool:
+        """
+        True — повтор сегмента, который ещё ждёт отправки или загружен меньше
+        window секунд назад. Иначе сегмент запоминается как ожидающий.
+        """
+        i = key & self.mask
+        if self.keys[i] == key:
+            age = now - self.stamps[i]
+            if age < (PENDING_LIMIT if self.pending[i] else window):
+                self.suppressed += 1
+                self.suppressed_bytes += nbytes
+                return True
+        self.keys[i] = key
+        self.stamps[i] = now
+        self.pending[i] = 1
+        return False
+
+    def sent(self, keys, now: float):
+        """Батч с этими сегментами загружен: окно повтора отсчитывается отсюда"""
+        for key in keys:
+            i = key & self.mask
+            if self.keys[i] == key:
+                self.stamps[i] = now
+                self.pending[i] = 0
+
+    def forget(self, keys):
+        """Сегменты выброшены, не дойдя до мессенджера: их повторы больше не подавляются"""
+        for key in keys:
+            i = key & self.mask
+            if self.keys[i] == key:
+                self.keys[i] = 0
+                self.forgotten += 1
+
+    def stats(self) -> dict:
+        return {'slots': self.mask + 1, 'suppressed': self.suppressed, 'suppressed_bytes': self.suppressed_bytes,
+                'pending': sum(self.pending), 'forgotten': self.forgotten}
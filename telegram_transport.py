@@ -1,19 +1,20 @@
 # --- START OF FILE telegram_transport.py ---
 from telethon import TelegramClient, events
+from telethon.sessions import StringSession
 import asyncio
-import time
-import io
 import logging
+import time
 from typing import Callable, Optional
 from config import config
-from crypto_utils import CryptoManager
-from compressor import Compressor
+from base_transport import BaseTransport
+from batch_buffer import BatchBuffer, BufferReader
+from metrics import metrics
 
 # Настройка логгера (чтобы видеть ошибки в консоли GUI)
 logger = logging.getLogger("VPN_Core")
 
 
-class TelegramBotTransport:
+class TelegramBotTransport(BaseTransport):
     # --- ВАЖНО: Статические переменные ---
     # Они заполняются из main.py ДО создания экземпляра класса.
     # Не удаляйте и не переносите их в __init__.
@@ -21,17 +22,25 @@ class TelegramBotTransport:
     code_callback: Optional[Callable] = None
     password_callback: Optional[Callable] = None
 
-    def __init__(self):
-        self.client: Optional[TelegramClient] = None
-        self.receive_callback = None
-        self.crypto = CryptoManager(config.encryption_key)
-        self.compressor = Compressor()
-        self.is_connected = False
+    def __init__(self, chat_id=None, encryption_key: Optional[str] = None,
+                 owner: Optional['TelegramBotTransport'] = None):
+        super().__init__(encryption_key)
+        # chat_id / owner задаются для сессий многоклиентского сервера:
+        # у каждого клиента свой чат, а подключение бота общее (его держит owner)
+        self.chat_id = chat_id if chat_id is not None else config.chat_id
+        self.owner = owner
+        self.client: Optional[TelegramClient] = owner.client if owner else None
+        self.owns_client = owner is None
+        self.sharers = []
+        if owner: owner.sharers.append(self)
         self.chat_entity = None
-        self.send_queue = asyncio.Queue()
-        self.sender_task = None
         self.me = None
-        self.upload_semaphore = asyncio.Semaphore(5)
+        self.watch_task = None
+        # Горячий резерв: второе подключение с тем же ключом авторизации
+        self.standby: Optional[TelegramClient] = None
+        self.standby_task = None
+        # Закрытие старого подключения после перехода на резерв — в фоне, но не без присмотра
+        self.retire_task = None
         # УБРАНО обнуление callbacks здесь, чтобы использовались статические переменные
 
     async def initialize(self, receive_callback: Callable, mode: str = 'server'):
@@ -39,6 +48,9 @@ class TelegramBotTransport:
         is_client = (mode == 'client')
 
         try:
+            if not self.owns_client:
+                return await self._start_session()
+
             print(f"🔗 Telegram Connecting ({mode.upper()})...")
             session_name = 'vpn_client_session' if is_client else 'vpn_server_session'
 
@@ -63,154 +75,185 @@ class TelegramBotTransport:
                 await self.client.start(bot_token=config.bot_token)
 
             self.me = await self.client.get_me()
-            self.is_connected = True
-
             username = self.me.username if self.me.username else self.me.first_name
             print(f"✅ Logged in as: {username} (ID: {self.me.id})")
 
-            await self._setup_chat()
-
-            self.sender_task = asyncio.create_task(self._batch_sender_worker())
-
-            @self.client.on(events.NewMessage(chats=self.chat_entity))
-            async def handler(event):
-                if event.sender_id == self.me.id: return
-                asyncio.create_task(self._handle_new_message(event))
-
-            return True
+            return await self._start_session()
         except Exception as e:
             print(f"❌ Telegram Init Error: {e}")
             import traceback
             traceback.print_exc()  # Печатаем полный лог ошибки
             return False
 
-    async def _setup_chat(self):
-        try:
-            self.chat_entity = await self.client.get_entity(config.chat_id)
-            print(f"✅ Tunnel Endpoint: {config.chat_id}")
-        except Exception as e:
-            print(f"⚠️ Error getting chat entity: {e}")
-            raise e
+    async def _start_session(self):
+        """Чат туннеля, батчер и подписка на сообщения (клиент уже авторизован)"""
+        if self.me is None:
+            self.me = await self.client.get_me()
+        self.is_connected = True
 
-    async def send_data(self, data: bytes):
-        if not self.is_connected: return
-        if self.send_queue.qsize() > 5000:
-            try:
-                self.send_queue.get_nowait()
-            except:
-                pass
-        await self.send_queue.put(data)
+        await self._setup_chat()
 
-    async def _batch_sender_worker(self):
-        print("📦 Batch sender started")
-        buffer = bytearray()
+        self.sender_task = asyncio.create_task(self._batch_sender_worker())
+        self._subscribe()
+        if self.owns_client:
+            self._watch_connection()
+            self._start_standby()
+        return True
 
-        while self.is_connected:
-            try:
-                packet = await self.send_queue.get()
-                self._append_to_buffer(buffer, packet)
-                self.send_queue.task_done()
-
-                start_time = time.time()
-                while len(buffer) < config.max_batch_size:
-                    elapsed = time.time() - start_time
-                    remaining = config.batch_interval - elapsed
-                    if remaining <= 0: break
-                    try:
-                        packet = await asyncio.wait_for(self.send_queue.get(), timeout=remaining)
-                        self._append_to_buffer(buffer, packet)
-                        self.send_queue.task_done()
-                    except asyncio.TimeoutError:
-                        break
-
-                if buffer:
-                    data_to_send = bytes(buffer)
-                    buffer.clear()
-                    asyncio.create_task(self._send_batch_task(data_to_send))
-
-            except asyncio.CancelledError:
-                break
-            except Exception as e:
-                print(f"❌ Worker Error: {e}")
-                buffer.clear()
-                await asyncio.sleep(0.1)
+    def _subscribe(self):
+        self.client.add_event_handler(self._on_new_message, events.NewMessage(chats=self.chat_entity))
+
+    async def _on_new_message(self, event):
+        if event.sender_id == self.me.id: return
+        # Ждём места в пуле: пока он занят, Telethon не разбирает следующие обновления
+        await self.download_pool.submit(event)
 
-    def _append_to_buffer(self, buffer: bytearray, packet: bytes):
-        length = len(packet)
-        buffer.extend(length.to_bytes(2, 'big'))
-        buffer.extend(packet)
+    # --- Переподключение ---
 
-    async def _send_batch_task(self, raw_data: bytes):
-        async with self.upload_semaphore:
+    def _watch_connection(self):
+        """
+        Telethon сам повторяет соединение (connection_retries) и завершает
+        client.disconnected, только когда сдался. Тогда чиним канал сами.
+        """
+        async def watch(client):
             try:
-                if config.compression_enabled:
-                    data_to_send = self.compressor.compress(raw_data)
-                else:
-                    data_to_send = raw_data
-
-                encrypted_data = self.crypto.encrypt(data_to_send)
-
-                # Лог отправки (можно закомментировать, если спамит)
-                size_kb = len(encrypted_data) / 1024
-                # print(f"📤 UP: {size_kb:.1f} KB")
-
-                file_obj = io.BytesIO(encrypted_data)
-                file_obj.name = "d"
-
-                await self.client.send_file(
-                    self.chat_entity,
-                    file_obj,
-                    force_document=True,
-                    allow_cache=False,
-                    attributes=[]
-                )
+                await client.disconnected
             except Exception as e:
-                print(f"⚠️ Send Error: {e}")
+                reason = e
+            else:
+                reason = ConnectionError("Telegram connection closed")
+            if self.is_connected and client is self.client:
+                self.connection_lost(reason)
+
+        if self.watch_task: self.watch_task.cancel()
+        self.watch_task = asyncio.create_task(watch(self.client))
+
+    def _start_standby(self):
+        """Горячий резерв (config.hot_standby): подключён и авторизован, обновлений не получает"""
+        if not config.hot_standby or self.standby is not None:
+            return
+        if self.standby_task and not self.standby_task.done():
+            return
+
+        async def connect():
+            client = TelegramClient(StringSession(StringSession.save(self.client.session)),
+                                    config.api_id, config.api_hash, receive_updates=False)
+            client.flood_sleep_threshold = self.client.flood_sleep_threshold
+            try:
+                await client.connect()
+                if not await client.is_user_authorized():
+                    raise ConnectionError("standby session is not authorized")
+            except Exception as e:
+                print(f"⚠️ Hot standby not ready: {e}")
+                await client.disconnect()
+                return
+            if self.is_connected:
+                self.standby = client
+                print("🛟 Hot standby connection ready")
+            else:
+                await client.disconnect()
+
+        self.standby_task = asyncio.create_task(connect())
+
+    async def _reconnect(self) -> bool:
+        if not self.owns_client:
+            # Подключение общее: его восстанавливает сессия-владелец
+            return self.owner.link_up
+        if self.standby is not None and self.standby.is_connected():
+            old, self.client, self.standby = self.client, self.standby, None
+            await self.client.set_receive_updates(True)
+            print("🛟 Switched to hot standby connection")
+            self._retire(old)
+            for t in [self] + self.sharers:
+                t.client = self.client
+                t._subscribe()
+        else:
+            if not self.client.is_connected():
+                await self.client.connect()
+            if not await self.client.is_user_authorized():
+                raise ConnectionError("session is not authorized")
+            # Телетон подтягивает пропущенные обновления после GetState
+            await self.client.set_receive_updates(True)
+        self._watch_connection()
+        self._start_standby()
+        return True
+
+    def _retire(self, old: TelegramClient):
+        """Закрыть сломанное подключение, не задерживая переход на резерв"""
+        async def close(previous):
+            if previous is not None:
+                await asyncio.gather(previous, return_exceptions=True)
+            try:
+                await asyncio.wait_for(old.disconnect(), 10.0)
+            except asyncio.TimeoutError:
+                print("⚠️ Old connection did not close in 10s")
+            except Exception as e:
+                print(f"⚠️ Old connection did not close cleanly: {e}")
+
+        self.retire_task = asyncio.create_task(close(self.retire_task))
+
+    async def _setup_chat(self):
+        try:
+            self.chat_entity = await self.client.get_entity(self.chat_id)
+            print(f"✅ Tunnel Endpoint: {self.chat_id}")
+        except Exception as e:
+            print(f"⚠️ Error getting chat entity: {e}")
+            raise e
 
-    async def _handle_new_message(self, event):
+    async def _send_batch_task(self, batch: BatchBuffer):
         try:
-            if not event.message.file: return
+            batch = await self._encode_batch_async(batch)
+            encrypted_data = batch.sealed
+
+            # Лог отправки (можно закомментировать, если спамит)
+            size_kb = len(encrypted_data) / 1024
+            # print(f"📤 UP: {size_kb:.1f} KB")
+
+            # Telethon читает части файла прямо из буфера батча
+            file_obj = BufferReader(encrypted_data, "d")
+
+            start = time.perf_counter()
+            await self.client.send_file(
+                self.chat_entity,
+                file_obj,
+                force_document=True,
+                allow_cache=False,
+                attributes=[]
+            )
+            metrics.upload_seconds.time(start)
+            metrics.upload_bytes.inc(len(encrypted_data))
+            self._batch_uploaded(batch)
+        except Exception as e:
+            if not self._upload_failed(batch, e):
+                print(f"⚠️ Send Error: {e}")
+            return
+        self._release_batch(batch)
 
-            encrypted_data = await event.message.download_media(file=bytes)
-            if not encrypted_data: return
+    async def _download_task(self, event):
+        # Ошибки скачивания печатает и считает пул (televpn_pool_download_errors_total)
+        if not event.message.file: return
 
-            # Лог приема (можно закомментировать)
-            # size_kb = len(encrypted_data) / 1024
-            # print(f"📥 DOWN: {size_kb:.1f} KB")
+        start = time.perf_counter()
+        encrypted_data = await event.message.download_media(file=bytes)
+        if not encrypted_data: return
+        metrics.download_seconds.time(start)
 
-            try:
-                decrypted_data = self.crypto.decrypt(encrypted_data)
-            except:
-                return
+        # Лог приема (можно закомментировать)
+        # size_kb = len(encrypted_data) / 1024
+        # print(f"📥 DOWN: {size_kb:.1f} KB")
 
-            if config.compression_enabled:
-                try:
-                    batch_data = self.compressor.decompress(decrypted_data)
-                except:
-                    print("⚠️ Decompression failed")
-                    return
-            else:
-                batch_data = decrypted_data
+        try:
+            batch_data = await self._decode_batch_async(encrypted_data)
+        except Exception:
+            print("⚠️ Batch decode failed")
+            return
 
-            await self._parse_batch_and_route(batch_data)
-        except Exception as e:
-            print(f"❌ Recv Error: {e}")
-
-    async def _parse_batch_and_route(self, data: bytes):
-        idx = 0
-        total_len = len(data)
-        while idx < total_len:
-            if idx + 2 > total_len: break
-            pkt_len = int.from_bytes(data[idx:idx + 2], 'big')
-            idx += 2
-            if idx + pkt_len > total_len: break
-            packet = data[idx:idx + pkt_len]
-            idx += pkt_len
-
-            if self.receive_callback:
-                await self.receive_callback(packet)
+        await self._parse_batch_and_route(batch_data)
 
     async def disconnect(self):
-        self.is_connected = False
-        if self.sender_task: self.sender_task.cancel()
-        if self.client: await self.client.disconnect()
\ No newline at end of file
+        await super().disconnect()
+        if self.watch_task: self.watch_task.cancel()
+        if self.standby_task: self.standby_task.cancel()
+        if self.retire_task: await asyncio.gather(self.retire_task, return_exceptions=True)
+        if self.standby: await self.standby.disconnect()
+        if self.client and self.owns_client: await self.client.disconnect()
\ No newline at end of file
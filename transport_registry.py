@@ -0,0 +1,117 @@
+# --- START OF FILE transport_registry.py ---
+"""
+Реестр транспортов с ленивой загрузкой.
+
+Транспорт задаётся именем ('telegram', 'vk', 'loopback' или сторонний
+плагин из entry point группы "televpn.transports"). Модуль с тяжёлыми
+зависимостями (Telethon, vk_api + requests) импортируется только когда
+этот транспорт выбран. Время импорта и память процесса видны в
+startup_report().
+"""
+import importlib
+import os
+import sys
+import time
+from typing import Dict, List, Optional
+
+ENTRY_POINT_GROUP = 'televpn.transports'
+
+# Имя -> "модуль:класс" (как в entry points)
+BUILTIN_TRANSPORTS = {
+    'telegram': 'telegram_transport:TelegramBotTransport',
+    'vk': 'vk_transport:VKTransport',
+    'loopback': 'loopback_transport:LoopbackTransport',
+}
+
+# Отсчёт старта процесса (модуль импортируется одним из первых)
+PROCESS_START = time.perf_counter()
+
+_classes: Dict[str, type] = {}
+import_seconds: Dict[str, float] = {}
+
+
+def _entry_points() -> Dict[str, str]:
+    try:
+        from importlib.metadata import entry_points
+        eps = entry_points()
+        group = eps.select(group=ENTRY_POINT_GROUP) if hasattr(eps, 'select') else eps.get(ENTRY_POINT_GROUP, [])
+        return {ep.name: ep.value for ep in group}
+    except Exception:
+        return {}
+
+
+def available() -> List[str]:
+    return sorted(set(BUILTIN_TRANSPORTS) | set(_entry_points()))
+
+
+def get_transport_class(name: str) -> type:
+    """Класс транспорта; модуль импортируется при первом обращении"""
+    cls = _classes.get(name)
+    if cls is not None:
+        return cls
+    target = BUILTIN_TRANSPORTS.get(name) or _entry_points().get(name)
+    if target is None:
+        raise ValueError(f"Unknown transport '{name}'. Available: {', '.join(available())}")
+    module_name, _, attr = target.partition(':')
+    start = time.perf_counter()
+    module = importlib.import_module(module_name)
+    import_seconds[name] = time.perf_counter() - start
+    cls = _classes[name] = getattr(module, attr)
+    return cls
+
+
+def create_transport(name: str, **kwargs):
+    return get_transport_class(name)(**kwargs)
+
+
+def current_rss() -> Optional[int]:
+    """Резидентная память процесса, байт (None — не удалось узнать)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    if sys.platform == 'win32':
+        try:
+            import ctypes
+            from ctypes import wintypes
+
+            class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+                _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD),
+                            ('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+                            ('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                            ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                            ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t)]
+
+            counters = PROCESS_MEMORY_COUNTERS()
+            counters.cb = ctypes.sizeof(counters)
+            handle = ctypes.windll.kernel32.GetCurrentProcess()
+            if ctypes.windll.psapi.GetProcessMemoryInfo(handle, ctypes.byref(counters), counters.cb):
+                return counters.WorkingSetSize
+        except Exception:
+            pass
+    try:
+        import resource
+        # ru_maxrss — пик, в КБ на Linux и в байтах на macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+    except Exception:
+        return None
+
+
+def startup_report() -> dict:
+    rss = current_rss()
+    return {
+        'uptime_s': round(time.perf_counter() - PROCESS_START, 3),
+        'transport_import_ms': {k: round(v * 1000, 1) for k, v in import_seconds.items()},
+        'modules': len(sys.modules),
+        'rss_mb': round(rss / 1048576, 1) if rss else None,
+    }
+
+
+def print_startup_report():
+    r = startup_report()
+    imports = ", ".join(f"{k} {v:.0f}ms" for k, v in r['transport_import_ms'].items()) or "none"
+    rss = f"{r['rss_mb']} MB" if r['rss_mb'] is not None else "n/a"
+    print(f"⏱️ Startup {r['uptime_s'] * 1000:.0f}ms | transport import: {imports} | "
+          f"modules: {r['modules']} | RSS: {rss}")
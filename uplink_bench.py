@@ -0,0 +1,187 @@
+# --- START OF FILE uplink_bench.py ---
+"""
+Копирования на исходящем пути: кадр TAP -> загружаемый файл.
+
+Сравнивает прежний путь (packet[14:], bytearray.extend, bytes(buffer),
+gzip.compress, префикс флагов, pad(), gostcipher CBC, iv + шифротекст,
+BytesIO) с текущим (BatchBuffer + compress_into + encrypt_into +
+BufferReader). Для каждой стадии считается, сколько байт она копирует,
+по реальным размерам объектов прогона; копии внутри gostcipher CBC
+(срезы блоков и склейка result + block) — по его исходному коду.
+Работа самого блочного шифра (раунды Кузнечика) одинакова в обоих путях
+и не считается. Результат — JSON, главное поле copied_per_payload_byte.
+
+Примеры:
+    python uplink_bench.py
+    python uplink_bench.py --batch-bytes 262144 --compression --output copies.json
+"""
+import argparse
+import gzip
+import io
+import json
+import platform
+import random
+import sys
+import time
+from collections import OrderedDict
+
+from Crypto.Random import get_random_bytes
+from Crypto.Util.Padding import pad
+from gostcrypto import gostcipher
+
+from base_transport import BATCH_FLAG_GZIP
+from batch_buffer import BatchBuffer, BufferReader, HEADROOM
+from compressor import Compressor
+from crypto_utils import CryptoManager
+from packet_view import PacketView
+
+KEY = 'uplink-bench-key-0123456789abcde'
+ETH_HEADER = b'\x02\x00\x00\x00\x00\x01\x02\x00\x00\x00\x00\x02\x08\x00'
+TELETHON_PART = 512 * 1024  # send_file читает файл частями такого размера
+
+
+def make_frames(batch_bytes: int, seed: int, compressible: bool):
+    """Кадры TAP (Ethernet + IPv4) общим объёмом IP-пакетов ~batch_bytes"""
+    rng = random.Random(seed)
+    frames, total = [], 0
+    while total < batch_bytes:
+        size = rng.choice((60, 576, 1400, 1500))
+        if compressible:
+            body = (b'GET /index.html HTTP/1.1\r\nHost: example.com\r\n' * 40)[:size - 20]
+        else:
+            body = rng.randbytes(size - 20)
+        ip = bytes((0x45, 0)) + size.to_bytes(2, 'big') + bytes(8) + bytes((10, 8, 0, 2, 93, 184, 216, 34)) + body
+        frames.append(ETH_HEADER + ip)
+        total += size
+    return frames
+
+
+def cbc_internal_copies(padded: int) -> int:
+    """Копии внутри gostcipher GOST34132015cbc.encrypt для padded байт (IV в один блок)"""
+    blocks = padded // 16
+    # pad_mode_1: data + b'' ; на блок: _get_block, init_vect[0:16], cipher_block[0:16],
+    # запись в init_vect ; склейка result = result + cipher_block: 16 * (1 + 2 + ... + blocks)
+    return padded + blocks * 16 * 4 + 8 * blocks * (blocks + 1)
+
+
+def read_like_upload(stream) -> int:
+    """Чтение файла частями, как send_file/VkUpload. Возвращает прочитанные байты"""
+    n = 0
+    while True:
+        part = stream.read(TELETHON_PART)
+        if not part: return n
+        n += len(part)
+
+
+def legacy_path(frames, compression: bool):
+    copies = OrderedDict.fromkeys(('frame_slice', 'batch_append', 'batch_freeze', 'compress',
+                                   'flags_prefix', 'pad', 'cbc_internal', 'iv_concat',
+                                   'upload_read'), 0)
+    start = time.perf_counter()
+    buffer = bytearray()
+    for frame in frames:
+        packet = frame[14:]
+        copies['frame_slice'] += len(packet)
+        buffer.extend(len(packet).to_bytes(2, 'big'))
+        buffer.extend(packet)
+        copies['batch_append'] += len(packet) + 2
+    raw = bytes(buffer)
+    copies['batch_freeze'] += len(raw)
+    if compression:
+        body = gzip.compress(raw)
+        copies['compress'] += len(body)
+        data = bytes((BATCH_FLAG_GZIP,)) + body
+    else:
+        data = b'\x00' + raw
+    copies['flags_prefix'] += len(data)
+    iv = get_random_bytes(16)
+    cipher = gostcipher.new('kuznechik', KEY.encode(), gostcipher.MODE_CBC, init_vect=iv)
+    padded = pad(data, 16)
+    copies['pad'] += len(padded)
+    encrypted = cipher.encrypt(padded)
+    copies['cbc_internal'] += cbc_internal_copies(len(padded))
+    sealed = iv + encrypted
+    copies['iv_concat'] += len(sealed)
+    copies['upload_read'] += read_like_upload(io.BytesIO(sealed))
+    return copies, time.perf_counter() - start, len(sealed)
+
+
+def current_path(frames, compression: bool, crypto: CryptoManager):
+    copies = OrderedDict.fromkeys(('batch_append', 'compress', 'cbc_in_place', 'upload_read'), 0)
+    start = time.perf_counter()
+    batch = BatchBuffer()
+    for frame in frames:
+        packet = PacketView(frame).ip_packet
+        batch.append_packet(packet)
+        copies['batch_append'] += len(packet) + 2
+    flags = 0
+    if compression:
+        out = BatchBuffer()
+        Compressor.compress_into(batch.payload(), out)
+        # Выход zlib (bytes) и его запись в буфер
+        copies['compress'] += 2 * len(out)
+        batch, flags = out, BATCH_FLAG_GZIP
+    batch.buf[HEADROOM - 1] = flags
+    sealed = crypto.encrypt_into(batch.buf, HEADROOM - 1, batch.end)
+    # На блок: чтение среза и запись результата на место; плюс паддинг
+    padded = len(sealed) - 16
+    copies['cbc_in_place'] += padded * 2 + padded - (batch.end - HEADROOM + 1)
+    copies['upload_read'] += read_like_upload(BufferReader(sealed, 'd'))
+    return copies, time.perf_counter() - start, len(sealed)
+
+
+def run(args) -> dict:
+    crypto = CryptoManager(KEY)
+    result = {'meta': {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+                       'platform': platform.platform()},
+              'params': {'batch_bytes': args.batch_bytes, 'batches': args.batches,
+                         'compression': args.compression, 'compressible': args.compressible}}
+    for name in ('legacy', 'current'):
+        totals, seconds, payload, sealed_bytes = OrderedDict(), 0.0, 0, 0
+        for i in range(args.batches):
+            frames = make_frames(args.batch_bytes, args.seed + i, args.compressible)
+            payload += sum(len(f) - 14 for f in frames)
+            if name == 'legacy':
+                copies, dt, size = legacy_path(frames, args.compression)
+            else:
+                copies, dt, size = current_path(frames, args.compression, crypto)
+            for k, v in copies.items():
+                totals[k] = totals.get(k, 0) + v
+            seconds += dt
+            sealed_bytes += size
+        copied = sum(totals.values())
+        result[name] = {
+            'payload_bytes': payload,
+            'uploaded_bytes': sealed_bytes,
+            'copied_bytes': copied,
+            'copied_per_payload_byte': round(copied / payload, 3),
+            'stages_per_payload_byte': {k: round(v / payload, 3) for k, v in totals.items()},
+            'ms_per_batch': round(seconds / args.batches * 1000, 1),
+        }
+        print(f"📏 {name}: {copied / payload:.2f} bytes copied per payload byte, "
+              f"{seconds / args.batches * 1000:.0f} ms/batch")
+    return result
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Bytes copied per payload byte on the uplink (legacy vs current)")
+    p.add_argument('--batch-bytes', type=int, default=65536, help="IP payload per batch")
+    p.add_argument('--batches', type=int, default=3)
+    p.add_argument('--compression', action='store_true')
+    p.add_argument('--compressible', action='store_true', help="repetitive payload instead of random bytes")
+    p.add_argument('--seed', type=int, default=1)
+    p.add_argument('--output', help="write JSON report here instead of stdout")
+    return p.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    json_out = sys.stdout
+    sys.stdout = sys.stderr
+    report = run(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+    else:
+        json_out.write(text + "\n")
@@ -2,36 +2,74 @@
 import vk_api
 from vk_api.longpoll import VkLongPoll, VkEventType
 from vk_api.upload import VkUpload
-from vk_api.exceptions import Captcha, ApiError  # <--- ВАЖНО
+from vk_api.exceptions import Captcha, ApiError, TOO_MANY_RPS_CODE  # <--- ВАЖНО
 import asyncio
-import io
 import time
-import requests
 from typing import Callable, Optional
+from urllib.parse import urlsplit
 from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 
 from config import config
-from crypto_utils import CryptoManager
-from compressor import Compressor
-
-
-class VKTransport:
-    def __init__(self):
+from base_transport import BaseTransport
+from batch_buffer import BatchBuffer, BufferReader
+from metrics import metrics
+
+# 6 — слишком много запросов в секунду (лимит на токен), 9 — flood control:
+# оба временные, запрос повторяется после паузы
+RATE_LIMIT_CODES = (6, 9)
+# Сколько id входящих сообщений сессия держит в очереди к своему пулу скачивания
+INBOX_LIMIT = 10000
+
+class _EndpointAdapter(HTTPAdapter):
+    """Перенаправляет запросы vk_api на другой адрес (локальный fake_vk_server.py)"""
+
+    def __init__(self, base_url: str):
+        super().__init__()
+        self.base_url = base_url.rstrip('/')
+
+    def send(self, request, **kwargs):
+        parts = urlsplit(request.url)
+        request.url = self.base_url + parts.path + (f'?{parts.query}' if parts.query else '')
+        return super().send(request, **kwargs)
+
+
+class VKTransport(BaseTransport):
+    # Ограничиваем очередь, чтобы при капче память не забилась
+    max_queue_size = 500
+    # Одна загрузка за раз, чтобы капчи вылетали по очереди, а не пачкой;
+    # скачиваний столько же, сколько потоков в executor
+    upload_workers = 1
+    download_workers = 2
+
+    def __init__(self, token: Optional[str] = None, peer_id=None, api_url: Optional[str] = None,
+                 encryption_key: Optional[str] = None, owner: Optional['VKTransport'] = None):
+        super().__init__(encryption_key)
+        # По умолчанию всё берётся из config; параметры нужны, чтобы поднять
+        # две стороны в одном процессе (стенд с fake_vk_server.py)
+        self.token = token if token is not None else config.vk_token
+        self.peer_id = int(peer_id if peer_id is not None else config.vk_peer_id or 0)
+        self.api_url = api_url if api_url is not None else config.vk_api_url
+        # owner задаётся для сессий многоклиентского сервера: у каждого клиента
+        # свой peer_id, а сессия VK и LongPoll общие (их держит owner, он же
+        # раздаёт входящие сообщения по peer_id)
+        self.owner = owner
+        self.owns_client = owner is None
+        self.sharers = []
+        if owner: owner.sharers.append(self)
         self.vk_session = None
         self.vk = None
         self.upload = None
         self.longpoll = None
 
-        self.receive_callback = None
-        self.crypto = CryptoManager(config.encryption_key)
-        self.compressor = Compressor()
-        self.is_connected = False
-
-        self.send_queue = asyncio.Queue()
-        self.sender_task = None
         self.receiver_task = None
-        # Уменьшаем кол-во потоков до 1, чтобы капчи вылетали по очереди, а не пачкой
-        self.upload_semaphore = asyncio.Semaphore(1)
+        # Id входящих от (общего) LongPoll: у каждой сессии своя очередь к своему
+        # пулу скачивания, так что медленный клиент не задерживает остальных
+        self.inbox = asyncio.Queue(maxsize=INBOX_LIMIT)
+        self.intake_task = None
+        # Горячий резерв (config.hot_standby): готовая сессия (vk_session, vk, upload, longpoll)
+        self.standby = None
+        self.standby_task = None
 
         self.captcha_callback: Optional[Callable] = None
         self.two_factor_callback: Optional[Callable] = None
@@ -58,128 +96,149 @@ class VKTransport:
         self.receive_callback = receive_callback
 
         try:
-            print(f"🔷 VK Connecting ({mode.upper()})...")
+            if not self.owns_client:
+                self._share_session(self.owner)
+                print(f"✅ VK session shared. Peer: {self.peer_id}")
+                self.is_connected = True
+                self.sender_task = asyncio.create_task(self._batch_sender_worker())
+                self.intake_task = asyncio.create_task(self._intake_worker())
+                return True
 
-            if config.vk_token and len(config.vk_token) > 10:
+            print(f"🔷 VK Connecting ({mode.upper()})...")
+            if self.token and len(self.token) > 10:
                 print("🔑 Using Access Token")
-                self.vk_session = vk_api.VkApi(token=config.vk_token)
-                try:
-                    self.vk = self.vk_session.get_api()
-                    loop = asyncio.get_running_loop()
-                    await loop.run_in_executor(self.executor, lambda: self.vk.users.get())
-                except Exception as e:
-                    print(f"❌ Token Invalid: {e}")
-                    return False
             else:
                 print("👤 Using Login/Password")
-                self.vk_session = vk_api.VkApi(
-                    login=config.vk_login,
-                    password=config.vk_password,
-                    app_id=config.vk_app_id,
-                    captcha_handler=self._captcha_handler,
-                    auth_handler=self._2fa_handler
-                )
-                loop = asyncio.get_running_loop()
-                await loop.run_in_executor(self.executor, self.vk_session.auth)
-                self.vk = self.vk_session.get_api()
-
-            self.upload = VkUpload(self.vk_session)
-            self.longpoll = VkLongPoll(self.vk_session)
+            self.vk_session, self.vk, self.upload, self.longpoll = await self._open_session()
 
-            print(f"✅ VK Connected. Peer: {config.vk_peer_id}")
+            print(f"✅ VK Connected. Peer: {self.peer_id}")
             self.is_connected = True
 
             self.sender_task = asyncio.create_task(self._batch_sender_worker())
             self.receiver_task = asyncio.create_task(self._receiver_worker())
+            self.intake_task = asyncio.create_task(self._intake_worker())
+            self._start_standby()
             return True
 
         except Exception as e:
             print(f"❌ VK Init Error: {e}")
             return False
 
-    async def send_data(self, data: bytes):
-        if not self.is_connected: return
-        # Ограничиваем очередь, чтобы при капче память не забилась
-        if self.send_queue.qsize() > 500:
-            try:
-                self.send_queue.get_nowait()
-            except:
-                pass
-        await self.send_queue.put(data)
-
-    async def _batch_sender_worker(self):
-        print("📦 VK Sender Started")
-        buffer = bytearray()
-        while self.is_connected:
+    async def _open_session(self):
+        """Новая авторизованная сессия: (vk_session, vk, upload, longpoll). Бросает исключение при ошибке"""
+        loop = asyncio.get_running_loop()
+        if self.token and len(self.token) > 10:
+            vk_session = vk_api.VkApi(token=self.token)
+            self._mount_api_url(vk_session.http)
+            vk = vk_session.get_api()
             try:
-                packet = await self.send_queue.get()
-                self._append_to_buffer(buffer, packet)
-                self.send_queue.task_done()
-
-                start = time.time()
-                while len(buffer) < config.max_batch_size:
-                    rem = config.batch_interval - (time.time() - start)
-                    if rem <= 0: break
-                    try:
-                        packet = await asyncio.wait_for(self.send_queue.get(), timeout=rem)
-                        self._append_to_buffer(buffer, packet)
-                        self.send_queue.task_done()
-                    except asyncio.TimeoutError:
-                        break
-
-                if buffer:
-                    data = bytes(buffer)
-                    buffer.clear()
-                    # Запускаем отправку
-                    asyncio.create_task(self._send_batch_task(data))
-
-            except asyncio.CancelledError:
-                break
+                await loop.run_in_executor(self.executor, lambda: vk.users.get())
             except Exception as e:
-                print(f"Sender Error: {e}")
-                await asyncio.sleep(0.1)
-
-    def _append_to_buffer(self, buffer, packet):
-        buffer.extend(len(packet).to_bytes(2, 'big'))
-        buffer.extend(packet)
-
-    async def _send_batch_task(self, raw_data: bytes):
-        async with self.upload_semaphore:
+                print(f"❌ Token Invalid: {e}")
+                raise
+        else:
+            vk_session = vk_api.VkApi(
+                login=config.vk_login,
+                password=config.vk_password,
+                app_id=config.vk_app_id,
+                captcha_handler=self._captcha_handler,
+                auth_handler=self._2fa_handler
+            )
+            self._mount_api_url(vk_session.http)
+            # Токен сохраняется в vk_config.v2.json, повторный вход обходится без 2FA
+            await loop.run_in_executor(self.executor, vk_session.auth)
+            vk = vk_session.get_api()
+
+        # Свой обработчик vk_api повторяет ошибку 6 бесконечно с паузой 0.5 с;
+        # пусть она доходит до нас и повторяется с растущей паузой
+        vk_session.error_handlers.pop(TOO_MANY_RPS_CODE, None)
+        upload = VkUpload(vk_session)
+        # Конструктор VkLongPoll сразу запрашивает сервер — это сетевой вызов
+        longpoll = await loop.run_in_executor(self.executor, VkLongPoll, vk_session)
+        self._mount_api_url(longpoll.session)
+        return vk_session, vk, upload, longpoll
+
+    def _share_session(self, owner: 'VKTransport'):
+        self.vk_session, self.vk, self.upload, self.longpoll = owner.vk_session, owner.vk, owner.upload, owner.longpoll
+
+    def _start_standby(self):
+        """Горячий резерв (config.hot_standby): вторая сессия с уже полученным LongPoll-сервером"""
+        if not config.hot_standby or self.standby is not None:
+            return
+        if self.standby_task and not self.standby_task.done():
+            return
+
+        async def connect():
             try:
-                data = self.compressor.compress(raw_data) if config.compression_enabled else raw_data
-                enc_data = self.crypto.encrypt(data)
-
-                # Создаем новый буфер для каждой попытки (чтобы seek(0) работал корректно)
-                f_data = enc_data
-
-                loop = asyncio.get_running_loop()
-                await loop.run_in_executor(self.executor, self._blocking_send, f_data)
+                self.standby = await self._open_session()
+                print("🛟 Hot standby session ready")
             except Exception as e:
-                # print(f"⚠️ Send Fail: {e}") # Отключаем спам в лог
-                pass
+                print(f"⚠️ Hot standby not ready: {e}")
+
+        self.standby_task = asyncio.create_task(connect())
+
+    async def _reconnect(self) -> bool:
+        if not self.owns_client:
+            # Сессия общая: её восстанавливает владелец
+            return self.owner.link_up
+        if self.standby is not None:
+            session, self.standby = self.standby, None
+            print("🛟 Switched to hot standby session")
+        else:
+            session = await self._open_session()
+        self.vk_session, self.vk, self.upload, self.longpoll = session
+        for t in self.sharers:
+            t._share_session(self)
+        self._start_standby()
+        return True
+
+    def _mount_api_url(self, session):
+        """Если задан vk_api_url, все запросы к API, LongPoll и загрузкам идут туда"""
+        if not self.api_url: return
+        adapter = _EndpointAdapter(self.api_url)
+        for host in ('api.vk.com', 'api.vk.ru', urlsplit(self.api_url).netloc):
+            session.mount(f'https://{host}/', adapter)
+
+    async def _send_batch_task(self, batch: BatchBuffer):
+        try:
+            batch = await self._encode_batch_async(batch)
+            f_data = batch.sealed
+
+            loop = asyncio.get_running_loop()
+            start = time.perf_counter()
+            if await loop.run_in_executor(self.executor, self._blocking_send, f_data):
+                metrics.upload_seconds.time(start)
+                metrics.upload_bytes.inc(len(f_data))
+                self._batch_uploaded(batch)
+            else:
+                metrics.upload_errors.inc()
+        except Exception as e:
+            # print(f"⚠️ Send Fail: {e}") # Отключаем спам в лог
+            self._upload_failed(batch, e)
+            return
+        self._release_batch(batch)
 
-    def _blocking_send(self, data_bytes):
-        """Блокирующая отправка с ручной обработкой капчи"""
+    def _blocking_send(self, data_bytes: memoryview) -> bool:
+        """Блокирующая отправка с ручной обработкой капчи. True — сообщение отправлено"""
         retries = 0
         max_retries = 5
 
         while retries < max_retries:
             try:
-                # Подготовка файла
-                f = io.BytesIO(data_bytes)
-                f.name = "d.bin"
+                # Подготовка файла: новый читатель на каждую попытку (позиция с нуля)
+                f = BufferReader(data_bytes, "d.bin")
 
                 # 1. Загрузка
-                doc = self.upload.document_message(f, peer_id=int(config.vk_peer_id))
+                doc = self.upload.document_message(f, peer_id=self.peer_id)
                 d = doc['doc']
 
                 # 2. Отправка
                 self.vk.messages.send(
-                    peer_id=int(config.vk_peer_id),
+                    peer_id=self.peer_id,
                     attachment=f"doc{d['owner_id']}_{d['id']}",
                     random_id=0
                 )
-                return  # Успех
+                return True  # Успех
 
             except Captcha as e:
                 print(f"⚠️ SEND CAPTCHA: {e.get_url()}")
@@ -189,14 +248,18 @@ class VKTransport:
                     if code:
                         e.try_again(code)  # Обновляем параметры капчи для следующей попытки
                         print(f"✅ Retry with code: {code}")
+                        if e.args and e.args[0] == 'messages.send':
+                            return True  # try_again уже отправил сообщение, повтор дал бы дубль
                         continue  # Повторяем цикл while
                 print("❌ Captcha not solved, dropping packet")
                 break
 
             except ApiError as e:
-                if e.code == 9:  # Flood control
-                    print("⏳ Flood limit. Sleeping 1s...")
-                    time.sleep(1)
+                if e.code in RATE_LIMIT_CODES:
+                    # Лимит общий на токен (одна сессия на всех клиентов сервера): пауза растёт
+                    delay = 2 ** retries
+                    print(f"⏳ Rate limit ({e.code}). Sleeping {delay}s...")
+                    time.sleep(delay)
                     retries += 1
                 elif e.code == 14:  # Captcha needed (иногда прилетает как ApiError)
                     # Обработка сложнее, vk_api обычно само кидает Captcha exception
@@ -205,57 +268,84 @@ class VKTransport:
                 else:
                     print(f"❌ API Error: {e}")
                     break
+            except OSError:
+                raise  # обрыв сети (requests) — решает _send_batch_task: backlog и переподключение
             except Exception as e:
                 print(f"❌ Unknown Send Error: {e}")
                 break
+        return False
+
+    def _blocking_get_message(self, mid):
+        """messages.getById с повтором при лимите запросов (ошибки 6 и 9)"""
+        for retries in range(5):
+            try:
+                return self.vk.messages.getById(message_ids=[mid])
+            except ApiError as e:
+                if e.code not in RATE_LIMIT_CODES or retries == 4:
+                    raise
+                time.sleep(2 ** retries)
 
     async def _receiver_worker(self):
         print("📥 VK Receiver Started")
         loop = asyncio.get_running_loop()
+        failures = 0
         while self.is_connected:
+            if self.reconnect_task is not None:
+                await asyncio.sleep(0.5)
+                continue
             try:
-                events = await loop.run_in_executor(self.executor, lambda: list(self.longpoll.check()))
+                longpoll = self.longpoll
+                events = await loop.run_in_executor(self.executor, lambda: list(longpoll.check()))
+                failures = 0
+                # Один LongPoll на все сессии: сообщение достаётся сессии своего peer_id
+                sessions = {t.peer_id: t for t in [self] + self.sharers if t.is_connected}
                 for event in events:
-                    if event.type == VkEventType.MESSAGE_NEW and event.to_me and event.peer_id == int(
-                            config.vk_peer_id):
+                    if event.type == VkEventType.MESSAGE_NEW and event.to_me and event.peer_id in sessions:
                         if event.attachments.get('attach1_type') == 'doc':
-                            asyncio.create_task(self._process_msg(event.message_id))
+                            sessions[event.peer_id]._deliver(event.message_id)
             except Exception as e:
                 # print(f"Receiver Error: {e}")
+                failures += 1
+                # LongPoll сам переполучает сервер на ошибках API; три сетевых сбоя подряд — обрыв
+                if failures >= 3 and self._is_connection_error(e) and longpoll is self.longpoll:
+                    failures = 0
+                    self.connection_lost(e)
                 await asyncio.sleep(1)
 
-    async def _process_msg(self, mid):
+    def _deliver(self, mid):
+        """Из LongPoll без ожидания; переполненная очередь сессии теряет сообщение"""
         try:
-            loop = asyncio.get_running_loop()
-            res = await loop.run_in_executor(self.executor, lambda: self.vk.messages.getById(message_ids=[mid]))
-            if not res['items']: return
-            for att in res['items'][0].get('attachments', []):
-                if att['type'] == 'doc':
-                    url = att['doc']['url']
-                    content = await loop.run_in_executor(None, lambda: requests.get(url).content)
-                    try:
-                        dec = self.crypto.decrypt(content)
-                        data = self.compressor.decompress(dec) if config.compression_enabled else dec
-                        await self._route_data(data)
-                    except:
-                        pass
-        except Exception as e:
-            pass
-
-    async def _route_data(self, data):
-        idx = 0
-        l = len(data)
-        while idx < l:
-            if idx + 2 > l: break
-            pl = int.from_bytes(data[idx:idx + 2], 'big')
-            idx += 2
-            if idx + pl > l: break
-            if self.receive_callback:
-                await self.receive_callback(data[idx:idx + pl])
-            idx += pl
+            self.inbox.put_nowait(mid)
+        except asyncio.QueueFull:
+            metrics.vk_inbox_dropped.inc()
+
+    async def _intake_worker(self):
+        # Пул занят — ждёт только эта сессия
+        while self.is_connected:
+            await self.download_pool.submit(await self.inbox.get())
+
+    async def _download_task(self, mid):
+        # Ошибки сети и API печатает и считает пул (televpn_pool_download_errors_total)
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        res = await loop.run_in_executor(self.executor, self._blocking_get_message, mid)
+        if not res['items']: return
+        for att in res['items'][0].get('attachments', []):
+            if att['type'] == 'doc':
+                url = att['doc']['url']
+                # Через сессию vk_api: keep-alive и тот же vk_api_url
+                content = await loop.run_in_executor(None, lambda: self.vk_session.http.get(url).content)
+                metrics.download_seconds.time(start)
+                try:
+                    data = await self._decode_batch_async(content)
+                except Exception:
+                    continue  # учтено в televpn_decode_errors_total
+                await self._parse_batch_and_route(data)
 
     async def disconnect(self):
-        self.is_connected = False
-        if self.sender_task: self.sender_task.cancel()
+        await super().disconnect()
         if self.receiver_task: self.receiver_task.cancel()
+        if self.intake_task: self.intake_task.cancel()
+        if self.standby_task: self.standby_task.cancel()
+        self.standby = None
         self.executor.shutdown(wait=False)
\ No newline at end of file
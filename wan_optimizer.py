@@ -0,0 +1,324 @@
+# --- START OF FILE wan_optimizer.py ---
+"""
+WAN-оптимизация: дедупликация повторяющегося содержимого между концами туннеля.
+
+Одни и те же байты ходят через туннель много раз (повторные загрузки,
+обновления, одинаковые картинки), и каждая копия — полная загрузка в
+мессенджер. Полезная нагрузка IP-пакетов батча режется на чанки по
+содержимому (gear rolling hash, как в FastCDC): границы зависят от
+самих байт, а не от смещения, поэтому сдвиг данных внутри пакета не
+ломает совпадения. Обе стороны держат LRU-хранилище чанков с одинаковым
+бюджетом config.wan_cache_bytes: отправитель помнит, какие чанки уже
+отправил, получатель — сами чанки. Повторный чанк уходит ссылкой
+(8 байт BLAKE2b) вместо содержимого.
+
+Формат батча с флагом BATCH_FLAG_WAN (до сжатия и шифрования):
+    [эпоха: 4 байта] и токены:
+    [0][длина: 2][байты]        литерал (заголовки, служебные кадры, мелочь)
+    [1][длина: 2][байты]        чанк целиком — получатель кладёт его в хранилище
+    [2][длина: 2][хеш: 8]       ссылка на чанк из хранилища
+
+Хранилища расходятся, когда батчи теряются или приходят не по порядку
+(загрузок и скачиваний несколько параллельно). Поэтому:
+  * на чанк можно ссылаться только через settle секунд после первой
+    отправки — к этому времени батч с ним уже дошёл до пира;
+  * у получателя запас хранилища на 1/8 больше, так что разный порядок
+    обращений почти не приводит к разному вытеснению;
+  * ссылка на неизвестный чанк: пакеты с ней отбрасываются (TCP повторит),
+    а пиру уходит CTRL_WAN_NACK с хешами — он забывает их и следующую
+    копию отправит целиком;
+  * много промахов сразу (например, получатель перезапустился) —
+    CTRL_WAN_RESET: отправитель очищает хранилище и начинает новую эпоху,
+    получатель, увидев новую эпоху, тоже начинает с чистого листа.
+"""
+import random
+import struct
+import time
+from collections import OrderedDict, deque
+from hashlib import blake2b
+
+from config import config
+from control_frames import CTRL_WAN_NACK, CTRL_WAN_RESET
+from metrics import metrics
+
+TOKEN_LITERAL = 0
+TOKEN_CHUNK = 1
+TOKEN_REF = 2
+
+DIGEST_SIZE = 8
+REF_SIZE = 3 + DIGEST_SIZE
+MAX_LITERAL = 0xFFFF
+
+# Размеры чанков: средний ~256 байт (8 бит маски), чтобы в пакет на MTU
+# попадало несколько границ
+MIN_CHUNK = 64
+MAX_CHUNK = 2048
+_MASK = 0xFF << 24  # старшие биты: в младших gear-хеш помнит только последние байты
+_WINDOW = 32        # за 32 сдвига байт полностью уходит из 32-битного хеша
+_rng = random.Random(0x7E1E)  # таблица одна и та же на обоих концах
+_GEAR = tuple(_rng.getrandbits(32) for _ in range(256))
+del _rng
+
+_EPOCH = struct.Struct('!I')
+# Промахов в одном батче, после которых проще начать эпоху заново
+RESET_MISSES = 16
+
+
+def chunk_bounds(data, start: int, end: int) -> list:
+    """Границы чанков data[start:end]: [(начало, конец), ...]"""
+    gear, mask = _GEAR, _MASK
+    bounds = []
+    while end - start > MIN_CHUNK:
+        stop = min(end, start + MAX_CHUNK)
+        cut = stop
+        h = 0
+        # Хеш набирается за _WINDOW байт до минимального размера, поэтому
+        # граница зависит только от содержимого, а не от начала чанка
+        i = start + MIN_CHUNK - _WINDOW
+        for b in data[i:stop]:
+            h = ((h << 1) + gear[b]) & 0xFFFFFFFF
+            i += 1
+            if not h & mask and i - start >= MIN_CHUNK:
+                cut = i
+                break
+        bounds.append((start, cut))
+        start = cut
+    if start < end:
+        bounds.append((start, end))
+    return bounds
+
+
+def payload_offset(data, start: int, length: int) -> int:
+    """Смещение полезной нагрузки в IP-пакете (за заголовками IP и TCP/UDP)"""
+    version = data[start] >> 4
+    if version == 4:
+        ihl = (data[start] & 0x0F) * 4
+        proto = data[start + 9]
+        if (data[start + 6] & 0x1F) or data[start + 7]:
+            return min(ihl, length)  # не первый фрагмент: заголовка L4 нет
+    elif version == 6:
+        ihl, proto = 40, data[start + 6]
+    else:
+        return length
+    if proto == 6 and length >= ihl + 20:
+        return min(length, ihl + (data[start + ihl + 12] >> 4) * 4)
+    if proto == 17:
+        return min(length, ihl + 8)
+    return min(length, ihl)
+
+
+class WanOptimizer:
+    """Кодек батчей одного транспорта: отправляющая и принимающая половины независимы"""
+
+    def __init__(self, capacity: int = None):
+        self.capacity = capacity if capacity is not None else config.wan_cache_bytes
+        # Отправитель: хеш -> [размер, время первой отправки]
+        self.sent = OrderedDict()
+        self.sent_bytes = 0
+        self.epoch = random.getrandbits(32)
+        # Получатель: хеш -> чанк
+        self.chunks = OrderedDict()
+        self.chunk_bytes = 0
+        self.peer_epoch = None
+        self.retired = deque(maxlen=8)
+        self.reset_sent = None
+        # Служебные кадры для пира [(тип, данные)], забирает транспорт
+        self.outgoing = []
+
+        self.hits = 0
+        self.chunks_sent = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.misses = 0
+        self.dropped_packets = 0
+        self.resets = 0
+
+    # --- Отправка ---
+
+    def encode_into(self, data, out, settle: float):
+        """Батч data -> токены в out (BatchBuffer); на чанк ссылаемся через settle с после отправки"""
+        now = time.monotonic()
+        sent = self.sent
+        out.extend(_EPOCH.pack(self.epoch))
+        out_start = len(out)
+        literal = 0  # начало ещё не записанного литерала
+        idx, total = 0, len(data)
+        while idx + 2 <= total:
+            pkt_len = (data[idx] << 8) | data[idx + 1]
+            if pkt_len == 0:
+                # Служебный кадр: [0x0000][тип][длина: 2][данные] — целиком литералом
+                if idx + 5 > total: break
+                idx += 5 + ((data[idx + 3] << 8) | data[idx + 4])
+                continue
+            start = idx + 2
+            idx = start + pkt_len
+            if idx > total: break
+            body = start + payload_offset(data, start, pkt_len)
+            if idx - body < MIN_CHUNK:
+                continue
+            for a, b in chunk_bounds(data, body, idx):
+                if b - a < MIN_CHUNK:
+                    continue
+                chunk = data[a:b]
+                digest = blake2b(chunk, digest_size=DIGEST_SIZE).digest()
+                entry = sent.get(digest)
+                self._literal(out, data, literal, a)
+                literal = b
+                if entry is not None:
+                    sent.move_to_end(digest)
+                    if now - entry[1] >= settle:
+                        out.append(TOKEN_REF)
+                        out.extend((b - a).to_bytes(2, 'big'))
+                        out.extend(digest)
+                        self.hits += 1
+                        metrics.wan_chunk_hits.inc()
+                        metrics.wan_bytes_saved.inc(b - a - REF_SIZE)
+                        continue
+                else:
+                    sent[digest] = [b - a, now]
+                    self.sent_bytes += b - a
+                out.append(TOKEN_CHUNK)
+                out.extend((b - a).to_bytes(2, 'big'))
+                out.extend(chunk)
+                self.chunks_sent += 1
+                metrics.wan_chunks_sent.inc()
+        self._literal(out, data, literal, total)
+        while self.sent_bytes > self.capacity:
+            _, (size, _) = sent.popitem(last=False)
+            self.sent_bytes -= size
+        self.bytes_in += total
+        self.bytes_out += len(out) - out_start + _EPOCH.size
+
+    @staticmethod
+    def _literal(out, data, start: int, end: int):
+        while start < end:
+            n = min(end - start, MAX_LITERAL)
+            out.append(TOKEN_LITERAL)
+            out.extend(n.to_bytes(2, 'big'))
+            out.extend(data[start:start + n])
+            start += n
+
+    def on_nack(self, payload: bytes):
+        """Пир не нашёл эти чанки: забываем их, следующая копия уйдёт целиком"""
+        if len(payload) < 4 or _EPOCH.unpack_from(payload)[0] != self.epoch:
+            return
+        for i in range(4, len(payload) - DIGEST_SIZE + 1, DIGEST_SIZE):
+            entry = self.sent.pop(payload[i:i + DIGEST_SIZE], None)
+            if entry is not None:
+                self.sent_bytes -= entry[0]
+
+    def on_reset(self, payload: bytes):
+        """Хранилища разошлись: новая эпоха с пустым хранилищем"""
+        if len(payload) < 4 or _EPOCH.unpack_from(payload)[0] != self.epoch:
+            return  # повтор запроса уже обработанной эпохи
+        self.epoch = (self.epoch + 1) & 0xFFFFFFFF
+        self.sent.clear()
+        self.sent_bytes = 0
+        self.resets += 1
+        metrics.wan_resyncs.inc()
+        print(f"🔁 WAN chunk store reset by peer, epoch {self.epoch:08x}")
+
+    # --- Приём ---
+
+    def decode(self, data) -> bytes:
+        """Токены -> исходный батч. Записи со ссылками на неизвестные чанки выбрасываются"""
+        epoch = _EPOCH.unpack_from(data)[0]
+        # Батч эпохи, которую пир уже сменил: читаем, но хранилище не трогаем
+        learn = epoch not in self.retired
+        if learn and epoch != self.peer_epoch:
+            if self.peer_epoch is not None:
+                self.retired.append(self.peer_epoch)
+            self.peer_epoch = epoch
+            self.chunks.clear()
+            self.chunk_bytes = 0
+
+        chunks = self.chunks
+        out = bytearray()
+        broken = []
+        missing = []
+        pos, total = 4, len(data)
+        while pos + 3 <= total:
+            token = data[pos]
+            n = (data[pos + 1] << 8) | data[pos + 2]
+            pos += 3
+            if token == TOKEN_LITERAL:
+                out += data[pos:pos + n]
+                pos += n
+            elif token == TOKEN_CHUNK:
+                chunk = bytes(data[pos:pos + n])
+                pos += n
+                out += chunk
+                if learn:
+                    digest = blake2b(chunk, digest_size=DIGEST_SIZE).digest()
+                    if digest in chunks:
+                        chunks.move_to_end(digest)
+                    else:
+                        chunks[digest] = chunk
+                        self.chunk_bytes += n
+            elif token == TOKEN_REF:
+                digest = bytes(data[pos:pos + DIGEST_SIZE])
+                pos += DIGEST_SIZE
+                chunk = chunks.get(digest)
+                if chunk is not None:
+                    if learn:
+                        chunks.move_to_end(digest)
+                    out += chunk
+                else:
+                    broken.append(len(out))
+                    missing.append(digest)
+                    out += bytes(n)
+            else:
+                raise ValueError(f"bad WAN token {token}")
+        # Запас 1/8: другой порядок обращений у получателя не вытесняет нужное пиру
+        limit = self.capacity + self.capacity // 8
+        while self.chunk_bytes > limit:
+            _, chunk = chunks.popitem(last=False)
+            self.chunk_bytes -= len(chunk)
+
+        if not missing:
+            return bytes(out)
+        self.misses += len(missing)
+        metrics.wan_misses.inc(len(missing))
+        if learn:
+            self._resync(epoch, missing)
+        return self._drop_broken(out, broken)
+
+    def _resync(self, epoch: int, missing: list):
+        if len(missing) >= RESET_MISSES or not self.chunks:
+            # Похоже, у нас нет почти ничего из того, что помнит пир
+            if self.reset_sent != epoch:
+                self.reset_sent = epoch
+                self.outgoing.append((CTRL_WAN_RESET, _EPOCH.pack(epoch)))
+            return
+        self.outgoing.append((CTRL_WAN_NACK, _EPOCH.pack(epoch) + b''.join(missing)))
+
+    def _drop_broken(self, data: bytearray, broken: list) -> bytes:
+        """Батч без записей, в которые попали недостающие чанки"""
+        out = bytearray()
+        idx, total, k = 0, len(data), 0
+        while idx + 2 <= total:
+            pkt_len = (data[idx] << 8) | data[idx + 1]
+            if pkt_len == 0:
+                if idx + 5 > total: break
+                end = idx + 5 + ((data[idx + 3] << 8) | data[idx + 4])
+            else:
+                end = idx + 2 + pkt_len
+            while k < len(broken) and broken[k] < idx:
+                k += 1
+            if k < len(broken) and broken[k] < end:
+                self.dropped_packets += 1
+                metrics.wan_dropped_packets.inc()
+            else:
+                out += data[idx:end]
+            idx = end
+        return bytes(out)
+
+    def stats(self) -> dict:
+        looked_up = self.hits + self.chunks_sent
+        return {'epoch': f'{self.epoch:08x}', 'capacity': self.capacity,
+                'sent_chunks': len(self.sent), 'sent_bytes': self.sent_bytes,
+                'stored_chunks': len(self.chunks), 'stored_bytes': self.chunk_bytes,
+                'hits': self.hits, 'chunks_sent': self.chunks_sent,
+                'hit_rate': round(self.hits / looked_up, 4) if looked_up else 0.0,
+                'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out,
+                'misses': self.misses, 'dropped_packets': self.dropped_packets, 'resets': self.resets}
@@ -0,0 +1,117 @@
+# --- START OF FILE worker_pool.py ---
+"""
+Пул воркеров с ограниченной очередью заданий.
+
+Вместо asyncio.create_task на каждый батч/сообщение: фиксированное число
+воркеров берёт задания из asyncio.Queue(maxsize). Когда очередь полна,
+submit() ждёт — это и есть обратное давление (батчер перестаёт выбирать
+пакеты, очередь отправки транспорта начинает выбрасывать старые).
+
+Ошибка задания не теряется: она печатается и считается в метриках, воркер
+продолжает работу. Если воркер всё же завершился, пул поднимает новый.
+Метрики агрегируются по имени пула (upload, download) по всем экземплярам.
+Задания с меньшим priority берутся первыми (срочные служебные батчи);
+при равном — в порядке постановки.
+"""
+import asyncio
+import itertools
+import time
+import weakref
+from typing import Awaitable, Callable, List
+
+from metrics import metrics
+
+_pools = weakref.WeakSet()
+
+
+def _sum(name: str, attr: str) -> float:
+    return sum(getattr(p, attr) for p in list(_pools) if p.name == name)
+
+
+def _register_metrics(name: str):
+    prefix = f'televpn_pool_{name}'
+    metrics.gauge(f'{prefix}_busy', f'Busy {name} workers', fn=lambda: _sum(name, 'busy'))
+    metrics.gauge(f'{prefix}_utilization', f'Busy / total {name} workers',
+                  fn=lambda: _sum(name, 'busy') / (_sum(name, 'workers') or 1))
+    metrics.gauge(f'{prefix}_queued', f'Jobs waiting in {name} pool queues', fn=lambda: _sum(name, 'queued'))
+    return (metrics.histogram(f'{prefix}_queue_wait_seconds', f'Time a {name} job waits for a worker'),
+            metrics.counter(f'{prefix}_errors_total', f'{name} jobs that raised an exception'))
+
+
+class WorkerPool:
+    def __init__(self, name: str, handler: Callable[..., Awaitable[None]], workers: int, queue_size: int):
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.queue = asyncio.PriorityQueue(maxsize=queue_size)
+        self.seq = itertools.count()
+        self.tasks: List[asyncio.Task] = []
+        self.busy = 0
+        self.processed = 0
+        self.errors = 0
+        self.closed = False
+        self.wait_hist, self.error_counter = _register_metrics(name)
+        _pools.add(self)
+
+    @property
+    def queued(self) -> int:
+        return self.queue.qsize()
+
+    def start(self):
+        self.closed = False
+        while len(self.tasks) < self.workers:
+            self._spawn()
+
+    def _spawn(self):
+        task = asyncio.create_task(self._worker())
+        task.add_done_callback(self._on_worker_done)
+        self.tasks.append(task)
+
+    def _on_worker_done(self, task: asyncio.Task):
+        if task in self.tasks:
+            self.tasks.remove(task)
+        if self.closed or task.cancelled():
+            return
+        print(f"⚠️ {self.name} worker died ({task.exception()!r}), restarting")
+        self._spawn()
+
+    async def submit(self, item, priority: int = 1):
+        """Поставить задание; ждёт, пока в очереди не освободится место"""
+        if not self.tasks and not self.closed:
+            self.start()
+        await self.queue.put((priority, next(self.seq), time.perf_counter(), item))
+
+    async def _worker(self):
+        while True:
+            _, _, enqueued, item = await self.queue.get()
+            self.wait_hist.time(enqueued)
+            self.busy += 1
+            try:
+                await self.handler(item)
+                self.processed += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.errors += 1
+                self.error_counter.inc()
+                print(f"❌ {self.name} job failed: {e}")
+            finally:
+                self.busy -= 1
+                self.queue.task_done()
+
+    async def join(self):
+        """Дождаться выполнения всех поставленных заданий"""
+        await self.queue.join()
+
+    def stop(self):
+        """Остановить воркеры; невыполненные задания отбрасываются"""
+        self.closed = True
+        for task in self.tasks:
+            task.cancel()
+        while not self.queue.empty():
+            self.queue.get_nowait()
+            self.queue.task_done()
+
+    def stats(self) -> dict:
+        return {'workers': self.workers, 'busy': self.busy, 'queued': self.queued,
+                'queue_size': self.queue.maxsize, 'processed': self.processed, 'errors': self.errors}